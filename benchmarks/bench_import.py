@@ -0,0 +1,52 @@
+""" Measures cold import time of the pipeline modules in fresh interpreters and lists heavy dependencies they load.
+Heavy dependencies should be imported on first use, the script exits with an error if an import loads any of them.
+
+Usage: python bench_import.py [module ...] [--repeat 5]
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+MODULES = ['s2_water_extraction', 'scheduler', 'geom_utils', 'visualisation', 'timelapse', 'tiled_extraction']
+# geopandas is not listed, it is imported by sentinelhub itself
+HEAVY_MODULES = ['s2cloudless', 'lightgbm', 'skimage.feature', 'skimage.morphology', 'scipy.ndimage', 'rasterio',
+                 'matplotlib', 'matplotlib.pyplot', 'tqdm']
+
+IMPORT_SCRIPT = """
+import sys, time, json
+import numpy
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'heavy': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+def time_import(module, repeat=5):
+    """
+    Imports the module in `repeat` fresh interpreters (with numpy already imported, as by every caller) and returns
+    the best time and heavy modules loaded by the import.
+    """
+    src_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [src_folder, os.environ.get('PYTHONPATH')])))
+    script = IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+
+    results = [json.loads(subprocess.check_output([sys.executable, '-W', 'ignore', '-c', script], env=env))
+               for _ in range(repeat)]
+    return min(result['seconds'] for result in results), results[0]['heavy']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import time of pipeline modules.')
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'module':>20} {'time':>8}  heavy dependencies loaded")
+    for module in args.modules:
+        seconds, heavy = time_import(module, repeat=args.repeat)
+        print(f"{module:>20} {seconds:>7.3f}s  {', '.join(heavy) or '-'}")
+        failed = failed or len(heavy) > 0
+    sys.exit(1 if failed else 0)
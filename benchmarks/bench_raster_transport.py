@@ -0,0 +1,119 @@
+""" Compares passing rasters to a process pool by pickling with the shared buffers of `raster_transport.RasterRing`:
+throughput and peak memory of the main process and of the workers. Each transport runs in a fresh interpreter, so
+peak memory is not shared between runs.
+
+Rasters are synthetic NDWI frames emulating downloads, at most `--pending` frames are in flight as in
+`CatalogueScheduler`. Workers either only read the raster (`--task sum`, transport dominates) or compute the
+water mask (`--task water_mask`). The first `--pending` frames warm up the pool and the buffers and are not timed.
+RSS counts shared pages in every process which touched them, so worker RSS of shared transports overstates the
+memory they use.
+
+Usage: python bench_raster_transport.py [--size 2000] [--frames 64] [--workers 2] [--task sum]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from synthetic import get_synthetic_dam, get_synthetic_ndwi
+from raster_transport import RasterRing, get_raster
+
+TRANSPORTS = ['pickle', 'shm', 'mmap']
+
+def get_peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss/1024
+
+def process_raster(raster, task):
+    ndwi = get_raster(raster)
+    if task == 'water_mask':
+        from s2_water_extraction import get_water_mask_from_S2
+        return get_water_mask_from_S2(ndwi)[0]
+    return float(ndwi.sum(dtype=np.float64))
+
+def run_transport(transport, size, n_frames, n_workers, max_pending, task):
+    """
+    Passes `n_frames` rasters to a process pool with the given transport and returns the throughput and peak RSS
+    of the main process and of the workers.
+    """
+    dam_poly, dam_bbox = get_synthetic_dam(size)
+    ndwi = get_synthetic_ndwi(dam_poly, dam_bbox, size)
+    ring = None if transport == 'pickle' else RasterRing(n_slots=max_pending, backend=transport)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        for idx in range(max_pending + n_frames):
+            if idx == max_pending:
+                # warm up workers and buffers before timing
+                while pending:
+                    raster, future = pending.popleft()
+                    future.result()
+                    if ring is not None:
+                        ring.release(raster)
+                start = time.perf_counter()
+            # a new array per frame, as returned by a download
+            frame = ndwi + 0
+            raster = frame if ring is None else ring.put(frame)
+            pending.append((raster, executor.submit(process_raster, raster, task)))
+            del frame
+            if len(pending) == max_pending:
+                raster, future = pending.popleft()
+                future.result()
+                if ring is not None:
+                    ring.release(raster)
+        while pending:
+            raster, future = pending.popleft()
+            future.result()
+            if ring is not None:
+                ring.release(raster)
+        seconds = time.perf_counter() - start
+
+    result = {'transport': transport, 'seconds': seconds, 'frames_per_s': n_frames/seconds,
+              'main_rss_mb': get_peak_rss_mb(resource.RUSAGE_SELF),
+              'worker_rss_mb': get_peak_rss_mb(resource.RUSAGE_CHILDREN)}
+    if ring is not None:
+        result['shared_mb'] = ring.nbytes/2**20
+        result['fallbacks'] = ring.stats['pickled']
+        ring.close()
+    return result
+
+def bench_transport(transport, args):
+    """
+    Runs the transport in a fresh interpreter and returns its results.
+    """
+    command = [sys.executable, '-W', 'ignore', os.path.abspath(__file__), '--run', transport, '--size', str(args.size),
+               '--frames', str(args.frames), '--workers', str(args.workers), '--pending', str(args.pending),
+               '--task', args.task]
+    return json.loads(subprocess.check_output(command).decode().splitlines()[-1])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Raster transport to worker processes.')
+    parser.add_argument('transports', nargs='*', default=TRANSPORTS)
+    parser.add_argument('--size', type=int, default=2000)
+    parser.add_argument('--frames', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--pending', type=int, default=8)
+    parser.add_argument('--task', choices=['sum', 'water_mask'], default='sum')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_transport(args.run, args.size, args.frames, args.workers, args.pending, args.task)))
+        sys.exit(0)
+
+    print(f'{args.frames} frames of {args.size} x {args.size} float32, {args.workers} workers, '
+          f'{args.pending} in flight, task {args.task}')
+    print(f"{'transport':>10} {'frames/s':>9} {'main RSS':>10} {'worker RSS':>11} {'shared':>9}")
+    for transport in args.transports:
+        result = bench_transport(transport, args)
+        shared = f"{result['shared_mb']:.0f} MB" if 'shared_mb' in result else '-'
+        print(f"{transport:>10} {result['frames_per_s']:>9.1f} {result['main_rss_mb']:>7.0f} MB "
+              f"{result['worker_rss_mb']:>8.0f} MB {shared:>9}")
@@ -0,0 +1,93 @@
+""" Compares float and compact (UINT8/UINT16) transfer of NDWI and cloud bands: transfer size, decode time and
+equivalence of water masks and cloud coverage. Responses are emulated by encoding synthetic rasters as the
+evalscripts do and writing them as TIFF files, decoding uses the same path as sentinelhub.
+
+Usage: python bench_transfer.py [size ...]
+"""
+
+import sys
+from io import BytesIO
+
+import numpy as np
+import tifffile
+
+from synthetic import get_synthetic_dam, get_synthetic_ndwi, get_synthetic_cloud_bands
+from bench_water_extent import time_call
+
+from s2_water_extraction import S2_NDWI_ENCODINGS, decode_ndwi, decode_cloud_bands, get_cloud_coverage
+from s2_water_extraction import get_water_mask_from_S2
+
+SIZES = [1000, 2000, 4000]
+
+def encode_ndwi(ndwi, valid, encoding):
+    """
+    Numpy equivalent of `S2_NDWI_COMPACT_SCRIPT_V3`.
+    """
+    half_range = S2_NDWI_ENCODINGS[encoding][1]
+    packed = 2*(np.floor(ndwi*half_range + 0.5) + half_range) + valid
+    return packed.astype(encoding.lower())
+
+def encode_cloud_bands(bands):
+    """
+    Numpy equivalent of `S2_CLOUD_BANDS_COMPACT_SCRIPT_V3`.
+    """
+    packed = np.clip(np.floor(10000*bands[..., :-1] + 0.5), 1, 65535).astype(np.uint16)
+    packed[bands[..., -1] == 0] = 0
+    return packed
+
+def to_tiff(array):
+    buffer = BytesIO()
+    tifffile.imwrite(buffer, array)
+    return buffer.getvalue()
+
+def decode_tiff(data, decode=None, *args):
+    image = tifffile.imread(BytesIO(data))
+    return image if decode is None else decode(image, *args)
+
+def bench_ndwi_transfer(size, repeat=3):
+    dam_poly, dam_bbox = get_synthetic_dam(size)
+    ndwi = get_synthetic_ndwi(dam_poly, dam_bbox, size)
+    valid = np.ones(ndwi.shape, dtype=np.float32)
+    valid[:size//100] = 0
+
+    float_tiff = to_tiff(np.stack([ndwi, valid], axis=-1))
+    float_data, t_float = time_call(decode_tiff, float_tiff, repeat=repeat)
+    float_status, float_mask = get_water_mask_from_S2(float_data[..., 0])
+
+    results = [{'data': 'NDWI', 'encoding': 'FLOAT32', 'bytes': len(float_tiff), 'decode_s': t_float,
+                'status_equal': True, 'mismatch': 0.0}]
+    for encoding in S2_NDWI_ENCODINGS:
+        tiff = to_tiff(encode_ndwi(ndwi, valid, encoding))
+        data, t_decode = time_call(decode_tiff, tiff, decode_ndwi, encoding, repeat=repeat)
+        status, mask = get_water_mask_from_S2(data[..., 0])
+        results.append({'data': 'NDWI', 'encoding': encoding, 'bytes': len(tiff), 'decode_s': t_decode,
+                        'status_equal': status == float_status and np.array_equal(data[..., 1], valid),
+                        'mismatch': np.count_nonzero(mask != float_mask)/mask.size})
+    return results
+
+def bench_cloud_transfer(size, repeat=3):
+    bands = get_synthetic_cloud_bands(size//8, cloud_fraction=0.15)
+    bands[:size//800, :, -1] = 0
+
+    float_tiff = to_tiff(bands)
+    float_data, t_float = time_call(decode_tiff, float_tiff, repeat=repeat)
+    float_coverage = get_cloud_coverage(float_data[np.newaxis], [0])[0]
+
+    tiff = to_tiff(encode_cloud_bands(bands))
+    data, t_decode = time_call(decode_tiff, tiff, decode_cloud_bands, repeat=repeat)
+    coverage = get_cloud_coverage(data[np.newaxis], [0])[0]
+
+    return [{'data': 'clouds', 'encoding': 'FLOAT32', 'bytes': len(float_tiff), 'decode_s': t_float,
+             'status_equal': True, 'mismatch': 0.0},
+            {'data': 'clouds', 'encoding': 'UINT16', 'bytes': len(tiff), 'decode_s': t_decode,
+             'status_equal': np.array_equal(data[..., -1], bands[..., -1]),
+             'mismatch': abs(coverage - float_coverage)}]
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES
+
+    print(f"{'size':>6} {'data':>7} {'encoding':>8} {'MB':>8} {'decode':>8} {'equal':>6} {'mismatch':>9}")
+    for size in sizes:
+        for result in bench_ndwi_transfer(size) + bench_cloud_transfer(size):
+            print(f"{size:>6} {result['data']:>7} {result['encoding']:>8} {result['bytes']/2**20:>8.2f} "
+                  f"{result['decode_s']:>7.3f}s {str(result['status_equal']):>6} {result['mismatch']:>9.2e}")
@@ -0,0 +1,46 @@
+""" Compares connected-component water extent with the reference GeoDataFrame implementation.
+
+Usage: python bench_water_extent.py [size ...]
+"""
+
+import sys
+import time
+
+from synthetic import get_synthetic_dam, get_synthetic_water_mask
+
+from geom_utils import get_water_extent, get_water_extent_geopandas
+
+SIZES = [1000, 2000, 3000, 4000, 5000]
+
+def time_call(func, *args, repeat=3, **kwargs):
+    """
+    Returns the result and the best wall time out of `repeat` calls.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+def bench_water_extent(size, repeat=3):
+    dam_poly, dam_bbox = get_synthetic_dam(size)
+    water_mask = get_synthetic_water_mask(dam_poly, dam_bbox, size)
+
+    reference, t_reference = time_call(get_water_extent_geopandas, water_mask, dam_poly, dam_bbox, simplify=False,
+                                       repeat=repeat)
+    extent, t_extent = time_call(get_water_extent, water_mask, dam_poly, dam_bbox, simplify=False, repeat=repeat)
+
+    return {'size': size,
+            'reference_s': t_reference,
+            'components_s': t_extent,
+            'speedup': t_reference/t_extent,
+            'area_diff': reference.symmetric_difference(extent).area/max(reference.area, 1e-12)}
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES
+    print(f"{'size':>6} {'reference':>10} {'components':>11} {'speedup':>8} {'area diff':>10}")
+    for size in sizes:
+        result = bench_water_extent(size)
+        print(f"{result['size']:>6} {result['reference_s']:>9.3f}s {result['components_s']:>10.3f}s "
+              f"{result['speedup']:>7.1f}x {result['area_diff']:>10.2e}")
@@ -0,0 +1,69 @@
+""" Regression check and benchmark of the water mask thresholding against the reference implementation.
+
+Usage: python bench_water_mask.py [size ...]
+"""
+
+import sys
+
+import numpy as np
+
+from synthetic import get_synthetic_dam, get_synthetic_ndwi
+from bench_water_extent import time_call
+
+from s2_water_extraction import get_water_mask_from_S2, get_water_mask_from_S2_reference
+
+SIZES = [500, 1000, 2000, 4000]
+
+def get_scenes(size):
+    """
+    Returns synthetic NDWI scenes covering all water detection statuses.
+    """
+    dam_poly, dam_bbox = get_synthetic_dam(size)
+    ndwi = get_synthetic_ndwi(dam_poly, dam_bbox, size)
+    rng = np.random.RandomState(size)
+    height, width = ndwi.shape
+
+    # dry land next to wet land with negative NDWI and a small pond, the Otsu threshold of edges separates the two
+    # kinds of land, so most pixels above it are not water and the threshold falls back to 0.0 (status 3)
+    shore = np.where(np.arange(width) < width//2, -0.8, -0.2).astype(np.float32)[np.newaxis].repeat(height, axis=0)
+    shore += rng.normal(0, 0.02, ndwi.shape).astype(np.float32)
+    shore[height//2 - height//20:height//2 + height//20, 3*width//4 - width//20:3*width//4 + width//20] = 0.4
+
+    return {'lake': ndwi,
+            'noisy lake': np.clip(ndwi + rng.normal(0, 0.3, ndwi.shape).astype(np.float32), -1, 1),
+            'dry': np.full(ndwi.shape, -0.3, dtype=np.float32) + rng.normal(0, 0.05, ndwi.shape).astype(np.float32),
+            'flooded': np.abs(ndwi),
+            'constant': np.full(ndwi.shape, 0.2, dtype=np.float32),
+            'two values': np.where(ndwi > 0, 0.5, -0.5).astype(np.float32),
+            'wet shore': shore}
+
+def check_water_mask(ndwi):
+    """
+    Returns True if status and mask are equal to the reference implementation.
+    """
+    status, mask = get_water_mask_from_S2(ndwi)
+    reference_status, reference_mask = get_water_mask_from_S2_reference(ndwi)
+    return status == reference_status and np.array_equal(mask, reference_mask), reference_status
+
+def bench_water_mask(size, repeat=3):
+    ndwi = get_scenes(size)['lake']
+    _, t_reference = time_call(get_water_mask_from_S2_reference, ndwi, repeat=repeat)
+    _, t_mask = time_call(get_water_mask_from_S2, ndwi, repeat=repeat)
+    return {'size': size, 'reference_s': t_reference, 'optimised_s': t_mask, 'speedup': t_reference/t_mask}
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES
+
+    failed = 0
+    for name, ndwi in get_scenes(min(sizes)).items():
+        equal, status = check_water_mask(ndwi)
+        failed += not equal
+        print(f"{name:>12}: status {status}, {'OK' if equal else 'DIFFERENT'}")
+
+    print(f"{'size':>6} {'reference':>10} {'optimised':>10} {'speedup':>8}")
+    for size in sizes:
+        result = bench_water_mask(size)
+        print(f"{result['size']:>6} {result['reference_s']:>9.3f}s {result['optimised_s']:>9.3f}s "
+              f"{result['speedup']:>7.1f}x")
+
+    sys.exit(1 if failed else 0)
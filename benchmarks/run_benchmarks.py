@@ -0,0 +1,130 @@
+""" Offline benchmark suite of the water extraction hot paths on synthetic data. Sentinel Hub requests are replaced
+by synthetic rasters, so no credentials or network access are needed.
+
+Usage: python run_benchmarks.py [--sizes 100 500 ...] [--repeat 3] [--output results.json] [--compare old.json]
+"""
+
+import sys
+import json
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+from contextlib import contextmanager
+
+import numpy as np
+
+from synthetic import get_synthetic_dam, get_synthetic_ndwi, get_synthetic_dem, get_synthetic_cloud_bands
+from bench_water_extent import time_call
+
+import s2_water_extraction
+from s2_water_extraction import get_water_mask_from_S2, extract_surface_water_area_per_frame
+from geom_utils import get_water_extent, get_budget_simplified_poly, get_wkt_size_estimate, apply_DEM_veto
+from definitions import WaterDetectionStatus
+
+# from a small pond to a reservoir at the 5000 x 5000 pixel limit
+SIZES = [100, 500, 1000, 2500, 5000]
+RESOLUTION = 10
+# relative and absolute slowdown reported as a regression by --compare
+REGRESSION_TOLERANCE = 1.2
+REGRESSION_MIN_SECONDS = 0.01
+
+@contextmanager
+def stubbed_requests(ndwi, cloud_bands, dem):
+    """
+    Replaces Sentinel Hub requests of `s2_water_extraction` by the given rasters.
+    """
+    def get_request_data(get_request, tile_cache=None, layer=None, evalscript=None, **kwargs):
+        if layer == 'DEM':
+            return dem[np.newaxis]
+        if evalscript is not None:
+            return cloud_bands[np.newaxis]
+        return np.stack([ndwi, np.ones_like(ndwi)], axis=-1)[np.newaxis]
+
+    original = s2_water_extraction.get_request_data
+    s2_water_extraction.get_request_data = get_request_data
+    try:
+        yield
+    finally:
+        s2_water_extraction.get_request_data = original
+
+def bench_size(size, repeat=3):
+    """
+    Times all benchmarks on a synthetic dam of size x size pixels. Returns a list of results.
+    """
+    dam_poly, dam_bbox = get_synthetic_dam(size)
+    ndwi = get_synthetic_ndwi(dam_poly, dam_bbox, size)
+    dem = get_synthetic_dem(dam_poly, dam_bbox, size)
+    cloud_bands = get_synthetic_cloud_bands(max(1, size//8), cloud_fraction=0.05)
+
+    (_, water_mask), t_mask = time_call(get_water_mask_from_S2, ndwi, repeat=repeat)
+    extent, t_extent = time_call(get_water_extent, water_mask, dam_poly, dam_bbox, simplify=False, repeat=repeat)
+    # with the budget used by get_water_extent
+    _, t_simplify = time_call(get_budget_simplified_poly, extent,
+                              max_bytes=min(100000, get_wkt_size_estimate(dam_poly)*100), repeat=repeat)
+    _, t_veto = time_call(apply_DEM_veto, dem, dam_poly, extent, dam_bbox, RESOLUTION, RESOLUTION, repeat=repeat)
+    with stubbed_requests(ndwi, cloud_bands, dem):
+        measurement, t_frame = time_call(extract_surface_water_area_per_frame, 1, dam_poly, dam_bbox,
+                                         datetime(2020, 1, 1), RESOLUTION, RESOLUTION, repeat=repeat)
+
+    if measurement.MEAS_STATUS != WaterDetectionStatus.MEASUREMENT_VALID.value:
+        raise RuntimeError(f'Frame benchmark of size {size} ended with status {measurement.MEAS_STATUS}')
+
+    timings = {'get_water_mask_from_S2': t_mask,
+               'get_water_extent': t_extent,
+               'get_budget_simplified_poly': t_simplify,
+               'apply_DEM_veto': t_veto,
+               'extract_surface_water_area_per_frame': t_frame}
+    return [{'benchmark': name, 'size': size, 'seconds': seconds} for name, seconds in timings.items()]
+
+def get_metadata(repeat):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'timestamp': datetime.utcnow().isoformat(),
+            'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'repeat': repeat}
+
+def compare(results, baseline):
+    """
+    Returns results slower than in the baseline by more than the tolerances, as (result, baseline seconds) pairs.
+    """
+    baseline_times = {(result['benchmark'], result['size']): result['seconds'] for result in baseline['results']}
+    regressions = []
+    for result in results:
+        old_seconds = baseline_times.get((result['benchmark'], result['size']))
+        if old_seconds is not None and result['seconds'] > REGRESSION_TOLERANCE*old_seconds and \
+                result['seconds'] - old_seconds > REGRESSION_MIN_SECONDS:
+            regressions.append((result, old_seconds))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmarks of water extraction.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='JSON file to save the results to')
+    parser.add_argument('--compare', help='JSON file with baseline results')
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'benchmark':>38} {'size':>6} {'time':>9}")
+    for size in args.sizes:
+        for result in bench_size(size, repeat=args.repeat):
+            print(f"{result['benchmark']:>38} {result['size']:>6} {result['seconds']:>8.3f}s")
+            results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'metadata': get_metadata(args.repeat), 'results': results}, output_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file))
+        for result, old_seconds in regressions:
+            print(f"REGRESSION {result['benchmark']} size {result['size']}: {old_seconds:.3f}s -> "
+                  f"{result['seconds']:.3f}s")
+        sys.exit(1 if regressions else 0)
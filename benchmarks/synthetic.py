@@ -0,0 +1,94 @@
+""" Synthetic rasters and dam polygons for offline benchmarks. """
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import numpy as np
+from shapely.geometry import Polygon
+from sentinelhub import BBox, CRS
+
+def get_synthetic_dam(size, seed=0, n_vertices=500, origin=(14.0, 46.0), pixel_size=0.0001):
+    """
+    Returns an irregular lake outline and its bbox. The lake covers roughly the central half of a size x size image.
+    """
+    rng = np.random.RandomState(seed)
+    extent = size*pixel_size
+    center_x, center_y = origin[0] + extent/2, origin[1] + extent/2
+
+    angles = np.linspace(0, 2*np.pi, n_vertices, endpoint=False)
+    radius = extent/4*(1 + 0.3*np.sin(5*angles + rng.uniform(0, 2*np.pi)) + 0.05*rng.uniform(-1, 1, n_vertices))
+    dam_poly = Polygon(zip(center_x + radius*np.cos(angles), center_y + radius*np.sin(angles)))
+
+    dam_bbox = BBox(bbox=[origin[0], origin[1], origin[0] + extent, origin[1] + extent], crs=CRS.WGS84)
+    return dam_poly, dam_bbox
+
+def get_pixel_grid(dam_bbox, size):
+    """
+    Returns the coordinates of pixel centers of a size x size image covering the bbox (first row is north).
+    """
+    min_x, min_y = dam_bbox.get_lower_left()
+    max_x, max_y = dam_bbox.get_upper_right()
+    xs = min_x + (np.arange(size) + 0.5)*(max_x - min_x)/size
+    ys = max_y - (np.arange(size) + 0.5)*(max_y - min_y)/size
+    return np.meshgrid(xs, ys)
+
+def get_synthetic_ndwi(dam_poly, dam_bbox, size, seed=0, shrink=0.8, noise=0.1, n_ponds=50):
+    """
+    Returns NDWI image with a lake (partially dried out nominal outline), small ponds and sensor noise.
+    """
+    from geom_utils import get_raster_mask
+
+    rng = np.random.RandomState(seed)
+    lake = get_raster_mask(dam_poly.buffer(-(1 - shrink)*np.sqrt(dam_poly.area)/4), dam_bbox, size, size)
+
+    ndwi = np.where(lake==1, 0.5, -0.3).astype(np.float32)
+
+    # small ponds and wet patches outside the lake
+    for _ in range(n_ponds):
+        cx, cy = rng.randint(0, size, 2)
+        radius = rng.randint(2, max(3, size//100))
+        y0, y1, x0, x1 = max(0, cy - radius), min(size, cy + radius), max(0, cx - radius), min(size, cx + radius)
+        yy, xx = np.ogrid[y0:y1, x0:x1]
+        ndwi[y0:y1, x0:x1][(xx - cx)**2 + (yy - cy)**2 < radius**2] = 0.4
+
+    ndwi += rng.normal(0, noise, ndwi.shape).astype(np.float32)
+    return np.clip(ndwi, -1, 1)
+
+def get_synthetic_water_mask(dam_poly, dam_bbox, size, seed=0):
+    """
+    Returns a binary water mask consistent with `get_synthetic_ndwi`.
+    """
+    return (get_synthetic_ndwi(dam_poly, dam_bbox, size, seed=seed) > 0).astype(np.uint8)
+
+def get_synthetic_dem(dam_poly, dam_bbox, size, seed=0, lake_height=400.0, slope=200.0):
+    """
+    Returns DEM with a flat lake bed and terrain rising away from the lake center.
+    """
+    rng = np.random.RandomState(seed)
+    xx, yy = get_pixel_grid(dam_bbox, size)
+    center = dam_poly.centroid
+    dist = np.hypot(xx - center.x, yy - center.y)/np.sqrt(dam_poly.area)
+    dem = lake_height + slope*dist**2 + rng.normal(0, 2, dist.shape)
+    return dem.astype(np.float32)
+
+# typical top of atmosphere reflectances of B01, B02, B04, B05, B08, B8A, B09, B10, B11, B12
+CLEAR_REFLECTANCES = [0.12, 0.09, 0.07, 0.11, 0.25, 0.27, 0.08, 0.003, 0.18, 0.10]
+CLOUD_REFLECTANCES = [0.55, 0.55, 0.55, 0.56, 0.60, 0.60, 0.30, 0.05, 0.40, 0.30]
+
+def get_synthetic_cloud_bands(size, seed=0, cloud_fraction=0.1):
+    """
+    Returns 10 cloud detector bands and data mask at cloud resolution, with a cloudy blob covering roughly the
+    given fraction of the image.
+    """
+    rng = np.random.RandomState(seed)
+    bands = np.ones((size, size, 11), dtype=np.float32)
+    bands[..., :-1] = CLEAR_REFLECTANCES
+    bands[..., :-1] *= rng.uniform(0.9, 1.1, (size, size, 10))
+
+    if cloud_fraction > 0:
+        yy, xx = np.ogrid[0:size, 0:size]
+        radius = size*np.sqrt(cloud_fraction/np.pi)
+        cloudy = (xx - size/4)**2 + (yy - size/4)**2 < radius**2
+        bands[cloudy, :-1] = CLOUD_REFLECTANCES*rng.uniform(0.9, 1.1, (np.count_nonzero(cloudy), 10))
+    return bands
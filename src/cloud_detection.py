@@ -0,0 +1,208 @@
+""" Module for batched cloud detection with a single s2cloudless classifier per process. """
+
+import os
+import threading
+from functools import lru_cache
+
+import numpy as np
+
+from profiling import stage
+
+CLOUD_THRESHOLD = 0.4
+# s2cloudless bands B01, B02, B04, B05, B08, B8A, B09, B10, B11, B12
+N_CLOUD_BANDS = 10
+# approximate bytes per classified pixel: contiguous float32 bands, float64 probabilities of both classes
+BYTES_PER_PIXEL = N_CLOUD_BANDS*4 + 3*8
+DEFAULT_MAX_BATCH_BYTES = 512*2**20
+
+def get_available_memory():
+    """
+    Returns available physical memory in bytes, or None if it can't be determined on this platform.
+    """
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+class _CloudRequest:
+    """
+    Frames of one `get_cloud_probabilities` call, waiting to be classified with frames of other threads.
+    """
+    __slots__ = ('frames', 'probabilities', 'error', 'done')
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.probabilities = None
+        self.error = None
+        self.done = False
+
+class CloudDetectionService:
+    """
+    Cloud detection of many frames with one s2cloudless classifier, loaded on first use (or by `preload`).
+
+    Frames may have different shapes, e.g. dates of different dams. Pixels of all frames are classified together in
+    batches of at most `max_batch_bytes` (by default a quarter of available memory, at most 512 MB), so a single
+    LightGBM prediction using `n_threads` cores (all by default) runs per batch instead of one per frame.
+    Probabilities are then averaged, thresholded and dilated per frame by `S2PixelCloudDetector.get_mask_from_prob`,
+    so masks are the same as from `S2PixelCloudDetector.get_cloud_masks`.
+
+    The service is shared by threads, e.g. download threads of `scheduler.CatalogueScheduler`, each with a frame
+    or a few. Frames submitted while a prediction runs wait for it and are then classified together by the first
+    of their threads, so concurrent frames make one prediction instead of one each. Numbers of predictions and
+    classified frames are in `stats`.
+    """
+    def __init__(self, threshold=CLOUD_THRESHOLD, average_over=4, dilation_size=2, max_batch_bytes=None,
+                 n_threads=None):
+        self.threshold = threshold
+        self.average_over = average_over
+        self.dilation_size = dilation_size
+        self.n_threads = n_threads
+
+        if max_batch_bytes is None:
+            available = get_available_memory()
+            max_batch_bytes = DEFAULT_MAX_BATCH_BYTES if available is None else \
+                min(DEFAULT_MAX_BATCH_BYTES, available//4)
+        self.max_batch_pixels = max(1, max_batch_bytes//BYTES_PER_PIXEL)
+
+        self.stats = {'predictions': 0, 'frames': 0}
+
+        self._detector = None
+        self._lock = threading.Lock()
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._predict_lock = threading.Lock()
+
+    @property
+    def detector(self):
+        with self._lock:
+            if self._detector is None:
+                from s2cloudless import S2PixelCloudDetector
+                detector = S2PixelCloudDetector(threshold=self.threshold, average_over=self.average_over,
+                                                dilation_size=self.dilation_size)
+                # loads the classifier
+                detector.classifier
+                self._detector = detector
+            return self._detector
+
+    def preload(self):
+        """
+        Imports s2cloudless and loads the classifier, e.g. when a worker process starts, so that the first frame
+        doesn't pay for it.
+        """
+        return self.detector
+
+    def _get_batches(self, pixels):
+        """
+        Splits pixels of all frames into batches of at most `max_batch_pixels`. Yields lists of
+        (frame index, start, stop) segments.
+        """
+        batch, batch_size = [], 0
+        for idx, frame_pixels in enumerate(pixels):
+            start = 0
+            while start < len(frame_pixels):
+                stop = min(len(frame_pixels), start + self.max_batch_pixels - batch_size)
+                batch.append((idx, start, stop))
+                batch_size += stop - start
+                start = stop
+                if batch_size == self.max_batch_pixels:
+                    yield batch
+                    batch, batch_size = [], 0
+        if batch:
+            yield batch
+
+    def get_cloud_probabilities(self, frames):
+        """
+        Returns cloud probability maps of frames. Each frame is an array of shape (height, width, bands), its first
+        10 bands are the bands of s2cloudless (further bands, e.g. data mask, are ignored).
+        """
+        request = _CloudRequest(frames)
+        with self._pending_lock:
+            self._pending.append(request)
+
+        with self._predict_lock:
+            # the request was either classified by the previous prediction or it is still pending
+            if not request.done:
+                with self._pending_lock:
+                    requests, self._pending = self._pending, []
+                self._predict(requests)
+
+        if request.error is not None:
+            raise request.error
+        return request.probabilities
+
+    def _predict(self, requests):
+        """
+        Classifies frames of all requests together and sets their probabilities, or the error of the prediction.
+        """
+        frames = [frame for request in requests for frame in request.frames]
+        try:
+            probabilities = self._get_probabilities(frames)
+        except Exception as exception:
+            for request in requests:
+                request.error, request.done = exception, True
+            return
+
+        self.stats['predictions'] += 1
+        self.stats['frames'] += len(frames)
+        offset = 0
+        for request in requests:
+            request.probabilities = probabilities[offset:offset + len(request.frames)]
+            request.done = True
+            offset += len(request.frames)
+
+    def _get_probabilities(self, frames):
+        detector = self.detector
+        pixels = [frame.reshape(-1, frame.shape[-1])[:, :N_CLOUD_BANDS] for frame in frames]
+        probabilities = [np.empty(len(frame_pixels), dtype=np.float64) for frame_pixels in pixels]
+        kwargs = {} if self.n_threads is None else {'num_threads': self.n_threads}
+
+        for batch in self._get_batches(pixels):
+            features = np.concatenate([pixels[idx][start:stop] for idx, start, stop in batch]).astype(np.float32)
+            batch_probabilities = detector.classifier.image_predict_proba(features[np.newaxis, np.newaxis],
+                                                                          **kwargs)[0, 0, :, 1]
+
+            offset = 0
+            for idx, start, stop in batch:
+                probabilities[idx][start:stop] = batch_probabilities[offset:offset + stop - start]
+                offset += stop - start
+
+        return [frame_probabilities.reshape(frame.shape[:2])
+                for frame, frame_probabilities in zip(frames, probabilities)]
+
+    def get_cloud_masks(self, frames, valid_masks=None):
+        """
+        Returns boolean cloud masks of frames (see `get_cloud_probabilities`). Pixels outside of valid masks are not
+        cloudy and, as in `s2cloudless.CloudMaskRequest`, their probabilities are set to 0 before averaging and
+        dilation.
+        """
+        with stage('cloud_inference'):
+            probabilities = self.get_cloud_probabilities(frames)
+
+        detector = self.detector
+        cloud_masks = []
+        for idx, frame_probabilities in enumerate(probabilities):
+            if valid_masks is not None:
+                frame_probabilities = frame_probabilities*valid_masks[idx]
+            cloud_mask = detector.get_mask_from_prob(frame_probabilities[np.newaxis])[0].astype(bool)
+            if valid_masks is not None:
+                cloud_mask &= valid_masks[idx]
+            cloud_masks.append(cloud_mask)
+        return cloud_masks
+
+    def get_cloud_coverage(self, frames):
+        """
+        Returns cloud coverage of each frame, given with stacked cloud bands and data mask as the last band (e.g.
+        from `get_cloud_bands_request`). Invalid pixels are not considered cloudy.
+        """
+        if len(frames) == 0:
+            return np.zeros(0, dtype=np.float32)
+
+        cloud_masks = self.get_cloud_masks(frames, valid_masks=[frame[..., -1] == 1.0 for frame in frames])
+        return np.array([np.count_nonzero(cloud_mask)/cloud_mask.size for cloud_mask in cloud_masks])
+
+@lru_cache(maxsize=4)
+def get_cloud_detection_service(threshold=CLOUD_THRESHOLD):
+    """
+    Returns the cloud detection service of this process for the threshold, shared by all frames and threads.
+    """
+    return CloudDetectionService(threshold=threshold)
@@ -0,0 +1,61 @@
+""" Module with per-waterbody static data reused across all measurement dates. """
+
+from shapely.prepared import prep
+
+from geom_utils import get_bbox, get_optimal_resolution, get_optimal_cloud_resolution, get_raster_mask
+
+class DamContext:
+    """
+    Static data of a waterbody which does not change between dates: inflated bbox, optimal resolutions, affine
+    transforms and rasterized nominal outlines per raster shape, and a prepared nominal polygon for fast intersects.
+    Transforms and masks are computed on first use for each bbox and raster shape and cached, the bbox is the dam's
+    unless a window (e.g. of a group of dams) is given.
+    """
+    def __init__(self, dam_id, dam_poly, inflate_bbox=0.1):
+        self.dam_id = dam_id
+        self.dam_poly = dam_poly
+        self.dam_bbox = get_bbox(dam_poly, inflate_bbox=inflate_bbox)
+        self.resx, self.resy = get_optimal_resolution(self.dam_bbox)
+        self.cloud_resx, self.cloud_resy = get_optimal_cloud_resolution(self.resx, self.resy)
+
+        self._prepared_poly = None
+        self._transforms = {}
+        self._nominal_masks = {}
+
+    def __getstate__(self):
+        # prepared geometries can't be pickled, they are recreated on first use
+        state = self.__dict__.copy()
+        state['_prepared_poly'] = None
+        return state
+
+    @property
+    def prepared_poly(self):
+        if self._prepared_poly is None:
+            self._prepared_poly = prep(self.dam_poly)
+        return self._prepared_poly
+
+    def _get_bbox_key(self, bbox):
+        bbox = self.dam_bbox if bbox is None else bbox
+        return bbox, tuple(bbox) + (str(bbox.crs),)
+
+    def get_transform(self, width, height, bbox=None):
+        """
+        Returns the affine transform of a width x height raster covering the bbox, the dam's bbox by default.
+        """
+        bbox, bbox_key = self._get_bbox_key(bbox)
+        key = (bbox_key, width, height)
+        if key not in self._transforms:
+            import rasterio.transform
+            self._transforms[key] = rasterio.transform.from_bounds(*bbox, width=width, height=height)
+        return self._transforms[key]
+
+    def get_nominal_mask(self, width, height, all_touched=False, bbox=None):
+        """
+        Returns the dam's nominal water extent burned to a width x height raster covering the bbox, the dam's bbox
+        by default. The returned array is shared and should not be modified.
+        """
+        bbox, bbox_key = self._get_bbox_key(bbox)
+        key = (bbox_key, width, height, all_touched)
+        if key not in self._nominal_masks:
+            self._nominal_masks[key] = get_raster_mask(self.dam_poly, bbox, width, height, all_touched=all_touched)
+        return self._nominal_masks[key]
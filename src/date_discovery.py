@@ -0,0 +1,300 @@
+""" Module for discovery of Sentinel-2 acquisition dates of many waterbodies from a cached catalogue of tiles.
+
+`get_S2_dates` queries the catalogue (WFS) with the bbox of each dam, although neighbouring dams are covered by the
+same Sentinel-2 tiles. Here tiles are queried once per cell of a regular grid, stored locally and refreshed only
+for the time not yet covered. Dates of a dam are the dates of tiles intersecting its bbox, filtered as by
+`WcsRequest.get_dates`.
+"""
+
+import os
+import json
+import math
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+import shapely.wkb
+from shapely.geometry import box, shape
+from shapely.ops import transform
+from shapely.strtree import STRtree
+
+from sentinelhub import BBox, CRS, DataSource
+from sentinelhub.time_utils import parse_time_interval
+
+from profiling import stage
+from sh_client import WebFeatureService
+from sh_requests import filter_dates, S2_TIME_DIFFERENCE
+from s2_water_extraction import S2_MAX_CC
+
+DEFAULT_CELL_SIZE = 1.0
+# tiles are ingested with a delay, so the last days of the cached time range are queried again on refresh
+DEFAULT_REFRESH_DAYS = 3
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+def _to_datetime(time):
+    return datetime.strptime(time[:19], TIME_FORMAT) if 'T' in time else datetime.strptime(time[:10], '%Y-%m-%d')
+
+def _to_string(time):
+    return time.strftime(TIME_FORMAT)
+
+def get_cells(bbox, cell_size=DEFAULT_CELL_SIZE):
+    """
+    Returns (column, row) indices of grid cells of `cell_size` degrees intersecting the WGS84 bbox.
+    """
+    min_col, max_col = math.floor(bbox.min_x/cell_size), math.floor(bbox.max_x/cell_size)
+    min_row, max_row = math.floor(bbox.min_y/cell_size), math.floor(bbox.max_y/cell_size)
+    return [(col, row) for col in range(min_col, max_col + 1) for row in range(min_row, max_row + 1)]
+
+def get_cell_bbox(cell, cell_size=DEFAULT_CELL_SIZE):
+    col, row = cell
+    return BBox(bbox=[col*cell_size, row*cell_size, (col + 1)*cell_size, (row + 1)*cell_size], crs=CRS.WGS84)
+
+def _get_tile_geometry(tile_info, query_polygon):
+    """
+    Returns the tile geometry of a WFS feature. WGS84 geometries may be returned in (lat, lon) axis order, the order
+    which intersects the queried cell is used.
+    """
+    geometry = shape(tile_info['geometry'])
+    if geometry.intersects(query_polygon):
+        return geometry
+    swapped = transform(lambda x, y: (y, x), geometry)
+    return swapped if swapped.intersects(query_polygon) else geometry
+
+class _CellTiles:
+    """
+    Tiles of a grid cell: acquisition times, cloud coverage and footprints, with footprints shared by acquisitions
+    of the same tile indexed in an STRtree.
+    """
+    def __init__(self, covered=None, records=None, geometries=None):
+        # covered time range (start, end) as strings, None if the cell was never queried
+        self.covered = covered
+        # True once the cell was queried by this catalogue, so the end of the covered range is up to date
+        self.fresh = False
+        self.records = records or {}
+        self.geometries = geometries or []
+        self._geometry_ids = {geometry.wkb: idx for idx, geometry in enumerate(self.geometries)}
+        self._build_index()
+
+    def add(self, tile_id, time, cloud_cover, geometry):
+        wkb = geometry.wkb
+        if wkb not in self._geometry_ids:
+            self._geometry_ids[wkb] = len(self.geometries)
+            self.geometries.append(geometry)
+        self.records[(tile_id, time)] = (cloud_cover, self._geometry_ids[wkb])
+
+    def _build_index(self):
+        """
+        Builds arrays of times, cloud coverage and geometry indices of records and a tree of geometries, replaced as
+        one tuple, so `get_times` running concurrently with `update` reads either the old or the new index.
+        """
+        records = list(self.records.items())
+        times = np.array([time for (_, time), _ in records], dtype='datetime64[s]')
+        cloud_cover = np.array([cloud_cover for _, (cloud_cover, _) in records], dtype=np.float32)
+        geometry_idx = np.array([geometry_idx for _, (_, geometry_idx) in records], dtype=np.int32)
+        geometries = list(self.geometries)
+        tree = STRtree(geometries) if geometries else None
+        self.index = (times, cloud_cover, geometry_idx, geometries, tree)
+
+    def update(self, tiles, covered, fresh):
+        for tile_id, time, cloud_cover, geometry in tiles:
+            self.add(tile_id, time, cloud_cover, geometry)
+        self.covered = covered
+        self.fresh = fresh
+        self._build_index()
+
+    def get_times(self, polygon, start, end, maxcc):
+        """
+        Returns acquisition times (numpy datetime64) of tiles intersecting the polygon within the time range.
+        """
+        times, cloud_cover, geometry_idx, geometries, tree = self.index
+        if tree is None:
+            return times[:0]
+        geometry_ids = [idx for idx in _query(tree, polygon, geometries) if geometries[idx].intersects(polygon)]
+        mask = np.isin(geometry_idx, geometry_ids)
+        mask &= (times >= np.datetime64(start)) & (times <= np.datetime64(end))
+        mask &= cloud_cover <= 100*maxcc
+        return times[mask]
+
+    def to_json(self):
+        return {'covered': self.covered,
+                'geometries': [geometry.wkb_hex for geometry in self.geometries],
+                'records': [[tile_id, time, cloud_cover, geometry_idx]
+                            for (tile_id, time), (cloud_cover, geometry_idx) in self.records.items()]}
+
+    @classmethod
+    def from_json(cls, content):
+        geometries = [shapely.wkb.loads(geometry, hex=True) for geometry in content['geometries']]
+        records = {(tile_id, time): (cloud_cover, geometry_idx)
+                   for tile_id, time, cloud_cover, geometry_idx in content['records']}
+        return cls(covered=tuple(content['covered']) if content['covered'] else None, records=records,
+                   geometries=geometries)
+
+def _query(tree, geometry, geometries):
+    """
+    Returns indices of tree geometries intersecting the geometry's extent. Shapely 2 returns indices, earlier
+    versions the geometries themselves.
+    """
+    result = tree.query(geometry)
+    if len(result) and not isinstance(result[0], (int, np.integer)):
+        ids = {id(tree_geometry): idx for idx, tree_geometry in enumerate(geometries)}
+        return [ids[id(tree_geometry)] for tree_geometry in result]
+    return list(result)
+
+class DateCatalogue:
+    """
+    Available acquisition dates of Sentinel-2 tiles, queried once per grid cell of `cell_size` degrees and kept in
+    memory. If `cache_folder` is given, tiles of each cell are stored there and a later run only queries the time
+    not yet covered by the cache (and the last `refresh_days` of it, since tiles are ingested with a delay).
+
+    Tiles are cached regardless of their cloud coverage, so the same cache serves any `maxcc`. Cells are queried by
+    the first thread which needs them, other threads wait for the result. Queries are counted in `stats`.
+
+    Tiles can't be acquired in the future, so queried ranges end at the current UTC time given by `clock`, read on
+    each query so that a long-lived catalogue keeps picking up new acquisitions.
+    """
+    def __init__(self, cache_folder=None, cell_size=DEFAULT_CELL_SIZE, data_source=DataSource.SENTINEL2_L1C,
+                 refresh_days=DEFAULT_REFRESH_DAYS, time_difference=S2_TIME_DIFFERENCE, clock=datetime.utcnow):
+        self.cache_folder = cache_folder
+        self.cell_size = cell_size
+        self.data_source = data_source
+        self.refresh = timedelta(days=refresh_days)
+        self.time_difference = time_difference
+        self.stats = {'cells_queried': 0, 'cells_cached': 0, 'tiles_queried': 0, 'dams': 0}
+        self.clock = clock
+
+        self._cells = {}
+        self._cell_locks = {}
+        self._lock = threading.Lock()
+
+    def _now(self):
+        return _to_string(self.clock())
+
+    def _get_cache_path(self, cell):
+        return os.path.join(self.cache_folder, self.data_source.name, f'{self.cell_size:g}',
+                            f'{cell[0]}_{cell[1]}.json')
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                self.stats[name] += count
+
+    def _load_cell(self, cell):
+        if self.cache_folder is None:
+            return _CellTiles()
+        path = self._get_cache_path(cell)
+        if not os.path.exists(path):
+            return _CellTiles()
+        with open(path) as cache_file:
+            return _CellTiles.from_json(json.load(cache_file))
+
+    def _save_cell(self, cell, cell_tiles):
+        if self.cache_folder is None:
+            return
+        path = self._get_cache_path(cell)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as tmp_file:
+            json.dump(cell_tiles.to_json(), tmp_file)
+        os.replace(tmp_path, path)
+
+    def query_tiles(self, bbox, start, end):
+        """
+        Queries the catalogue for all tiles intersecting the bbox within the time range. Returns a list of
+        (tile id, time string, cloud coverage in percent, geometry).
+        """
+        query_polygon = box(*bbox)
+        tiles = []
+        for tile_info in WebFeatureService(bbox, (start, end), data_source=self.data_source, maxcc=1.0):
+            properties = tile_info['properties']
+            if not properties.get('date'):
+                continue
+            time = f"{properties['date']}T{properties['time'].split('.')[0]}"
+            tiles.append((properties.get('id') or properties.get('path'), time,
+                          properties.get('cloudCoverPercentage', 0.0), _get_tile_geometry(tile_info, query_polygon)))
+        return tiles
+
+    def _get_missing_ranges(self, cell_tiles, start, end):
+        """
+        Returns time ranges of [start, end] which have to be queried, given the time range covered by the cell.
+        Ranges are extended so that the covered range stays contiguous. The last `refresh_days` of a range loaded
+        from the cache are queried again.
+        """
+        if cell_tiles.covered is None:
+            return [(start, end)]
+        covered_start, covered_end = cell_tiles.covered
+        ranges = []
+        if start < covered_start:
+            ranges.append((start, covered_start))
+        refresh_start = covered_end if cell_tiles.fresh else \
+            max(covered_start, _to_string(_to_datetime(covered_end) - self.refresh))
+        if end > covered_end or (end > refresh_start and not cell_tiles.fresh):
+            ranges.append((refresh_start, max(end, covered_end)))
+        return ranges
+
+    def _get_cell(self, cell, start, end):
+        """
+        Returns tiles of the cell, querying the catalogue for the part of the time range not covered yet.
+        """
+        with self._lock:
+            cell_lock = self._cell_locks.setdefault(cell, threading.Lock())
+
+        with cell_lock:
+            cell_tiles = self._cells.get(cell)
+            if cell_tiles is None:
+                cell_tiles = self._load_cell(cell)
+                if cell_tiles.covered is not None:
+                    self._count(cells_cached=1)
+
+            self._cells[cell] = cell_tiles
+            end = min(end, self._now())
+            ranges = self._get_missing_ranges(cell_tiles, start, end)
+            if len(ranges) == 0:
+                return cell_tiles
+
+            tiles = []
+            with stage('date_discovery'):
+                for range_start, range_end in ranges:
+                    tiles.extend(self.query_tiles(get_cell_bbox(cell, self.cell_size), range_start, range_end))
+            self._count(cells_queried=1, tiles_queried=len(tiles))
+
+            covered_start, covered_end = cell_tiles.covered or (start, end)
+            fresh = cell_tiles.fresh or any(range_end >= covered_end for _, range_end in ranges)
+            cell_tiles.update(tiles, (min(start, covered_start), max(end, covered_end)), fresh)
+            self._save_cell(cell, cell_tiles)
+            return cell_tiles
+
+    def prefetch(self, bboxes, time_interval):
+        """
+        Queries all cells covering the bboxes, e.g. before processing dams concurrently.
+        """
+        start, end = parse_time_interval(time_interval)
+        if start > self._now():
+            return
+        cells = sorted(set(cell for bbox in bboxes for cell in get_cells(bbox, self.cell_size)))
+        for cell in cells:
+            self._get_cell(cell, start, end)
+
+    def get_dates(self, bbox, time_interval, maxcc=1.0):
+        """
+        Returns sorted acquisition dates (datetimes) of tiles intersecting the WGS84 bbox with cloud coverage at most
+        `maxcc`, dates within `time_difference` reduced to the first one, as by `get_S2_dates`.
+        """
+        if bbox.crs is not CRS.WGS84:
+            raise ValueError(f'Date catalogue is indexed in WGS84, got a bbox in {bbox.crs}')
+
+        start, end = parse_time_interval(time_interval)
+        if start > self._now():
+            return []
+        polygon = box(*bbox)
+        times = [self._get_cell(cell, start, end).get_times(polygon, start, end, maxcc)
+                 for cell in get_cells(bbox, self.cell_size)]
+        times = np.unique(np.concatenate(times)) if times else []
+        self._count(dams=1)
+        return filter_dates([time.astype(datetime) for time in times], self.time_difference)
+
+    def fetch_dates(self, time_interval, dam_bbox, resx, resy, maxcc=None):
+        """
+        Date discovery with the signature of `scheduler.fetch_S2_dates`, e.g.
+        `CatalogueScheduler(..., fetch_dates=catalogue.fetch_dates)`.
+        """
+        return self.get_dates(dam_bbox, time_interval, maxcc=S2_MAX_CC if maxcc is None else maxcc)
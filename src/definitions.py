@@ -1,6 +1,9 @@
 from enum import Enum
 from recordclass import recordclass
 from datetime import datetime
+import threading
+
+import numpy as np
 
 class WaterDetectionSensor(Enum):
     S2_NDWI = 'S2_NDWI'
@@ -23,35 +26,393 @@ Measurement = recordclass('SurfaceWaterLevelMeasurement',
                           'MEAS_STATUS', 'MEAS_ALG_VER',
                           'CLOUD_COVERAGE', 'SURF_WATER_LEVEL', 'CC_ORIG', 'CC_CLEAN', 'ALG_STATUS', 'GEOMETRY', 'S3_IMAGE_URL'])
 
-def get_new_measurement_entry(dam_id, date, sensor, version):
-    return Measurement(BLUEDOT_WB_ID = dam_id, 
-                       BLUEDOT_MEAS_DATE = datetime.today().strftime('%Y-%m-%d'),
-                       SAT_IMAGE_DATE = date.strftime('%Y-%m-%d'),
-                       SENSOR_TYPE = sensor.value,
-                       MEAS_STATUS = WaterDetectionStatus.UNKNOWN_ERROR.value,
-                       MEAS_ALG_VER = version,
-                       CLOUD_COVERAGE = 1.0,
-                       SURF_WATER_LEVEL = 0.0,
-                       CC_ORIG = 0,
-                       CC_CLEAN = 0,
-                       ALG_STATUS = -1,
-                       GEOMETRY = 'POINT (0 0)',
-                       S3_IMAGE_URL = 'none')
-
-def copy_measurement(measurement):
-    return Measurement(BLUEDOT_WB_ID = measurement.BLUEDOT_WB_ID, 
-                       BLUEDOT_MEAS_DATE = measurement.BLUEDOT_MEAS_DATE, 
-                       SAT_IMAGE_DATE = measurement.SAT_IMAGE_DATE, 
-                       SENSOR_TYPE = measurement.SENSOR_TYPE,
-                       MEAS_STATUS = measurement.MEAS_STATUS, 
-                       MEAS_ALG_VER = measurement.MEAS_ALG_VER,
-                       CLOUD_COVERAGE = measurement.CLOUD_COVERAGE, 
-                       SURF_WATER_LEVEL = measurement.SURF_WATER_LEVEL, 
-                       CC_ORIG = measurement.CC_ORIG,
-                       CC_CLEAN = measurement.CC_CLEAN,
-                       ALG_STATUS = measurement.ALG_STATUS, 
-                       GEOMETRY = measurement.GEOMETRY, 
-                       S3_IMAGE_URL = measurement.S3_IMAGE_URL)
+MEASUREMENT_FIELDS = ('BLUEDOT_WB_ID', 'BLUEDOT_MEAS_DATE', 'SAT_IMAGE_DATE', 'SENSOR_TYPE', 'MEAS_STATUS',
+                      'MEAS_ALG_VER', 'CLOUD_COVERAGE', 'SURF_WATER_LEVEL', 'CC_ORIG', 'CC_CLEAN', 'ALG_STATUS',
+                      'GEOMETRY', 'S3_IMAGE_URL')
+
+SENSORS = [sensor.value for sensor in WaterDetectionSensor]
+_SENSOR_CODES = {sensor: code for code, sensor in enumerate(SENSORS)}
+
+_EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+def _to_days(value):
+    """
+    Converts a date, datetime or 'YYYY-MM-DD' string to days since epoch, i.e. the integer value of datetime64[D].
+    """
+    if isinstance(value, str):
+        return int(np.datetime64(value[:10], 'D').astype(np.int64))
+    return value.toordinal() - _EPOCH_ORDINAL
+
+class _StringColumn:
+    """
+    Variable length strings stored in a single byte buffer with offsets and lengths per row. Replaced strings are
+    left in the buffer until `compact` is called.
+    """
+    def __init__(self, capacity):
+        self.buffer = bytearray()
+        self.offsets = np.zeros(capacity, dtype=np.int64)
+        self.lengths = np.zeros(capacity, dtype=np.int32)
+
+    def resize(self, capacity):
+        self.offsets = np.resize(self.offsets, capacity)
+        self.lengths = np.resize(self.lengths, capacity)
+
+    def get(self, row):
+        offset = self.offsets[row]
+        return self.buffer[offset:offset + self.lengths[row]].decode()
+
+    def set(self, row, value):
+        encoded = value.encode()
+        self.offsets[row] = len(self.buffer)
+        self.lengths[row] = len(encoded)
+        self.buffer += encoded
+
+    def compact(self, size):
+        values = [bytes(self.buffer[offset:offset + length])
+                  for offset, length in zip(self.offsets[:size], self.lengths[:size])]
+        self.buffer = bytearray(b''.join(values))
+        self.offsets[:size] = np.concatenate([[0], np.cumsum(self.lengths[:size])[:-1]]) if size else []
+
+class MeasurementTable:
+    """
+    Columnar store of measurements backed by numpy arrays: fixed width IDs, datetime64 dates, small integer sensor,
+    status and version codes, float32 cloud coverage, float64 water level, and geometries and image URLs in byte buffers.
+    Rows are accessed through `MeasurementView` objects with the same attributes as `Measurement`.
+
+    IDs are stored as given (`id_dtype` object) or as fixed width ASCII strings (e.g. 'S16'), in which case longer
+    IDs raise a ValueError. Arrays grow by doubling, so appending is amortized O(1). Rows can be added and
+    modified by several threads, all access goes through the table lock.
+    """
+    def __init__(self, capacity=1024, id_dtype=object):
+        capacity = max(1, capacity)
+        self.lock = threading.RLock()
+        self.size = 0
+        self.versions = []
+        self._version_codes = {}
+        self.columns = {'BLUEDOT_WB_ID': np.zeros(capacity, dtype=id_dtype),
+                        'BLUEDOT_MEAS_DATE': np.zeros(capacity, dtype='datetime64[D]'),
+                        'SAT_IMAGE_DATE': np.zeros(capacity, dtype='datetime64[D]'),
+                        'SENSOR_TYPE': np.zeros(capacity, dtype=np.int8),
+                        'MEAS_STATUS': np.zeros(capacity, dtype=np.int8),
+                        'MEAS_ALG_VER': np.zeros(capacity, dtype=np.int16),
+                        'CLOUD_COVERAGE': np.zeros(capacity, dtype=np.float32),
+                        'SURF_WATER_LEVEL': np.zeros(capacity, dtype=np.float64),
+                        'CC_ORIG': np.zeros(capacity, dtype=np.int32),
+                        'CC_CLEAN': np.zeros(capacity, dtype=np.int32),
+                        'ALG_STATUS': np.zeros(capacity, dtype=np.int8)}
+        self.strings = {'GEOMETRY': _StringColumn(capacity), 'S3_IMAGE_URL': _StringColumn(capacity)}
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, row):
+        if not -self.size <= row < self.size:
+            raise IndexError(f'Row {row} out of range of table with {self.size} rows')
+        return MeasurementView(self, row % self.size)
+
+    def __iter__(self):
+        return (MeasurementView(self, row) for row in range(self.size))
+
+    @property
+    def capacity(self):
+        return len(self.columns['MEAS_STATUS'])
+
+    def _reserve(self, n_rows):
+        if self.size + n_rows <= self.capacity:
+            return
+        capacity = max(2*self.capacity, self.size + n_rows)
+        for name, column in self.columns.items():
+            self.columns[name] = np.resize(column, capacity)
+        for column in self.strings.values():
+            column.resize(capacity)
+
+    def get_version_code(self, version):
+        if version not in self._version_codes:
+            self._version_codes[version] = len(self.versions)
+            self.versions.append(version)
+        return self._version_codes[version]
+
+    def append(self, **values):
+        """
+        Appends a row with given field values and returns its view. Fields which are not given are left empty.
+        """
+        with self.lock:
+            self._reserve(1)
+            row = self.size
+            self.size += 1
+            for name, value in values.items():
+                _SETTERS[name](self, row, value)
+        return MeasurementView(self, row)
+
+    def copy_row(self, source):
+        """
+        Appends a copy of a row of this table and returns its view. Geometry and image URL bytes are shared.
+        """
+        with self.lock:
+            self._reserve(1)
+            row = self.size
+            self.size += 1
+            for column in self.columns.values():
+                column[row] = column[source]
+            for column in self.strings.values():
+                column.offsets[row] = column.offsets[source]
+                column.lengths[row] = column.lengths[source]
+        return MeasurementView(self, row)
+
+    def extend(self, measurements):
+        """
+        Appends copies of measurements (views or `Measurement` records) in bulk. Returns the range of new rows.
+        """
+        measurements = list(measurements)
+        return self.append_columns(**{name: [getattr(measurement, name) for measurement in measurements]
+                                      for name in MEASUREMENT_FIELDS})
+
+    def append_columns(self, **columns):
+        """
+        Appends rows given as columns of values, all fields have to be given. Returns the range of new rows.
+        """
+        with self.lock:
+            return self._append_columns(columns)
+
+    def _append_columns(self, columns):
+        n_rows = len(columns['BLUEDOT_WB_ID'])
+        self._reserve(n_rows)
+        rows = slice(self.size, self.size + n_rows)
+
+        self.columns['BLUEDOT_WB_ID'][rows] = [_encode_id(self, value) for value in columns['BLUEDOT_WB_ID']]
+        for name in ['BLUEDOT_MEAS_DATE', 'SAT_IMAGE_DATE']:
+            self.columns[name].view(np.int64)[rows] = [_to_days(value) for value in columns[name]]
+        self.columns['SENSOR_TYPE'][rows] = [_SENSOR_CODES[value] for value in columns['SENSOR_TYPE']]
+        self.columns['MEAS_ALG_VER'][rows] = [self.get_version_code(value) for value in columns['MEAS_ALG_VER']]
+        for name in ['MEAS_STATUS', 'CLOUD_COVERAGE', 'SURF_WATER_LEVEL', 'CC_ORIG', 'CC_CLEAN', 'ALG_STATUS']:
+            self.columns[name][rows] = columns[name]
+        for name, column in self.strings.items():
+            for row, value in zip(range(rows.start, rows.stop), columns[name]):
+                column.set(row, value)
+
+        self.size += n_rows
+        return range(rows.start, rows.stop)
+
+    def get_column(self, name):
+        """
+        Returns the array of a fixed width column, e.g. `MEAS_STATUS`. The array is a view and shouldn't be resized.
+        """
+        return self.columns[name][:self.size]
+
+    def get_status_mask(self, *statuses):
+        """
+        Returns boolean mask of rows with any of the given statuses (`WaterDetectionStatus`).
+        """
+        return np.isin(self.get_column('MEAS_STATUS'), [status.value for status in statuses])
+
+    def get_rows(self, rows):
+        """
+        Returns views of rows given by indices or a boolean mask.
+        """
+        rows = np.flatnonzero(rows) if np.asarray(rows).dtype == bool else rows
+        return [MeasurementView(self, int(row)) for row in rows]
+
+    def compact(self):
+        """
+        Releases space of replaced geometries and image URLs.
+        """
+        with self.lock:
+            for column in self.strings.values():
+                column.compact(self.size)
+
+    @property
+    def nbytes(self):
+        return sum(column[:self.size].nbytes for column in self.columns.values()) + \
+            sum(len(column.buffer) + column.offsets[:self.size].nbytes + column.lengths[:self.size].nbytes
+                for column in self.strings.values())
+
+class MeasurementView:
+    """
+    Row of a `MeasurementTable` with the attributes of `Measurement`. Dates are returned as 'YYYY-MM-DD' strings,
+    sensor type and algorithm version as strings, as in `Measurement`.
+    """
+    __slots__ = ('table', 'row')
+    _fields = MEASUREMENT_FIELDS
+
+    def __init__(self, table, row):
+        object.__setattr__(self, 'table', table)
+        object.__setattr__(self, 'row', row)
+
+    def __iter__(self):
+        return (getattr(self, name) for name in MEASUREMENT_FIELDS)
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other)
+
+    def __repr__(self):
+        values = ', '.join(f'{name}={getattr(self, name)!r}' for name in MEASUREMENT_FIELDS)
+        return f'MeasurementView({values})'
+
+    def __reduce__(self):
+        # views are pickled by value and unpickled into a standalone `Measurement` record
+        return _measurement_from_values, (tuple(self),)
+
+    def _asdict(self):
+        return {name: getattr(self, name) for name in MEASUREMENT_FIELDS}
+
+def _encode_id(table, value):
+    column = table.columns['BLUEDOT_WB_ID']
+    if column.dtype == object:
+        return value
+    encoded = str(value).encode()
+    if len(encoded) > column.dtype.itemsize:
+        raise ValueError(f'Waterbody ID {value!r} is longer than {column.dtype.itemsize} characters of the table')
+    return encoded
+
+def _get_id(table, row):
+    value = table.columns['BLUEDOT_WB_ID'][row]
+    return value.decode() if isinstance(value, bytes) else value
+
+def _set_id(table, row, value):
+    table.columns['BLUEDOT_WB_ID'][row] = _encode_id(table, value)
+
+def _get_date(name):
+    return lambda table, row: str(table.columns[name][row])
+
+def _set_date(name):
+    def setter(table, row, value):
+        table.columns[name].view(np.int64)[row] = _to_days(value)
+    return setter
+
+def _get_number(name, cast):
+    return lambda table, row: cast(table.columns[name][row])
+
+def _set_number(name):
+    def setter(table, row, value):
+        table.columns[name][row] = value
+    return setter
+
+def _get_string(name):
+    return lambda table, row: table.strings[name].get(row)
+
+def _set_string(name):
+    return lambda table, row, value: table.strings[name].set(row, value)
+
+def _get_sensor(table, row):
+    return SENSORS[table.columns['SENSOR_TYPE'][row]]
+
+def _set_sensor(table, row, value):
+    table.columns['SENSOR_TYPE'][row] = _SENSOR_CODES[value]
+
+def _get_version(table, row):
+    return table.versions[table.columns['MEAS_ALG_VER'][row]]
+
+def _set_version(table, row, value):
+    table.columns['MEAS_ALG_VER'][row] = table.get_version_code(value)
+
+_GETTERS = {'BLUEDOT_WB_ID': _get_id,
+            'BLUEDOT_MEAS_DATE': _get_date('BLUEDOT_MEAS_DATE'),
+            'SAT_IMAGE_DATE': _get_date('SAT_IMAGE_DATE'),
+            'SENSOR_TYPE': _get_sensor,
+            'MEAS_STATUS': _get_number('MEAS_STATUS', int),
+            'MEAS_ALG_VER': _get_version,
+            'CLOUD_COVERAGE': _get_number('CLOUD_COVERAGE', float),
+            'SURF_WATER_LEVEL': _get_number('SURF_WATER_LEVEL', float),
+            'CC_ORIG': _get_number('CC_ORIG', int),
+            'CC_CLEAN': _get_number('CC_CLEAN', int),
+            'ALG_STATUS': _get_number('ALG_STATUS', int),
+            'GEOMETRY': _get_string('GEOMETRY'),
+            'S3_IMAGE_URL': _get_string('S3_IMAGE_URL')}
+
+_SETTERS = {'BLUEDOT_WB_ID': _set_id,
+            'BLUEDOT_MEAS_DATE': _set_date('BLUEDOT_MEAS_DATE'),
+            'SAT_IMAGE_DATE': _set_date('SAT_IMAGE_DATE'),
+            'SENSOR_TYPE': _set_sensor,
+            'MEAS_STATUS': _set_number('MEAS_STATUS'),
+            'MEAS_ALG_VER': _set_version,
+            'CLOUD_COVERAGE': _set_number('CLOUD_COVERAGE'),
+            'SURF_WATER_LEVEL': _set_number('SURF_WATER_LEVEL'),
+            'CC_ORIG': _set_number('CC_ORIG'),
+            'CC_CLEAN': _set_number('CC_CLEAN'),
+            'ALG_STATUS': _set_number('ALG_STATUS'),
+            'GEOMETRY': _set_string('GEOMETRY'),
+            'S3_IMAGE_URL': _set_string('S3_IMAGE_URL')}
+
+def _get_property(name):
+    getter, setter = _GETTERS[name], _SETTERS[name]
+
+    def get(view):
+        with view.table.lock:
+            return getter(view.table, view.row)
+
+    def set(view, value):
+        with view.table.lock:
+            setter(view.table, view.row, value)
+    return property(get, set)
+
+for _name in MEASUREMENT_FIELDS:
+    setattr(MeasurementView, _name, _get_property(_name))
+
+# None: measurements without a table are standalone `Measurement` records
+_default_table = None
+
+def get_default_table():
+    """
+    Returns the table into which new measurements are added by default, None if they are standalone records.
+    """
+    return _default_table
+
+def set_default_table(table):
+    """
+    Sets the table into which new measurements are added by default, None for standalone records. A table should
+    be scoped to a run and dropped once its measurements are sunk, it only grows. Returns the previous table.
+    """
+    global _default_table
+    previous, _default_table = _default_table, table
+    return previous
+
+def _measurement_from_values(values):
+    return Measurement(*values)
+
+def _format_date(value):
+    return value[:10] if isinstance(value, str) else value.strftime('%Y-%m-%d')
+
+def get_new_measurement_entry(dam_id, date, sensor, version, table=None):
+    """
+    Adds a new measurement with unknown status to the table (by default the default table) and returns its view.
+    Without a table the measurement is a standalone `Measurement` record.
+    """
+    values = dict(BLUEDOT_WB_ID = dam_id,
+                  BLUEDOT_MEAS_DATE = datetime.today(),
+                  SAT_IMAGE_DATE = date,
+                  SENSOR_TYPE = sensor.value,
+                  MEAS_STATUS = WaterDetectionStatus.UNKNOWN_ERROR.value,
+                  MEAS_ALG_VER = version,
+                  CLOUD_COVERAGE = 1.0,
+                  SURF_WATER_LEVEL = 0.0,
+                  CC_ORIG = 0,
+                  CC_CLEAN = 0,
+                  ALG_STATUS = -1,
+                  GEOMETRY = 'POINT (0 0)',
+                  S3_IMAGE_URL = 'none')
+    table = _default_table if table is None else table
+    if table is None:
+        values['BLUEDOT_MEAS_DATE'] = _format_date(values['BLUEDOT_MEAS_DATE'])
+        values['SAT_IMAGE_DATE'] = _format_date(date)
+        return Measurement(**values)
+    return table.append(**values)
+
+def copy_measurement(measurement, table=None):
+    """
+    Adds a copy of the measurement to the table (by default the table of the measurement, else the default table)
+    and returns its view, or returns a standalone `Measurement` copy if there is no table. Within a table fixed
+    width fields are copied column-wise and the geometry bytes are shared.
+    """
+    if table is None and isinstance(measurement, MeasurementView):
+        table = measurement.table
+    table = _default_table if table is None else table
+
+    if table is None:
+        return Measurement(*[getattr(measurement, name) for name in MEASUREMENT_FIELDS])
+    if isinstance(measurement, MeasurementView) and measurement.table is table:
+        return table.copy_row(measurement.row)
+
+    return table.append(**{name: getattr(measurement, name) for name in MEASUREMENT_FIELDS})
 
 def set_measurement_status(measurement, status):
     measurement.MEAS_STATUS = status.value
@@ -1,15 +1,20 @@
 from sentinelhub import BBox, CRS, bbox_to_resolution
-import rasterio
-import rasterio.features
-import geopandas as gpd
 import numpy as np
 import numpy.ma as ma
-from shapely.geometry import Point
+from shapely.geometry import shape
+from shapely.ops import unary_union
 import sys
+import time
+import logging
 
-from skimage.morphology import closing
-from skimage.morphology import disk
-from skimage.measure import label
+from profiling import stage, add_count
+
+# rasterio, geopandas and skimage are imported on first use to keep the import of this module fast
+
+LOGGER = logging.getLogger(__name__)
+
+# approximate length of a vertex in WKT, e.g. "14.123456789012345 46.12345678901234, "
+WKT_BYTES_PER_VERTEX = 40
 
 def get_bbox(polygon, inflate_bbox=0.1):
     """
@@ -57,10 +62,91 @@ def get_simplified_poly(poly, simpl_fact = 0.0, simpl_step = 0.0001, threshold=2
             
     return poly
     
-def get_water_extent(water_mask, dam_poly, dam_bbox, simplify=True):
+def get_num_vertices(geom):
+    """
+    Returns the number of coordinates of a geometry, including interior rings and all parts of multi-geometries.
+    """
+    if geom.is_empty:
+        return 0
+    if hasattr(geom, 'geoms'):
+        return sum(get_num_vertices(part) for part in geom.geoms)
+    if geom.geom_type == 'Polygon':
+        return len(geom.exterior.coords) + sum(len(interior.coords) for interior in geom.interiors)
+    return len(geom.coords)
+
+def get_wkt_size_estimate(geom):
     """
-    Returns the polygon of measured water extent.
+    Estimates the length of geometry's WKT from its number of vertices.
     """
+    return get_num_vertices(geom)*WKT_BYTES_PER_VERTEX
+
+def get_budget_simplified_poly(poly, max_vertices=None, max_bytes=None, rel_tolerance=0.05, max_iterations=30):
+    """
+    Simplifies the polygon to at most `max_vertices` vertices (or estimated WKT size of at most `max_bytes`).
+
+    The smallest sufficient simplification tolerance is searched for by doubling the tolerance until the budget is
+    met followed by bisection, so the number of simplifications is logarithmic. Returns the simplified polygon and
+    a dictionary with number of iterations, used tolerance, number of vertices, whether the polygon is still over
+    budget (after `max_iterations`) and time spent. Iterations, removed vertices and overruns are also added to the
+    profiler counters.
+    """
+    start = time.perf_counter()
+    if max_vertices is None and max_bytes is None:
+        raise ValueError('Either max_vertices or max_bytes has to be given')
+    if max_vertices is None:
+        max_vertices = max_bytes//WKT_BYTES_PER_VERTEX
+    
+    n_vertices = get_num_vertices(poly)
+    stats = {'iterations': 0, 'tolerance': 0.0, 'vertices': n_vertices, 'over_budget': False}
+    if n_vertices <= max_vertices:
+        stats['time'] = time.perf_counter() - start
+        return poly, stats
+
+    # exponential search for a tolerance which meets the budget
+    minx, miny, maxx, maxy = poly.bounds
+    low, high = 0.0, max(maxx - minx, maxy - miny)*1e-5
+    simplified = poly.simplify(high, preserve_topology=False)
+    n_simplified = get_num_vertices(simplified)
+    stats['iterations'] += 1
+    while n_simplified > max_vertices and stats['iterations'] < max_iterations:
+        low, high = high, 2*high
+        simplified = poly.simplify(high, preserve_topology=False)
+        n_simplified = get_num_vertices(simplified)
+        stats['iterations'] += 1
+
+    # bisection for the smallest tolerance which meets the budget
+    while high - low > rel_tolerance*high and stats['iterations'] < max_iterations:
+        middle = (low + high)/2
+        candidate = poly.simplify(middle, preserve_topology=False)
+        n_candidate = get_num_vertices(candidate)
+        stats['iterations'] += 1
+        if n_candidate > max_vertices:
+            low = middle
+        else:
+            high, simplified, n_simplified = middle, candidate, n_candidate
+
+    stats.update({'tolerance': high, 'vertices': n_simplified, 'over_budget': n_simplified > max_vertices,
+                  'time': time.perf_counter() - start})
+    if stats['over_budget']:
+        LOGGER.warning('Simplified %d to %d vertices, over the budget of %d vertices after %d iterations',
+                       n_vertices, n_simplified, max_vertices, stats['iterations'])
+    else:
+        LOGGER.debug('Simplified %d to %d vertices in %d iterations (%.3fs)', n_vertices, n_simplified,
+                     stats['iterations'], stats['time'])
+    add_count('simplify_iterations', stats['iterations'])
+    add_count('simplify_removed', n_vertices - n_simplified)
+    add_count('simplify_overrun', int(stats['over_budget']))
+    return simplified, stats
+
+def get_water_extent_geopandas(water_mask, dam_poly, dam_bbox, simplify=True):
+    """
+    Returns the polygon of measured water extent, None if there is no water. Reference implementation which
+    polygonizes the entire mask.
+    """
+    import rasterio.features
+    import rasterio.transform
+    import geopandas as gpd
+
     src_transform = rasterio.transform.from_bounds(*dam_bbox.get_lower_left(),
                                                    *dam_bbox.get_upper_right(),
                                                    width=water_mask.shape[1],
@@ -72,12 +158,12 @@ def get_water_extent(water_mask, dam_poly, dam_bbox, simplify=True):
     
     geoms = list(results)
     if len(geoms)==0:
-        return Point(0,0), 0, 0
+        return None
 
     gpd_polygonized_raster = gpd.GeoDataFrame.from_features(geoms)
     intrscts_idx = gpd_polygonized_raster.index[(gpd_polygonized_raster.intersects(dam_poly)==True)] 
     
-    measured_water_extent = gpd_polygonized_raster.loc[intrscts_idx].cascaded_union
+    measured_water_extent = unary_union(gpd_polygonized_raster.loc[intrscts_idx].geometry)
     measured_water_extent = measured_water_extent.buffer(0)
     
     if simplify:
@@ -85,27 +171,119 @@ def get_water_extent(water_mask, dam_poly, dam_bbox, simplify=True):
     
     return measured_water_extent
 
-def get_raster_mask(dam_poly, dam_bbox, width, height):
+def get_water_extent(water_mask, dam_poly, dam_bbox, simplify=True, dam_context=None):
+    """
+    Returns the polygon of measured water extent, None if there is no water.
+
+    Connected water regions touching the rasterized dam polygon are selected on the raster and only those are
+    polygonized. Output is equivalent to `get_water_extent_geopandas`. If dam context is given, its cached
+    transform, nominal mask and prepared polygon are used.
+    """
+    import rasterio.features
+    import rasterio.transform
+    from skimage.measure import label
+
+    height, width = water_mask.shape
+    if dam_context is not None:
+        src_transform = dam_context.get_transform(width, height, bbox=dam_bbox)
+    else:
+        src_transform = rasterio.transform.from_bounds(*dam_bbox.get_lower_left(),
+                                                       *dam_bbox.get_upper_right(),
+                                                       width=width,
+                                                       height=height)
+
+    with stage('polygonize'):
+        # 4-connected components, same connectivity as rasterio.features.shapes
+        labels = label(water_mask==1, connectivity=1)
+        if labels.max()==0:
+            return None
+
+        if dam_context is not None:
+            dam_mask = dam_context.get_nominal_mask(width, height, all_touched=True, bbox=dam_bbox)
+        else:
+            dam_mask = get_raster_mask(dam_poly, dam_bbox, width, height, all_touched=True)
+        dam_labels = np.unique(labels[(dam_mask==1) & (labels>0)])
+
+        # do vectorization of selected components only
+        water_mask = np.isin(labels, dam_labels)
+        geoms = [shape(s) for s, v in rasterio.features.shapes(water_mask.astype(np.uint8), mask=water_mask,
+                                                                 transform=src_transform)]
+        dam_intersects = dam_context.prepared_poly.intersects if dam_context is not None else dam_poly.intersects
+        geoms = [geom for geom in geoms if dam_intersects(geom)]
+
+        measured_water_extent = unary_union(geoms)
+        measured_water_extent = measured_water_extent.buffer(0)
+
+    if simplify:
+        with stage('simplify'):
+            measured_water_extent, _ = get_budget_simplified_poly(
+                measured_water_extent, max_bytes=min(100000, get_wkt_size_estimate(dam_poly)*100))
+
+    return measured_water_extent
+
+def get_raster_mask(dam_poly, dam_bbox, width, height, all_touched=False):
     """
     Burns the dam's nominal water extent to raster.
     """
+    import rasterio.features
+    import rasterio.transform
+
     dst_transform = rasterio.transform.from_bounds(*dam_bbox, width=width, height=height)
     raster = np.zeros((height, width), dtype=np.uint8)
-    rasterio.features.rasterize([(dam_poly.buffer(0), 1)], out=raster, transform=dst_transform, dtype=np.uint8)
+    rasterio.features.rasterize([(dam_poly.buffer(0), 1)], out=raster, transform=dst_transform, dtype=np.uint8,
+                                all_touched=all_touched)
     return raster
 
-def apply_DEM_veto(dem, dam_nominal, dam_current, dam_bbox, resx, resy, dem_threshold=15, simplify=True):
+def get_raster_outline(geometry, dam_bbox, width, height, line_width=1):
     """
-    Applies veto to measured water extent based on Digital Eleveation Model (DEM) data. Regions of detected water above 15 meters
-    above mean dem height of the lake are excluded.
+    Burns the boundary of a (multi)polygon to a raster mask with lines of about `line_width` pixels, using the same
+    transform as `get_raster_mask`.
     """
-    wb_nominal = get_raster_mask(dam_nominal, dam_bbox, dem.shape[1], dem.shape[0])
-    wb_current = get_raster_mask(dam_current, dam_bbox, dem.shape[1], dem.shape[0])
+    import rasterio.features
+    import rasterio.transform
+    from skimage.morphology import disk, binary_dilation
+
+    dst_transform = rasterio.transform.from_bounds(*dam_bbox, width=width, height=height)
+    raster = np.zeros((height, width), dtype=np.uint8)
+    if geometry is None or geometry.is_empty:
+        return raster.astype(bool)
+    rasterio.features.rasterize([(geometry.boundary, 1)], out=raster, transform=dst_transform, dtype=np.uint8,
+                                all_touched=True)
+    if line_width > 1:
+        return binary_dilation(raster.astype(bool), disk(line_width//2))
+    return raster.astype(bool)
+
+def get_DEM_veto_mask(dem, dam_nominal, dam_bbox, dem_threshold=15, dam_context=None):
+    """
+    Returns the mask of pixels where water is allowed by the DEM veto: pixels less than `dem_threshold` meters above 
+    mean dem height of the lake or within the nominal outline. The mask depends only on the dam, so it can be 
+    computed once and applied to all measurements.
+    """
+    if dam_context is not None:
+        wb_nominal = dam_context.get_nominal_mask(dem.shape[1], dem.shape[0], bbox=dam_bbox)
+    else:
+        wb_nominal = get_raster_mask(dam_nominal, dam_bbox, dem.shape[1], dem.shape[0])
     
     dem_masked = ma.masked_array(dem, mask=np.logical_not(wb_nominal))
     
     dem_valid = dem<(ma.mean(dem_masked)+dem_threshold)
-    dem_valid = np.logical_or(dem_valid, wb_nominal)
+    return np.logical_or(dem_valid, wb_nominal)
+
+def apply_DEM_veto_mask(dem_valid, dam_nominal, dam_current, dam_bbox, simplify=True, dam_context=None):
+    """
+    Applies precomputed DEM veto mask (see `get_DEM_veto_mask`) to measured water extent. Returns None if no water
+    is left.
+    """
+    wb_current = get_raster_mask(dam_current, dam_bbox, dem_valid.shape[1], dem_valid.shape[0])
     wb_current = np.logical_and(dem_valid, wb_current)
 
-    return get_water_extent(wb_current.astype(np.uint8), dam_nominal, dam_bbox, simplify)
\ No newline at end of file
+    return get_water_extent(wb_current.astype(np.uint8), dam_nominal, dam_bbox, simplify, dam_context=dam_context)
+
+def apply_DEM_veto(dem, dam_nominal, dam_current, dam_bbox, resx, resy, dem_threshold=15, simplify=True,
+                   dam_context=None):
+    """
+    Applies veto to measured water extent based on Digital Eleveation Model (DEM) data. Regions of detected water above 15 meters
+    above mean dem height of the lake are excluded. Returns None if no water is left.
+    """
+    dem_valid = get_DEM_veto_mask(dem, dam_nominal, dam_bbox, dem_threshold, dam_context=dam_context)
+    return apply_DEM_veto_mask(dem_valid, dam_nominal, dam_current, dam_bbox, simplify, dam_context=dam_context)
@@ -0,0 +1,148 @@
+""" Module for incremental processing, which skips dates already measured by the current algorithm version. """
+
+import re
+from datetime import datetime
+
+from definitions import WaterDetectionSensor, WaterDetectionStatus
+from sh_requests import get_S2_dates
+from dam_context import DamContext
+from s2_water_extraction import S2_WATER_DETECTOR_VERSION, S2_MAX_CC, extract_surface_water_area_per_frame
+
+RETRYABLE_STATUSES = (WaterDetectionStatus.UNKNOWN_ERROR, WaterDetectionStatus.SH_REQUEST_ERROR)
+
+def parse_version(version):
+    """
+    Parses algorithm version string, e.g. 'v.0.2' -> (0, 2).
+    """
+    return tuple(int(number) for number in re.findall(r'\d+', version))
+
+def _to_ordinal(date):
+    if isinstance(date, str):
+        date = datetime.strptime(date[:10], '%Y-%m-%d')
+    if isinstance(date, datetime):
+        date = date.date()
+    return date.toordinal()
+
+class MeasurementIndex:
+    """
+    Compact index of existing measurements: (dam, date) -> (algorithm version, status). Dates are stored as day
+    ordinals and version and status are packed into a single integer, with version strings interned.
+
+    Only measurements of one sensor type (S2_NDWI by default) are indexed.
+    """
+    def __init__(self, version=S2_WATER_DETECTOR_VERSION, sensor=WaterDetectionSensor.S2_NDWI,
+                 retryable_statuses=RETRYABLE_STATUSES):
+        self.version = parse_version(version)
+        self.sensor = sensor.value
+        self.retryable_statuses = set(status.value for status in retryable_statuses)
+        self.stats = {'scheduled': 0, 'skipped': 0, 'new': 0, 'outdated': 0, 'retried': 0}
+
+        self._versions = []
+        self._version_idx = {}
+        self._index = {}
+
+    def __len__(self):
+        return sum(len(dates) for dates in self._index.values())
+
+    def _pack(self, version, status):
+        if version not in self._version_idx:
+            self._version_idx[version] = len(self._versions)
+            self._versions.append(parse_version(version))
+        return (self._version_idx[version] << 8) | (status & 0xff)
+
+    def _unpack(self, value):
+        status = value & 0xff
+        return self._versions[value >> 8], status - 0x100 if status > 0x7f else status
+
+    def add(self, dam_id, date, version, status, sensor=None):
+        """
+        Adds a measurement to the index. Among measurements of the same dam and date the newest algorithm version
+        is kept, a retryable status is replaced by any other status of the same version.
+        """
+        if sensor is not None and sensor != self.sensor:
+            return
+
+        dam_dates = self._index.setdefault(str(dam_id), {})
+        day = _to_ordinal(date)
+        value = self._pack(version, status)
+        if day in dam_dates:
+            old_version, old_status = self._unpack(dam_dates[day])
+            new_version = parse_version(version)
+            if new_version < old_version:
+                return
+            if new_version == old_version and old_status not in self.retryable_statuses:
+                return
+        dam_dates[day] = value
+
+    @classmethod
+    def from_measurements(cls, measurements, **kwargs):
+        """
+        Builds the index from an iterable of measurements.
+        """
+        index = cls(**kwargs)
+        for measurement in measurements:
+            index.add(measurement.BLUEDOT_WB_ID, measurement.SAT_IMAGE_DATE, measurement.MEAS_ALG_VER,
+                      measurement.MEAS_STATUS, sensor=measurement.SENSOR_TYPE)
+        return index
+
+    @classmethod
+    def from_dataset(cls, root_path, file_format='parquet', **kwargs):
+        """
+        Builds the index from a dataset written by `measurement_sink.MeasurementSink`.
+        """
+        from measurement_sink import read_measurements
+
+        columns = ['BLUEDOT_WB_ID', 'SAT_IMAGE_DATE', 'MEAS_ALG_VER', 'MEAS_STATUS', 'SENSOR_TYPE']
+        table = read_measurements(root_path, file_format=file_format, columns=columns).to_pydict()
+
+        index = cls(**kwargs)
+        for dam_id, date, version, status, sensor in zip(*(table[column] for column in columns)):
+            index.add(dam_id, date, version, status, sensor=sensor)
+        return index
+
+    def needs_processing(self, dam_id, date):
+        """
+        Returns the reason for (re)processing the date ('new', 'outdated' or 'retried') or None if it is up to date.
+        """
+        value = self._index.get(str(dam_id), {}).get(_to_ordinal(date))
+        if value is None:
+            return 'new'
+
+        version, status = self._unpack(value)
+        if version < self.version:
+            return 'outdated'
+        if status in self.retryable_statuses:
+            return 'retried'
+        return None
+
+    def get_dates_to_process(self, dam_id, dates):
+        """
+        Returns the dates of the dam which have not been measured yet, were measured by an older algorithm version
+        or ended with a retryable status. Counts of scheduled and skipped dates are accumulated in `stats`.
+        """
+        dates_to_process = []
+        for date in dates:
+            reason = self.needs_processing(dam_id, date)
+            if reason is None:
+                self.stats['skipped'] += 1
+            else:
+                self.stats[reason] += 1
+                self.stats['scheduled'] += 1
+                dates_to_process.append(date)
+        return dates_to_process
+
+def extract_surface_water_area_incremental(dam_id, dam_poly, time_interval, index, tile_cache=None,
+                                           date_catalogue=None):
+    """
+    Runs water detection for the dates in the time interval which need (re)processing according to the index.
+    Dates are taken from the date catalogue (see `date_discovery.DateCatalogue`) if it is given.
+    """
+    dam_context = DamContext(dam_id, dam_poly)
+    if date_catalogue is not None:
+        dates = date_catalogue.get_dates(dam_context.dam_bbox, time_interval, maxcc=S2_MAX_CC)
+    else:
+        dates = get_S2_dates(time_interval, dam_context.dam_bbox, S2_MAX_CC)
+
+    for date in index.get_dates_to_process(dam_id, dates):
+        yield extract_surface_water_area_per_frame(dam_id, dam_poly, dam_context.dam_bbox, date, dam_context.resx,
+                                                   dam_context.resy, tile_cache=tile_cache, dam_context=dam_context)
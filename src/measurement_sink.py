@@ -0,0 +1,136 @@
+""" Module for writing measurements to columnar (Parquet/Arrow) datasets. """
+
+import os
+import uuid
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+from shapely.wkt import loads
+
+PARTITION_COLUMN = 'BLUEDOT_WB_ID'
+
+MEASUREMENT_SCHEMA = pa.schema([('BLUEDOT_WB_ID', pa.string()),
+                                ('BLUEDOT_MEAS_DATE', pa.date32()),
+                                ('SAT_IMAGE_DATE', pa.date32()),
+                                ('SENSOR_TYPE', pa.string()),
+                                ('MEAS_STATUS', pa.int8()),
+                                ('MEAS_ALG_VER', pa.string()),
+                                ('CLOUD_COVERAGE', pa.float32()),
+                                ('SURF_WATER_LEVEL', pa.float64()),
+                                ('CC_ORIG', pa.int32()),
+                                ('CC_CLEAN', pa.int32()),
+                                ('ALG_STATUS', pa.int8()),
+                                ('GEOMETRY', pa.string()),
+                                ('S3_IMAGE_URL', pa.string())])
+
+MEASUREMENT_FIELDS = MEASUREMENT_SCHEMA.names
+
+FILE_EXTENSIONS = {'parquet': 'parquet', 'arrow': 'arrow'}
+
+def get_partitioning():
+    """
+    Hive partitioning by waterbody ID. IDs are URI-encoded in directory names, so IDs with e.g. '/', '=' or '%'
+    map to a single partition and are read back unchanged.
+    """
+    return ds.HivePartitioning(pa.schema([(PARTITION_COLUMN, pa.string())]), segment_encoding='uri')
+
+def _to_date(date):
+    return datetime.strptime(date, '%Y-%m-%d').date() if isinstance(date, str) else date
+
+class MeasurementSink:
+    """
+    Buffers measurements in columns and writes them in batches of `batch_size` rows to a Parquet or Arrow IPC
+    dataset partitioned by waterbody ID (`<root_path>/BLUEDOT_WB_ID=<URI-encoded id>/part-<uuid>-<i>.<ext>`, see
+    `get_partitioning`). Each flush adds new files, so existing data is never rewritten. Geometries can be stored as
+    WKT, WKB (`GEOMETRY_WKB` column) or both.
+    """
+    def __init__(self, root_path, batch_size=10000, file_format='parquet', wkt_geometry=True, wkb_geometry=False):
+        if file_format not in FILE_EXTENSIONS:
+            raise ValueError(f'Unsupported file format {file_format}, use one of {list(FILE_EXTENSIONS)}')
+
+        self.root_path = root_path
+        self.batch_size = batch_size
+        self.file_format = file_format
+        self.wkt_geometry = wkt_geometry
+        self.wkb_geometry = wkb_geometry
+        self.n_written = 0
+        self.n_batches = 0
+
+        schema = MEASUREMENT_SCHEMA
+        if not wkt_geometry:
+            schema = schema.remove(schema.get_field_index('GEOMETRY'))
+        if wkb_geometry:
+            schema = schema.append(pa.field('GEOMETRY_WKB', pa.binary()))
+        self.schema = schema
+
+        self._columns = {name: [] for name in MEASUREMENT_FIELDS}
+        os.makedirs(root_path, exist_ok=True)
+
+    def __len__(self):
+        return len(self._columns['BLUEDOT_WB_ID'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, measurement):
+        """
+        Adds measurement to the buffer and flushes the buffer if it is full.
+        """
+        for name in MEASUREMENT_FIELDS:
+            self._columns[name].append(getattr(measurement, name))
+
+        if len(self) >= self.batch_size:
+            self.flush()
+
+    def write_all(self, measurements):
+        for measurement in measurements:
+            self.write(measurement)
+
+    def _get_table(self):
+        columns = self._columns
+        arrays = {'BLUEDOT_WB_ID': [str(wb_id) for wb_id in columns['BLUEDOT_WB_ID']],
+                  'BLUEDOT_MEAS_DATE': [_to_date(date) for date in columns['BLUEDOT_MEAS_DATE']],
+                  'SAT_IMAGE_DATE': [_to_date(date) for date in columns['SAT_IMAGE_DATE']]}
+        if self.wkb_geometry:
+            arrays['GEOMETRY_WKB'] = [loads(geometry).wkb for geometry in columns['GEOMETRY']]
+
+        return pa.table([pa.array(arrays.get(field.name, columns.get(field.name)), type=field.type)
+                         for field in self.schema], schema=self.schema)
+
+    def flush(self):
+        """
+        Writes buffered measurements as new files of the dataset.
+        """
+        if len(self)==0:
+            return
+
+        table = self._get_table()
+        extension = FILE_EXTENSIONS[self.file_format]
+        ds.write_dataset(table, self.root_path, format='ipc' if self.file_format == 'arrow' else 'parquet',
+                         partitioning=get_partitioning(),
+                         basename_template=f'part-{uuid.uuid4().hex}-{{i}}.{extension}',
+                         existing_data_behavior='overwrite_or_ignore')
+
+        self.n_written += len(self)
+        self.n_batches += 1
+        self._columns = {name: [] for name in MEASUREMENT_FIELDS}
+
+    def close(self):
+        self.flush()
+
+def read_measurements(root_path, file_format='parquet', columns=None, dam_ids=None):
+    """
+    Reads the measurement dataset written by `MeasurementSink` as a pyarrow table, optionally only selected columns
+    and waterbodies.
+    """
+    dataset = ds.dataset(root_path, format='ipc' if file_format == 'arrow' else 'parquet',
+                         partitioning=get_partitioning())
+
+    row_filter = None
+    if dam_ids is not None:
+        row_filter = ds.field(PARTITION_COLUMN).isin([str(dam_id) for dam_id in dam_ids])
+    return dataset.to_table(columns=columns, filter=row_filter)
@@ -0,0 +1,210 @@
+""" Module for lightweight per-stage profiling of the extraction pipeline.
+
+Profiling is disabled unless a collector is set with `set_collector`. When disabled, `stage` returns a shared no-op
+context manager and `timed` functions only check a global, so the instrumentation can stay in place.
+"""
+
+import time
+import threading
+from functools import wraps
+
+import numpy as np
+
+_collector = None
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    def __init__(self, collector, name):
+        self.collector = collector
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.collector.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+class _Record:
+    def __init__(self, collector, labels):
+        self.collector = collector
+        self.labels = labels
+
+    def __enter__(self):
+        self.collector.start_record(**self.labels)
+        return self
+
+    def __exit__(self, *exc):
+        self.collector.finish_record()
+        return False
+
+def set_collector(collector):
+    """
+    Enables profiling with the given collector (e.g. `StageProfiler`) or disables it with None. Returns the previous
+    collector.
+    """
+    global _collector
+    previous, _collector = _collector, collector
+    return previous
+
+def get_collector():
+    return _collector
+
+def stage(name):
+    """
+    Context manager timing a pipeline stage. Nested stages are timed separately, the outer time includes them.
+    """
+    if _collector is None:
+        return _NULL_STAGE
+    return _Stage(_collector, name)
+
+def timed(name):
+    """
+    Decorator timing every call of the function as a pipeline stage.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _collector is None:
+                return func(*args, **kwargs)
+            with _Stage(_collector, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record(**labels):
+    """
+    Context manager grouping stage timings, byte counts and array sizes of one measurement, e.g.
+    `record(dam_id=..., date=...)`.
+    """
+    if _collector is None:
+        return _NULL_STAGE
+    return _Record(_collector, labels)
+
+def add_bytes(name, nbytes):
+    """
+    Adds to a byte counter, e.g. downloaded bytes per request type.
+    """
+    if _collector is not None:
+        _collector.add_bytes(name, nbytes)
+
+def add_count(name, count=1):
+    """
+    Adds to a counter, e.g. iterations of polygon simplification.
+    """
+    if _collector is not None:
+        _collector.add_count(name, count)
+
+def track_array(array):
+    """
+    Tracks the size of an array for the peak array size of the current measurement.
+    """
+    if _collector is not None:
+        _collector.track_array(array.nbytes)
+
+class StageProfiler:
+    """
+    Collects stage timings, byte counters and peak array size per measurement and reports percentiles over a run.
+    Measurements are recorded per thread, so the profiler can be shared by download threads. Compute processes
+    have their own (disabled by default) collector.
+
+    Timings outside of `record` (e.g. of date discovery) are collected into an unlabelled record per thread, which
+    is not a measurement: its stages are reported separately from percentiles over measurements.
+    """
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _current(self):
+        current = getattr(self._local, 'record', None)
+        if current is None:
+            # timings outside of a measurement record are collected into a record of their own
+            current = self.start_record()
+            current['orphan'] = True
+            with self._lock:
+                self.records.append(current)
+        return current
+
+    def start_record(self, **labels):
+        self._local.record = {'labels': labels, 'times': {}, 'bytes': {}, 'counts': {}, 'peak_array_bytes': 0,
+                              'orphan': False}
+        return self._local.record
+
+    def finish_record(self):
+        current = getattr(self._local, 'record', None)
+        self._local.record = None
+        if current is not None:
+            with self._lock:
+                self.records.append(current)
+
+    def add_time(self, name, seconds):
+        times = self._current()['times']
+        times[name] = times.get(name, 0.0) + seconds
+
+    def add_bytes(self, name, nbytes):
+        counters = self._current()['bytes']
+        counters[name] = counters.get(name, 0) + nbytes
+
+    def add_count(self, name, count):
+        counters = self._current()['counts']
+        counters[name] = counters.get(name, 0) + count
+
+    def track_array(self, nbytes):
+        current = self._current()
+        current['peak_array_bytes'] = max(current['peak_array_bytes'], nbytes)
+
+    @staticmethod
+    def _percentiles(values):
+        if len(values)==0:
+            return {'count': 0, 'total': 0.0, 'p50': 0.0, 'p90': 0.0, 'p99': 0.0, 'max': 0.0}
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        return {'count': len(values), 'total': sum(values), 'p50': p50, 'p90': p90, 'p99': p99, 'max': max(values)}
+
+    def summary(self):
+        """
+        Returns percentiles of stage times (in seconds) over measurements, total stage times outside of
+        measurements, total bytes per byte counter, totals of other counters and the maximal peak array size.
+        Counters include both measurements and timings outside of them.
+        """
+        with self._lock:
+            records = list(self.records)
+        measurements = [rec for rec in records if not rec['orphan']]
+        orphans = [rec for rec in records if rec['orphan']]
+
+        stages = sorted(set(name for rec in measurements for name in rec['times']))
+        other_stages = sorted(set(name for rec in orphans for name in rec['times']))
+        counters = sorted(set(name for rec in records for name in rec['bytes']))
+        counts = sorted(set(name for rec in records for name in rec['counts']))
+        return {'measurements': len(measurements),
+                'stages': {name: self._percentiles([rec['times'][name] for rec in measurements
+                                                    if name in rec['times']])
+                           for name in stages},
+                'other_stages': {name: sum(rec['times'].get(name, 0.0) for rec in orphans) for name in other_stages},
+                'bytes': {name: sum(rec['bytes'].get(name, 0) for rec in records) for name in counters},
+                'counts': {name: sum(rec['counts'].get(name, 0) for rec in records) for name in counts},
+                'peak_array_bytes': max([rec['peak_array_bytes'] for rec in records], default=0)}
+
+    def __str__(self):
+        summary = self.summary()
+        lines = [f"{summary['measurements']} measurements, peak array {summary['peak_array_bytes']/2**20:.1f} MB",
+                 f"{'stage':>20} {'count':>6} {'total':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}"]
+        for name, stats in summary['stages'].items():
+            lines.append(f"{name:>20} {stats['count']:>6} {stats['total']:>7.2f}s {stats['p50']:>7.3f}s "
+                         f"{stats['p90']:>7.3f}s {stats['p99']:>7.3f}s {stats['max']:>7.3f}s")
+        for name, seconds in summary['other_stages'].items():
+            lines.append(f"{name:>20} {'-':>6} {seconds:>7.2f}s (outside of measurements)")
+        for name, nbytes in summary['bytes'].items():
+            lines.append(f"{name:>20} {nbytes/2**20:>8.1f} MB")
+        for name, count in summary['counts'].items():
+            lines.append(f"{name:>20} {count:>8}")
+        return '\n'.join(lines)
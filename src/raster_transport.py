@@ -0,0 +1,329 @@
+""" Module for passing rasters to worker processes through shared memory instead of pickling them.
+
+Rasters are written once into a ring of reusable shared buffers and workers get a small `RasterHandle`, by which
+they attach to the buffer and read the raster without a copy. Buffers are memory-mapped files in /dev/shm (or another
+folder) or `multiprocessing.shared_memory` segments on Python 3.8+. Rasters which do not fit into the free space of
+the folder (e.g. the 64 MB /dev/shm of a Docker container) are pickled instead.
+"""
+
+import os
+import uuid
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# rasters smaller than this are cheaper to pickle than to pass through a buffer
+DEFAULT_MIN_BYTES = 256*2**10
+# space left free in the folder of buffers for other users of it
+FREE_BYTES_MARGIN = 16*2**20
+# number of buffers each worker process keeps attached
+WORKER_BUFFERS = 16
+_worker_buffers = OrderedDict()
+_worker_lock = threading.Lock()
+
+class RasterHandle:
+    """
+    Reference to a raster in a shared buffer, passed to worker processes instead of the raster.
+    """
+    __slots__ = ('name', 'backend', 'shape', 'dtype', 'ring', 'slot')
+
+    def __init__(self, name, backend, shape, dtype, ring, slot):
+        self.name = name
+        self.backend = backend
+        self.shape = shape
+        self.dtype = dtype
+        self.ring = ring
+        self.slot = slot
+
+    def __getstate__(self):
+        return self.name, self.backend, self.shape, self.dtype, self.ring, self.slot
+
+    def __setstate__(self, state):
+        self.name, self.backend, self.shape, self.dtype, self.ring, self.slot = state
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape))*np.dtype(self.dtype).itemsize
+
+    def __repr__(self):
+        return f'RasterHandle({self.name!r}, shape={self.shape}, dtype={self.dtype})'
+
+class _Buffer:
+    """
+    Shared buffer of a ring slot, owned by the process which created it.
+    """
+    def __init__(self, size, backend, folder):
+        self.size = size
+        self.backend = backend
+        if backend == 'shm':
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            self.name = self._shm.name
+            self.buf = self._shm.buf
+        else:
+            self.name = os.path.join(folder, f'raster-{os.getpid()}-{uuid.uuid4().hex}.buf')
+            try:
+                with open(self.name, 'wb') as file:
+                    if hasattr(os, 'posix_fallocate'):
+                        # allocate the file now, so a lack of space raises here instead of SIGBUS on writing
+                        os.posix_fallocate(file.fileno(), 0, size)
+                    else:
+                        file.truncate(size)
+                self._mmap = np.memmap(self.name, dtype=np.uint8, mode='r+', shape=(size,))
+            except OSError:
+                self._remove_file()
+                raise
+            self.buf = self._mmap
+
+    def get_array(self, shape, dtype):
+        return np.ndarray(shape, dtype=dtype, buffer=self.buf)
+
+    def close(self):
+        """
+        Removes the buffer. Processes which still have it attached keep their mapping until they drop it.
+        """
+        self.buf = None
+        if self.backend == 'shm':
+            try:
+                self._shm.close()
+            except BufferError:
+                # views of the buffer still exist in this process, the mapping is freed with them
+                pass
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                # removed by the resource tracker of a worker process which attached it and exited
+                pass
+        else:
+            self._mmap = None
+            self._remove_file()
+
+    def _remove_file(self):
+        try:
+            os.remove(self.name)
+        except FileNotFoundError:
+            pass
+
+def get_default_backend():
+    """
+    Memory-mapped files are the default, they work on every Python and were faster to pass to workers than
+    `shared_memory` segments in `benchmarks/bench_raster_transport.py`.
+    """
+    return 'mmap'
+
+def get_default_folder():
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+def get_free_bytes(folder):
+    """
+    Returns the free space of the file system of the folder in bytes, or None if it is unknown.
+    """
+    try:
+        stat = os.statvfs(folder)
+    except (AttributeError, OSError):
+        return None
+    return stat.f_bavail*stat.f_frsize
+
+class RasterRing:
+    """
+    Ring of `n_slots` reusable shared buffers. `put` copies a raster into a free slot with a reference count and
+    returns its handle, `release` frees the slot when the count drops to zero, so the buffer is reused by a later
+    raster. A slot too small for a raster is replaced by a buffer at least twice as large, so buffers quickly grow to
+    the largest rasters.
+
+    `put` never blocks: if all slots are in use, the raster is smaller than `min_bytes` or there is no space for its
+    buffer, the raster itself is returned and it is pickled as before. Counts of these cases are in `stats`.
+
+    Backend is 'mmap' (memory-mapped files in `folder`, /dev/shm by default) or 'shm'
+    (`multiprocessing.shared_memory`, Python 3.8+). The ring is thread-safe, buffers are removed by `close`.
+    """
+    def __init__(self, n_slots=64, min_bytes=DEFAULT_MIN_BYTES, backend=None, folder=None):
+        self.n_slots = n_slots
+        self.min_bytes = min_bytes
+        self.backend = backend or get_default_backend()
+        if self.backend == 'shm' and shared_memory is None:
+            raise ValueError('multiprocessing.shared_memory requires Python 3.8 or later, use the mmap backend')
+        self.folder = folder or get_default_folder()
+        self.stats = {'shared': 0, 'shared_bytes': 0, 'pickled': 0, 'pickled_bytes': 0, 'grown': 0, 'no_space': 0}
+
+        self._id = uuid.uuid4().hex
+        self._buffers = [None]*n_slots
+        self._refs = [0]*n_slots
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def nbytes(self):
+        """
+        Total size of the shared buffers.
+        """
+        return sum(buffer.size for buffer in self._buffers if buffer is not None)
+
+    def _get_free_slot(self, nbytes):
+        """
+        Returns the free slot whose buffer is the smallest which fits, else an empty slot, else the largest free
+        slot (to be grown), or None if all slots are in use.
+        """
+        free = [slot for slot in range(self.n_slots) if self._refs[slot] == 0]
+        if not free:
+            return None
+        fitting = [slot for slot in free if self._buffers[slot] is not None and self._buffers[slot].size >= nbytes]
+        if fitting:
+            return min(fitting, key=lambda slot: self._buffers[slot].size)
+        empty = [slot for slot in free if self._buffers[slot] is None]
+        if empty:
+            return empty[0]
+        return max(free, key=lambda slot: self._buffers[slot].size)
+
+    def put(self, array, refs=1):
+        """
+        Copies the array into a shared buffer and returns its handle, holding `refs` references. Returns the array
+        if it is small or if no slot is free.
+        """
+        array = np.asarray(array)
+        if array.nbytes < self.min_bytes:
+            return self._pickled(array)
+
+        with self._lock:
+            slot = self._get_free_slot(array.nbytes)
+            if slot is not None:
+                self._refs[slot] = refs
+                buffer = self._buffers[slot]
+        if slot is None:
+            return self._pickled(array)
+
+        if buffer is None or buffer.size < array.nbytes:
+            buffer = self._grow(slot, array.nbytes)
+            if buffer is None:
+                return self._pickled(array)
+
+        buffer.get_array(array.shape, array.dtype)[...] = array
+        with self._lock:
+            self.stats['shared'] += 1
+            self.stats['shared_bytes'] += array.nbytes
+        return RasterHandle(buffer.name, self.backend, array.shape, array.dtype.str, self._id, slot)
+
+    def _grow(self, slot, nbytes):
+        """
+        Replaces the buffer of a slot held by `put` with one of at least `nbytes`, twice the old size if there is
+        space for it. Returns None and frees the slot if there is no space for the buffer.
+        """
+        with self._lock:
+            buffer = self._buffers[slot]
+            sizes = [nbytes]
+            if buffer is not None:
+                buffer.close()
+                self._buffers[slot] = None
+                self.stats['grown'] += 1
+                sizes.insert(0, max(nbytes, 2*buffer.size))
+
+            # shared memory segments are in /dev/shm on Linux
+            free_bytes = get_free_bytes('/dev/shm' if self.backend == 'shm' else self.folder)
+            for size in sizes:
+                if free_bytes is not None and size + FREE_BYTES_MARGIN > free_bytes:
+                    continue
+                try:
+                    self._buffers[slot] = _Buffer(size, self.backend, self.folder)
+                    return self._buffers[slot]
+                except OSError:
+                    pass
+
+            self.stats['no_space'] += 1
+            self._refs[slot] = 0
+            return None
+
+    def _pickled(self, array):
+        with self._lock:
+            self.stats['pickled'] += 1
+            self.stats['pickled_bytes'] += array.nbytes
+        return array
+
+    def retain(self, handle):
+        """
+        Adds a reference to the raster, e.g. when it is passed to another task.
+        """
+        if isinstance(handle, RasterHandle):
+            with self._lock:
+                self._refs[handle.slot] += 1
+
+    def release(self, handle):
+        """
+        Drops a reference to the raster, its slot is reused once no references are left. Arrays (rasters which
+        were not shared) and None are ignored.
+        """
+        if isinstance(handle, RasterHandle):
+            with self._lock:
+                self._refs[handle.slot] = max(0, self._refs[handle.slot] - 1)
+
+    def get(self, handle):
+        """
+        Returns the raster of the handle in this process.
+        """
+        if not isinstance(handle, RasterHandle):
+            return handle
+        return self._buffers[handle.slot].get_array(handle.shape, handle.dtype)
+
+    def close(self):
+        with self._lock:
+            for slot, buffer in enumerate(self._buffers):
+                if buffer is not None:
+                    buffer.close()
+                self._buffers[slot] = None
+                self._refs[slot] = 0
+
+def _detach(owner):
+    if shared_memory is not None and isinstance(owner, shared_memory.SharedMemory):
+        # views of the buffer may still exist in this process, the mapping is then freed with them
+        try:
+            owner.close()
+        except BufferError:
+            pass
+
+def _attach(handle):
+    """
+    Returns the buffer of the handle attached by this process, buffers are kept attached for later rasters. Buffers
+    are kept per ring slot, so the buffer of a slot which was regrown is dropped on attaching its new buffer.
+    """
+    key = handle.ring, handle.slot
+    with _worker_lock:
+        attached = _worker_buffers.get(key)
+        if attached is not None and attached[0] == handle.name:
+            _worker_buffers.move_to_end(key)
+            return attached[2]
+        if attached is not None:
+            del _worker_buffers[key]
+            _detach(attached[1])
+
+        if handle.backend == 'shm':
+            shm = shared_memory.SharedMemory(name=handle.name)
+            _worker_buffers[key] = (handle.name, shm, shm.buf)
+        else:
+            mmap = np.memmap(handle.name, dtype=np.uint8, mode='r')
+            _worker_buffers[key] = (handle.name, mmap, mmap)
+
+        if len(_worker_buffers) > WORKER_BUFFERS:
+            _, (_, owner, _) = _worker_buffers.popitem(last=False)
+            _detach(owner)
+        return _worker_buffers[key][2]
+
+def get_raster(raster):
+    """
+    Returns the raster of a handle as a read-only array without copying it. Arrays are returned unchanged, so
+    functions run in worker processes can take either.
+    """
+    if not isinstance(raster, RasterHandle):
+        return raster
+    array = np.ndarray(raster.shape, dtype=raster.dtype, buffer=_attach(raster))
+    array.flags.writeable = False
+    return array
@@ -4,16 +4,20 @@ import numpy.ma as ma
 from sentinelhub import WcsRequest, MimeType, CustomUrlParam
 from sentinelhub import DownloadFailedException
 from sentinelhub.download import ImageDecodingError
-from s2cloudless import CloudMaskRequest
 
-from skimage.filters import threshold_otsu
-from skimage.feature import canny
-from skimage.morphology import disk, binary_dilation
+# s2cloudless (LightGBM), skimage and scipy are imported on first use, so that worker processes which only download
+# or write measurements don't pay for them at startup
 
 from geom_utils import get_water_extent, get_optimal_resolution, get_optimal_cloud_resolution
-from geom_utils import get_bbox, apply_DEM_veto, get_simplified_poly
+from geom_utils import get_bbox, apply_DEM_veto, get_simplified_poly, get_DEM_veto_mask, apply_DEM_veto_mask
 
 from sh_requests import get_optical_data, get_S2_dates, get_S2_request, get_DEM_request, get_S2_wmsrequest
+from sh_requests import S2_DEM_SCRIPT_V3
+
+from tile_cache import get_request_data
+from sh_client import download
+from cloud_detection import get_cloud_detection_service
+from profiling import stage, timed, record, add_bytes, track_array
 
 from definitions import Measurement, WaterDetectionSensor, WaterDetectionStatus, get_new_measurement_entry, set_measurement_status, copy_measurement
 
@@ -22,13 +26,16 @@ from datetime import datetime, timedelta
 from shapely.wkt import loads
 import sys
 import gc
-
-from tqdm import tqdm_notebook as tqdm
+import threading
+from functools import lru_cache
 
 S2_WATER_DETECTOR_VERSION = 'v.0.2'
 S2_MAX_CC = 0.5
 S2_MIN_VALID_FRACTION = 0.98
 S2_MAX_CLOUD_COVERAGE = 0.20
+S2_CLOUD_THRESHOLD = 0.4
+_scratch_buffers = threading.local()
+
 S2_CLOUD_BANDS_SCRIPT = 'return [B01,B02,B04,B05,B08,B8A,B09,B10,B11,B12]'
 
 S2_CLOUD_BANDS_SCRIPT_V3 = """
@@ -60,11 +67,243 @@ S2_CLOUD_BANDS_SCRIPT_V3 = """
     }
 """
 
-def get_water_mask_from_S2(ndwi, canny_sigma=4, canny_threshold=0.3, selem=disk(4)):
+# compact transfer: NDWI scaled to integers with data mask packed in the lowest bit, cloud bands as digital numbers
+S2_NDWI_ENCODINGS = {'UINT8': (MimeType.TIFF_d8, 63),
+                     'UINT16': (MimeType.TIFF_d16, 16383)}
+
+S2_NDWI_COMPACT_SCRIPT_V3 = """
+    //VERSION=3
+    function setup() {
+        return {
+            input: [{
+                bands: ["B03", "B08", "dataMask"],
+            }],
+            output: {
+                bands: 1,
+                sampleType: "%(sample_type)s"
+            }
+        };
+    }
+
+    function evaluatePixel(sample) {
+        var ndwi = (sample.B03 - sample.B08)/(sample.B03 + sample.B08);
+        if (!isFinite(ndwi)) {
+            return [0];
+        }
+        return [2*(Math.round(ndwi*%(half_range)d) + %(half_range)d) + sample.dataMask];
+    }
+"""
+
+S2_CLOUD_BANDS_COMPACT_SCRIPT_V3 = """
+    //VERSION=3
+    function setup() {
+        return {
+            input: [{
+                bands: ["B01", "B02", "B04", "B05", "B08","B8A", "B09", "B10", "B11", "B12", "dataMask"],
+            }],
+            output: {
+                bands: 10,
+                sampleType: "UINT16"
+            }
+        };
+    }
+
+    function toDN(value) {
+        return Math.min(Math.max(Math.round(10000*value), 1), 65535);
+    }
+
+    function evaluatePixel(sample) {
+        if (sample.dataMask == 0) {
+            return [0, 0, 0, 0, 0, 0, 0, 0, 0, 0];
+        }
+        return [toDN(sample.B01),
+                toDN(sample.B02),
+                toDN(sample.B04),
+                toDN(sample.B05),
+                toDN(sample.B08),
+                toDN(sample.B8A),
+                toDN(sample.B09),
+                toDN(sample.B10),
+                toDN(sample.B11),
+                toDN(sample.B12)];
+    }
+"""
+
+def get_ndwi_compact_script(encoding):
+    """
+    Returns the evalscript of compact NDWI transfer for the encoding ('UINT8' or 'UINT16').
+    """
+    return S2_NDWI_COMPACT_SCRIPT_V3 % {'sample_type': encoding, 'half_range': S2_NDWI_ENCODINGS[encoding][1]}
+
+def decode_ndwi(packed, encoding):
+    """
+    Decodes NDWI packed by the compact evalscript into the layout of the float NDWI request, i.e. NDWI and data mask
+    as the last axis.
+    """
+    half_range = S2_NDWI_ENCODINGS[encoding][1]
+    data = np.empty(packed.shape + (2,), dtype=np.float32)
+    np.subtract(packed >> 1, half_range, out=data[..., 0], dtype=np.float32, casting='unsafe')
+    data[..., 0] *= np.float32(1/half_range)
+    np.bitwise_and(packed, 1, out=data[..., 1], casting='unsafe')
+    return data
+
+def decode_cloud_bands(packed):
+    """
+    Decodes cloud bands transferred as digital numbers into reflectances with data mask as the last band.
+    """
+    data = np.empty(packed.shape[:-1] + (packed.shape[-1] + 1,), dtype=np.float32)
+    np.multiply(packed, np.float32(1e-4), out=data[..., :-1], dtype=np.float32, casting='unsafe')
+    np.greater(packed[..., 0], 0, out=data[..., -1], casting='unsafe')
+    return data
+
+@lru_cache(maxsize=8)
+def get_structuring_element(radius):
+    """
+    Returns cached disk structuring element used for dilation of canny edges.
+    """
+    from skimage.morphology import disk
+    return disk(radius).astype(bool)
+
+@lru_cache(maxsize=8)
+def _get_rectangle_decomposition(shape, selem_bytes):
+    """
+    Decomposes a symmetric convex structuring element (e.g. disk) into a union of centered rectangles, given as
+    (height, width) pairs. Returns None if the structuring element can't be decomposed.
+    """
+    selem = np.frombuffer(selem_bytes, dtype=bool).reshape(shape)
+    if shape[0] % 2 == 0 or shape[1] % 2 == 0:
+        return None
+
+    center_y, center_x = shape[0]//2, shape[1]//2
+    half_widths = [np.count_nonzero(selem[center_y + dy])//2 for dy in range(center_y + 1)]
+    rectangles = [(2*dy + 1, 2*half_widths[dy] + 1) for dy in range(center_y + 1)
+                  if half_widths[dy] > 0 and (dy == center_y or half_widths[dy + 1] != half_widths[dy])]
+
+    reconstructed = np.zeros(shape, dtype=bool)
+    for height, width in rectangles:
+        reconstructed[center_y - height//2:center_y + height//2 + 1, center_x - width//2:center_x + width//2 + 1] = True
+    return tuple(rectangles) if np.array_equal(reconstructed, selem) else None
+
+def binary_dilation_fast(image, selem, out):
+    """
+    Binary dilation with zero border. Structuring elements which are unions of centered rectangles (e.g. disk) are
+    applied as separable maximum filters, others with `scipy.ndimage.binary_dilation`.
+    """
+    from scipy import ndimage as ndi
+
+    selem = np.asarray(selem, dtype=bool)
+    rectangles = _get_rectangle_decomposition(selem.shape, selem.tobytes())
+    if rectangles is None:
+        return ndi.binary_dilation(image, structure=selem, output=out)
+
+    image = image.view(np.uint8)
+    rows = _get_buffer('dilation_rows', image.shape, np.uint8)
+    rectangle = _get_buffer('dilation_rectangle', image.shape, np.uint8)
+    out[...] = False
+    for height, width in rectangles:
+        ndi.maximum_filter1d(image, height, axis=0, output=rows, mode='constant')
+        ndi.maximum_filter1d(rows, width, axis=1, output=rectangle, mode='constant')
+        out |= rectangle.view(bool)
+    return out
+
+def _get_buffer(name, shape, dtype):
+    """
+    Returns a scratch array of this thread which is reused between calls with the same shape.
+    """
+    buffer = getattr(_scratch_buffers, name, None)
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = np.empty(shape, dtype=dtype)
+        setattr(_scratch_buffers, name, buffer)
+    return buffer
+
+# bins of the Otsu histogram, as in skimage.filters.threshold_otsu
+OTSU_BINS = 256
+
+def threshold_otsu_histogram(values, value_range, nbins=OTSU_BINS):
+    """
+    Otsu threshold computed from the histogram of values within the known value range. Same as
+    `skimage.filters.threshold_otsu` for values with more than one distinct value.
+    """
+    return get_otsu_threshold(*np.histogram(values, bins=nbins, range=value_range))
+
+def get_otsu_threshold(counts, bin_edges):
+    """
+    Otsu threshold of a histogram given by counts and bin edges (e.g. summed histograms of several rasters with
+    the same bins).
+    """
+    bin_centers = (bin_edges[:-1] + bin_edges[1:])/2.
+
+    # class probabilities and means for all possible thresholds
+    weight1 = np.cumsum(counts)
+    weight2 = np.cumsum(counts[::-1])[::-1]
+    mean1 = np.cumsum(counts*bin_centers)/weight1
+    mean2 = (np.cumsum((counts*bin_centers)[::-1])/weight2[::-1])[::-1]
+
+    variance12 = weight1[:-1]*weight2[1:]*(mean1[:-1] - mean2[1:])**2
+    return bin_centers[np.argmax(variance12)]
+
+@timed('water_mask')
+def get_water_mask_from_S2(ndwi, canny_sigma=4, canny_threshold=0.3, selem=None):
     """
     Make water detection on input NDWI single band image.
+
+    Gives the same statuses and masks as `get_water_mask_from_S2_reference`. Distinct values are detected from
+    min/max instead of sorting, Otsu threshold is computed from a histogram over the known value range, edges are
+    dilated with separable filters of a cached structuring element and scratch buffers are reused between calls.
+    """
+    from skimage.feature import canny
+
+    if selem is None:
+        selem = get_structuring_element(4)
+
+    # default threshold (no water detected)
+    ndwi_min, ndwi_max = np.min(ndwi), np.max(ndwi)
+    if ndwi_min == ndwi_max:
+        return 0, (ndwi>1.0).astype(np.uint8)
+    
+    # transform NDWI values to [0,1]
+    ndwi_std = _get_buffer('ndwi_std', ndwi.shape, np.result_type(ndwi.dtype, np.float32))
+    np.subtract(ndwi, ndwi_min, out=ndwi_std)
+    ndwi_std /= (ndwi_max - ndwi_min)
+
+    edges = canny(ndwi_std, sigma=canny_sigma, high_threshold=canny_threshold)
+    dilated_edges = _get_buffer('dilated_edges', ndwi.shape, bool)
+    binary_dilation_fast(edges, selem, dilated_edges)
+    edge_values = ndwi[dilated_edges]
+
+    if edge_values.size > 0 and edge_values.min() != edge_values.max():
+        # threshold determined using dilated canny edge + otsu
+        otsu_thr = threshold_otsu_histogram(edge_values, (edge_values.min(), edge_values.max()))
+        status, fallback_status = 1, 3
+    else:
+        # theshold determined with otsu on entire image
+        otsu_thr = threshold_otsu_histogram(ndwi, (ndwi_min, ndwi_max))
+        status, fallback_status = 2, 4
+
+    # if majority of pixels above threshold have negative NDWI values
+    # change the threshold to 0.0
+    water = np.greater(ndwi, otsu_thr)
+    positive = _get_buffer('positive', ndwi.shape, bool)
+    np.greater(ndwi, 0, out=positive)
+    n_water = np.count_nonzero(water)
+    if n_water > 0 and np.count_nonzero(positive)/n_water < 0.9:
+        np.copyto(water, positive)
+        status = fallback_status
+
+    return status, water.view(np.uint8)
+
+def get_water_mask_from_S2_reference(ndwi, canny_sigma=4, canny_threshold=0.3, selem=None):
+    """
+    Make water detection on input NDWI single band image. Reference implementation of `get_water_mask_from_S2`.
     
     """
+    from skimage.filters import threshold_otsu
+    from skimage.feature import canny
+    from skimage.morphology import disk, binary_dilation
+
+    if selem is None:
+        selem = disk(4)
+
     # default threshold (no water detected)
     otsu_thr = 1.0
     status = 0
@@ -84,8 +323,8 @@ def get_water_mask_from_S2(ndwi, canny_sigma=4, canny_threshold=0.3, selem=disk(
 
             # if majority of pixels above threshold have negative NDWI values
             # change the threshold to 0.0
-            fraction = np.count_nonzero(ndwi>0)/np.count_nonzero(ndwi>otsu_thr)
-            if fraction < 0.9:
+            n_water = np.count_nonzero(ndwi>otsu_thr)
+            if n_water > 0 and np.count_nonzero(ndwi>0)/n_water < 0.9:
                 otsu_thr = 0.0
                 status = 3
         else:
@@ -95,116 +334,460 @@ def get_water_mask_from_S2(ndwi, canny_sigma=4, canny_threshold=0.3, selem=disk(
             
             # if majority of pixels above threshold have negative NDWI values
             # change the threshold to 0.0
-            fraction = np.count_nonzero(ndwi>0)/np.count_nonzero(ndwi>otsu_thr)
-            if fraction < 0.9:
+            n_water = np.count_nonzero(ndwi>otsu_thr)
+            if n_water > 0 and np.count_nonzero(ndwi>0)/n_water < 0.9:
                 otsu_thr = 0.0
                 status = 4
 
     return status, (ndwi>otsu_thr).astype(np.uint8)
 
-def get_water_level_optical(timestamp, ndwi, dam_poly, dam_bbox, simplify=True):
+def get_water_level_optical(timestamp, ndwi, dam_poly, dam_bbox, simplify=True, dam_context=None):
     """
-    Run water detection algorithm for an NDWI image.
+    Run water detection algorithm for an NDWI image. Returns None if no water is detected.
     """
     water_det_status, water_mask = get_water_mask_from_S2(ndwi)
-    measured_water_extent = get_water_extent(water_mask, dam_poly, dam_bbox, simplify)
+    measured_water_extent = get_water_extent(water_mask, dam_poly, dam_bbox, simplify, dam_context=dam_context)
+    if measured_water_extent is None:
+        return None
     
     return {'alg_status':water_det_status,
             'water_level':measured_water_extent.area/dam_poly.area,
             'geometry':measured_water_extent}
 
-def extract_surface_water_area_per_frame(dam_id, dam_poly, dam_bbox, date, resx, resy):
+@timed('request_setup')
+def get_ndwi_request(dam_bbox, time, resx, resy, encoding=None):
     """
-    Run water detection algorithm for a single timestamp.
+    Initialises the NDWI request. Time can be a single date string or a time interval. With encoding ('UINT8' or
+    'UINT16') NDWI and data mask are packed into a single integer band, see `decode_ndwi`.
     """
-    measurement = get_new_measurement_entry(dam_id, date, WaterDetectionSensor.S2_NDWI, S2_WATER_DETECTOR_VERSION)
-    
-    # initialise requests
-    try:
-        wcs_ndwi_request = WcsRequest(layer='NDWI', bbox=dam_bbox, time=date.strftime('%Y-%m-%d'), maxcc=S2_MAX_CC,
-                                      resx=f'{resx}m', resy=f'{resy}m', image_format=MimeType.TIFF_d32f, 
-                                      time_difference=timedelta(hours=2),
-                                      custom_url_params={CustomUrlParam.SHOWLOGO: False,
-                                                         CustomUrlParam.TRANSPARENT: True})
-
-        cloudresx, cloudresy = get_optimal_cloud_resolution(resx, resy)   
-        wcs_bands_request = WcsRequest(layer='NDWI', bbox=dam_bbox, time=date.strftime('%Y-%m-%d'), maxcc=S2_MAX_CC,
-                                       resx=f'{cloudresx}m', resy=f'{cloudresy}m', image_format=MimeType.TIFF_d32f,
-                                       time_difference=timedelta(hours=2),
-                                       custom_url_params={CustomUrlParam.EVALSCRIPT: S2_CLOUD_BANDS_SCRIPT_V3})
-
-    except (RuntimeError, DownloadFailedException):
-        set_measurement_status(measurement, WaterDetectionStatus.SH_REQUEST_ERROR)
+    if encoding is not None:
+        return WcsRequest(layer='NDWI', bbox=dam_bbox, time=time, maxcc=S2_MAX_CC,
+                          resx=f'{resx}m', resy=f'{resy}m', image_format=S2_NDWI_ENCODINGS[encoding][0],
+                          time_difference=timedelta(hours=2),
+                          custom_url_params={CustomUrlParam.EVALSCRIPT: get_ndwi_compact_script(encoding),
+                                             CustomUrlParam.SHOWLOGO: False})
+
+    return WcsRequest(layer='NDWI', bbox=dam_bbox, time=time, maxcc=S2_MAX_CC,
+                      resx=f'{resx}m', resy=f'{resy}m', image_format=MimeType.TIFF_d32f, 
+                      time_difference=timedelta(hours=2),
+                      custom_url_params={CustomUrlParam.SHOWLOGO: False,
+                                         CustomUrlParam.TRANSPARENT: True})
+
+@timed('request_setup')
+def get_cloud_bands_request(dam_bbox, time, resx, resy, compact=False):
+    """
+    Initialises the request for bands used by cloud detector. Time can be a single date string or a time interval.
+    With `compact` the bands are transferred as 16-bit digital numbers, see `decode_cloud_bands`.
+    """
+    cloudresx, cloudresy = get_optimal_cloud_resolution(resx, resy)
+    return WcsRequest(layer='NDWI', bbox=dam_bbox, time=time, maxcc=S2_MAX_CC,
+                      resx=f'{cloudresx}m', resy=f'{cloudresy}m',
+                      image_format=MimeType.TIFF_d16 if compact else MimeType.TIFF_d32f,
+                      time_difference=timedelta(hours=2),
+                      custom_url_params={CustomUrlParam.EVALSCRIPT: S2_CLOUD_BANDS_COMPACT_SCRIPT_V3 if compact
+                                                                    else S2_CLOUD_BANDS_SCRIPT_V3})
+
+def set_water_level_optical(measurement, date, ndwi, dam_poly, dam_bbox, simplify=True, dam_context=None):
+    """
+    Runs water detection on a frame which passed the data validity and cloud coverage checks and stores the
+    result in the measurement. Without detected water the status is INVALID_POLYGON.
+    """
+    result = get_water_level_optical(date, ndwi, dam_poly, dam_bbox, simplify=simplify, dam_context=dam_context)
+    if result is None:
+        set_measurement_status(measurement, WaterDetectionStatus.INVALID_POLYGON)
         return measurement
-     
-    # download NDWI
+
+    set_measurement_status(measurement, WaterDetectionStatus.MEASUREMENT_VALID)
+    measurement.SURF_WATER_LEVEL = result['water_level']
+    measurement.GEOMETRY = result['geometry'].wkt
+    measurement.ALG_STATUS = result['alg_status']
+
+    return measurement
+
+def preload_cloud_detector(threshold=S2_CLOUD_THRESHOLD):
+    """
+    Imports s2cloudless and loads the cloud classifier of this process, e.g. when a worker process starts, so that
+    the first frame doesn't pay for it.
+    """
+    return get_cloud_detection_service(threshold).preload()
+
+@timed('cloud_detection')
+def get_cloud_coverage(cloud_bands, frames_idx, threshold=S2_CLOUD_THRESHOLD):
+    """
+    Runs cloud detection on the selected frames of stacked cloud bands (last band is data mask) and returns 
+    cloud coverage per selected frame. Invalid pixels are not considered cloudy. Frames are classified in batches
+    by the cloud detection service of this process, see `cloud_detection.CloudDetectionService`.
+    """
+    return get_cloud_detection_service(threshold).get_cloud_coverage([cloud_bands[idx] for idx in frames_idx])
+
+class TransferStats:
+    """
+    Number of requests and bytes downloaded, and of NDWI requests and bytes saved by cloud-first screening.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self.requests_saved = 0
+        self.bytes_saved = 0
+
+    def add_download(self, data):
+        self.requests += 1
+        self.bytes += data.nbytes
+
+    def add_skipped_ndwi(self, cloud_bands_shape, resx, resy, encoding=None):
+        """
+        Counts a skipped NDWI download, its size is estimated from the shape of cloud bands.
+        """
+        cloudresx, cloudresy = get_optimal_cloud_resolution(resx, resy)
+        height = int(round(cloud_bands_shape[0]*cloudresy/resy))
+        width = int(round(cloud_bands_shape[1]*cloudresx/resx))
+        pixel_bytes = 2*np.dtype(np.float32).itemsize if encoding is None else np.dtype(encoding.lower()).itemsize
+        self.requests_saved += 1
+        self.bytes_saved += height*width*pixel_bytes
+
+    def __str__(self):
+        return (f'{self.requests} requests ({self.bytes/2**20:.1f} MB) downloaded, '
+                f'{self.requests_saved} requests ({self.bytes_saved/2**20:.1f} MB) saved')
+
+def download_ndwi(measurement, dam_bbox, date_str, resx, resy, tile_cache=None, stats=None, encoding=None):
+    """
+    Downloads NDWI for a single timestamp and checks data validity. Returns the NDWI data if it is valid, otherwise
+    sets the measurement status and returns None. With encoding, compact data is downloaded (and cached) and
+    decoded afterwards.
+    """
     try:
-        ndwi = np.asarray(wcs_ndwi_request.get_data())
-    except (DownloadFailedException, ImageDecodingError):
+        with stage('ndwi_download'):
+            ndwi = get_request_data(lambda: get_ndwi_request(dam_bbox, date_str, resx, resy, encoding), tile_cache,
+                                    layer='NDWI', evalscript=encoding and get_ndwi_compact_script(encoding),
+                                    bbox=dam_bbox, resx=resx, resy=resy, date=date_str, maxcc=S2_MAX_CC)
+    except (RuntimeError, DownloadFailedException, ImageDecodingError):
         set_measurement_status(measurement, WaterDetectionStatus.SH_REQUEST_ERROR)
-        return measurement
+        return None
+
+    if stats is not None:
+        stats.add_download(ndwi)
+    add_bytes('ndwi', ndwi.nbytes)
 
     if len(ndwi)==0:
         set_measurement_status(measurement, WaterDetectionStatus.SH_NO_DATA)
-        return measurement
-    
+        return None
+
+    if encoding is not None:
+        with stage('decode'):
+            ndwi = decode_ndwi(ndwi, encoding)
+    track_array(ndwi)
+
     # check that image has no INVALID PIXELS
     valid_pxs_frac = np.count_nonzero(ndwi[...,1])/np.size(ndwi[...,1])
     if valid_pxs_frac < S2_MIN_VALID_FRACTION:
         del ndwi
         set_measurement_status(measurement, WaterDetectionStatus.INVALID_DATA)
-        return measurement
+        return None
 
-    # run cloud detection
+    return ndwi
+
+def download_cloud_bands(measurement, dam_bbox, date_str, resx, resy, tile_cache=None, stats=None, compact=False):
+    """
+    Downloads cloud bands for a single timestamp. Returns None and sets the measurement status if there is no data.
+    With `compact` the bands are downloaded (and cached) as digital numbers and decoded afterwards.
+    """
+    cloudresx, cloudresy = get_optimal_cloud_resolution(resx, resy)
+    evalscript = S2_CLOUD_BANDS_COMPACT_SCRIPT_V3 if compact else S2_CLOUD_BANDS_SCRIPT_V3
     try:
-        all_cloud_masks = CloudMaskRequest(ogc_request=wcs_bands_request, threshold=0.4)
-        cloud_mask = all_cloud_masks.get_cloud_masks()
-    except (DownloadFailedException, ImageDecodingError):
+        with stage('cloud_download'):
+            cloud_bands = get_request_data(lambda: get_cloud_bands_request(dam_bbox, date_str, resx, resy, compact),
+                                           tile_cache, layer='NDWI', evalscript=evalscript, bbox=dam_bbox,
+                                           resx=cloudresx, resy=cloudresy, date=date_str, maxcc=S2_MAX_CC)
+    except (RuntimeError, DownloadFailedException, ImageDecodingError):
         set_measurement_status(measurement, WaterDetectionStatus.SH_REQUEST_ERROR)
-        return measurement
+        return None
 
-    if len(ndwi)==0:
+    if stats is not None:
+        stats.add_download(cloud_bands)
+    add_bytes('cloud_bands', cloud_bands.nbytes)
+
+    if len(cloud_bands)==0:
         set_measurement_status(measurement, WaterDetectionStatus.SH_NO_CLOUD_DATA)
-        return measurement
+        return None
+
+    if compact:
+        with stage('decode'):
+            cloud_bands = decode_cloud_bands(cloud_bands)
+    track_array(cloud_bands)
+
+    return cloud_bands
+
+def get_frame_data(measurement, dam_bbox, date, resx, resy, tile_cache=None, cloud_first=False, stats=None,
+                   encoding=None):
+    """
+    Downloads NDWI and cloud bands for a single timestamp and checks data validity and cloud coverage. 
+    Returns the NDWI band if the frame passed the checks, otherwise sets the measurement status and returns None.
+    If tile cache is given, cached rasters are used instead of downloading.
+
+    With `cloud_first` the low resolution cloud bands are checked first and NDWI is downloaded only for frames which
+    are not too cloudy. Such frames are reported as TOO_CLOUDY even if their NDWI data is invalid.
+
+    With encoding ('UINT8' or 'UINT16') NDWI and cloud bands are transferred as integers instead of floats.
+    """
+    date_str = date.strftime('%Y-%m-%d')
+    
+    ndwi = None
+    if not cloud_first:
+        ndwi = download_ndwi(measurement, dam_bbox, date_str, resx, resy, tile_cache=tile_cache, stats=stats,
+                             encoding=encoding)
+        if ndwi is None:
+            return None
+
+    # run cloud detection
+    cloud_bands = download_cloud_bands(measurement, dam_bbox, date_str, resx, resy, tile_cache=tile_cache,
+                                       stats=stats, compact=encoding is not None)
+    if cloud_bands is None:
+        return None
           
     # check cloud coverage
-    cloud_cov = np.count_nonzero(cloud_mask)/np.size(cloud_mask)
+    cloud_cov = get_cloud_coverage(cloud_bands, [0])[0]
     if cloud_cov > S2_MAX_CLOUD_COVERAGE:
-        del cloud_mask, all_cloud_masks
+        if cloud_first and stats is not None:
+            stats.add_skipped_ndwi(cloud_bands.shape[1:3], resx, resy, encoding=encoding)
+        del cloud_bands
         set_measurement_status(measurement, WaterDetectionStatus.TOO_CLOUDY)
-        return measurement
+        return None
+    del cloud_bands
+
+    if cloud_first:
+        ndwi = download_ndwi(measurement, dam_bbox, date_str, resx, resy, tile_cache=tile_cache, stats=stats,
+                             encoding=encoding)
+        if ndwi is None:
+            return None
   
     measurement.CLOUD_COVERAGE = cloud_cov
-    try:
-        # run water detction algorithm
-        result = get_water_level_optical(date, ndwi[0,...,0], dam_poly, dam_bbox, simplify=True)
-        
-        set_measurement_status(measurement, WaterDetectionStatus.MEASUREMENT_VALID)
-        measurement.SURF_WATER_LEVEL = result['water_level']
-        measurement.GEOMETRY = result['geometry'].wkt
-        measurement.ALG_STATUS = result['alg_status']
-        
-        del result
-    except AttributeError:
-        set_measurement_status(measurement, WaterDetectionStatus.INVALID_POLYGON)
     
-    del ndwi, cloud_mask, all_cloud_masks, wcs_ndwi_request, wcs_bands_request 
+    return ndwi[0,...,0]
+
+def extract_surface_water_area_per_frame(dam_id, dam_poly, dam_bbox, date, resx, resy, tile_cache=None,
+                                         dam_context=None, cloud_first=False, stats=None, encoding=None):
+    """
+    Run water detection algorithm for a single timestamp. Dam context built once per waterbody can be passed
+    to reuse its static data across dates. If profiling is enabled, stage timings are recorded per measurement.
+    """
+    measurement = get_new_measurement_entry(dam_id, date, WaterDetectionSensor.S2_NDWI, S2_WATER_DETECTOR_VERSION)
+
+    with record(dam_id=dam_id, date=date):
+        ndwi = get_frame_data(measurement, dam_bbox, date, resx, resy, tile_cache=tile_cache,
+                              cloud_first=cloud_first, stats=stats, encoding=encoding)
+        if ndwi is not None:
+            # run water detction algorithm
+            set_water_level_optical(measurement, date, ndwi, dam_poly, dam_bbox, simplify=True,
+                                    dam_context=dam_context)
+            del ndwi
     
     return measurement
 
-def surface_water_area_with_dem_veto(measurement, the_dam_nominal, the_dam_bbox, resx, resy, dem_threshold):
+def extract_surface_water_area_time_series(dam_id, dam_poly, time_interval, dam_bbox=None, resx=None, resy=None,
+                                           simplify=True, dam_context=None):
+    """
+    Run water detection algorithm for all available timestamps in the time interval.
+
+    NDWI and cloud bands for all dates are downloaded as two stacked arrays. Data validity and cloud coverage are
+    checked along the time axis and water detection is run only on frames that pass both checks. Measurements
+    are yielded in chronological order, including the rejected frames with the corresponding status.
+    """
+    if dam_context is not None:
+        dam_bbox, resx, resy = dam_context.dam_bbox, dam_context.resx, dam_context.resy
+    if dam_bbox is None:
+        dam_bbox = get_bbox(dam_poly)
+    if resx is None or resy is None:
+        resx, resy = get_optimal_resolution(dam_bbox)
+
+    wcs_ndwi_request = get_ndwi_request(dam_bbox, time_interval, resx, resy)
+    wcs_bands_request = get_cloud_bands_request(dam_bbox, time_interval, resx, resy)
+    dates = wcs_ndwi_request.get_dates()
+    
+    measurements = [get_new_measurement_entry(dam_id, date, WaterDetectionSensor.S2_NDWI, S2_WATER_DETECTOR_VERSION)
+                    for date in dates]
+    if len(measurements)==0:
+        return
+
+    # download NDWI for all dates
+    try:
+        ndwi = np.asarray(download(wcs_ndwi_request))
+    except (DownloadFailedException, ImageDecodingError):
+        for measurement in measurements:
+            set_measurement_status(measurement, WaterDetectionStatus.SH_REQUEST_ERROR)
+            yield measurement
+        return
+
+    if len(ndwi)!=len(measurements):
+        for measurement in measurements:
+            set_measurement_status(measurement, WaterDetectionStatus.SH_NO_DATA)
+            yield measurement
+        return
+
+    # check that images have no INVALID PIXELS
+    valid_pxs_frac = np.count_nonzero(ndwi[...,1], axis=(1, 2))/np.prod(ndwi.shape[1:3])
+    valid_idx = np.flatnonzero(valid_pxs_frac >= S2_MIN_VALID_FRACTION)
+
+    # download cloud bands and run cloud detection only on valid frames
+    cloud_cov = np.ones(len(measurements))
+    cloud_status = None
+    if len(valid_idx) > 0:
+        try:
+            cloud_bands = np.asarray(download(wcs_bands_request))
+            if len(cloud_bands)!=len(measurements):
+                cloud_status = WaterDetectionStatus.SH_NO_CLOUD_DATA
+            else:
+                cloud_cov[valid_idx] = get_cloud_coverage(cloud_bands, valid_idx)
+            del cloud_bands
+        except (DownloadFailedException, ImageDecodingError):
+            cloud_status = WaterDetectionStatus.SH_REQUEST_ERROR
+
+    for idx, (date, measurement) in enumerate(zip(dates, measurements)):
+        if valid_pxs_frac[idx] < S2_MIN_VALID_FRACTION:
+            set_measurement_status(measurement, WaterDetectionStatus.INVALID_DATA)
+        elif cloud_status is not None:
+            set_measurement_status(measurement, cloud_status)
+        elif cloud_cov[idx] > S2_MAX_CLOUD_COVERAGE:
+            set_measurement_status(measurement, WaterDetectionStatus.TOO_CLOUDY)
+        else:
+            measurement.CLOUD_COVERAGE = cloud_cov[idx]
+            set_water_level_optical(measurement, date, ndwi[idx,...,0], dam_poly, dam_bbox, simplify=simplify,
+                                    dam_context=dam_context)
+        
+        yield measurement
+
+    del ndwi
+
+def extract_surface_water_area_cloud_first(dam_id, dam_poly, time_interval, dam_bbox=None, resx=None, resy=None,
+                                           simplify=True, dam_context=None, tile_cache=None, stats=None,
+                                           encoding=None):
+    """
+    Run water detection algorithm for all available timestamps in the time interval, screening clouds first.
+
+    Low resolution cloud bands for all dates are downloaded with a single request and full resolution NDWI is
+    downloaded only for frames which are not too cloudy. Measurements are yielded in chronological order. Requests
+    and bytes downloaded and saved compared to per-frame extraction are accumulated in `stats` (`TransferStats`).
+    With encoding ('UINT8' or 'UINT16') NDWI and cloud bands are transferred as integers instead of floats.
+    """
+    if dam_context is not None:
+        dam_bbox, resx, resy = dam_context.dam_bbox, dam_context.resx, dam_context.resy
+    if dam_bbox is None:
+        dam_bbox = get_bbox(dam_poly)
+    if resx is None or resy is None:
+        resx, resy = get_optimal_resolution(dam_bbox)
+    if stats is None:
+        stats = TransferStats()
+
+    wcs_bands_request = get_cloud_bands_request(dam_bbox, time_interval, resx, resy, compact=encoding is not None)
+    dates = wcs_bands_request.get_dates()
+
+    measurements = [get_new_measurement_entry(dam_id, date, WaterDetectionSensor.S2_NDWI, S2_WATER_DETECTOR_VERSION)
+                    for date in dates]
+    if len(measurements)==0:
+        return
+
+    # download cloud bands for all dates with a single request
+    try:
+        cloud_bands = np.asarray(download(wcs_bands_request))
+    except (DownloadFailedException, ImageDecodingError):
+        for measurement in measurements:
+            set_measurement_status(measurement, WaterDetectionStatus.SH_REQUEST_ERROR)
+            yield measurement
+        return
+
+    stats.add_download(cloud_bands)
+    stats.requests_saved += len(measurements) - 1
+    if encoding is not None and len(cloud_bands) > 0:
+        cloud_bands = decode_cloud_bands(cloud_bands)
+
+    if len(cloud_bands)!=len(measurements):
+        for measurement in measurements:
+            set_measurement_status(measurement, WaterDetectionStatus.SH_NO_CLOUD_DATA)
+            yield measurement
+        return
+
+    cloud_cov = get_cloud_coverage(cloud_bands, np.arange(len(measurements)))
+    cloud_bands_shape = cloud_bands.shape[1:3]
+    del cloud_bands
+
+    # download NDWI only for frames which are not too cloudy
+    for idx, (date, measurement) in enumerate(zip(dates, measurements)):
+        if cloud_cov[idx] > S2_MAX_CLOUD_COVERAGE:
+            set_measurement_status(measurement, WaterDetectionStatus.TOO_CLOUDY)
+            stats.add_skipped_ndwi(cloud_bands_shape, resx, resy, encoding=encoding)
+        else:
+            ndwi = download_ndwi(measurement, dam_bbox, date.strftime('%Y-%m-%d'), resx, resy, tile_cache=tile_cache,
+                                 stats=stats, encoding=encoding)
+            if ndwi is not None:
+                measurement.CLOUD_COVERAGE = cloud_cov[idx]
+                set_water_level_optical(measurement, date, ndwi[0,...,0], dam_poly, dam_bbox, simplify=simplify,
+                                        dam_context=dam_context)
+                del ndwi
+
+        yield measurement
+
+def surface_water_area_with_dem_veto(measurement, the_dam_nominal, the_dam_bbox, resx, resy, dem_threshold,
+                                     tile_cache=None, dam_context=None):
     water_level_dem = copy_measurement(measurement)
     
     try:
-        dam_vetoed = apply_DEM_veto(get_optical_data(get_DEM_request(the_dam_bbox, resx, resy)),
-                                    the_dam_nominal, loads(measurement.GEOMETRY), the_dam_bbox, resx, resy, 
-                                    dem_threshold, simplify=True)
-        water_level_dem.SURF_WATER_LEVEL = dam_vetoed.area/the_dam_nominal.area
-        water_level_dem.GEOMETRY = dam_vetoed.wkt
-        del dam_vetoed
+        with stage('dem_download'):
+            dem = get_request_data(lambda: get_DEM_request(the_dam_bbox, resx, resy), tile_cache,
+                                   layer='DEM', evalscript=S2_DEM_SCRIPT_V3, bbox=the_dam_bbox, resx=resx, resy=resy,
+                                   date=None, maxcc=None)[0]
+        add_bytes('dem', dem.nbytes)
+        with stage('dem_veto'):
+            dam_vetoed = apply_DEM_veto(dem, the_dam_nominal, loads(measurement.GEOMETRY), the_dam_bbox, resx, resy,
+                                        dem_threshold, simplify=True, dam_context=dam_context)
     except (DownloadFailedException, ImageDecodingError):
         set_measurement_status(water_level_dem, WaterDetectionStatus.SH_REQUEST_ERROR)
-    except AttributeError:
-        set_measurement_status(measurement, WaterDetectionStatus.INVALID_POLYGON)
+        return water_level_dem
+
+    if dam_vetoed is None:
+        set_measurement_status(water_level_dem, WaterDetectionStatus.INVALID_POLYGON)
+    else:
+        water_level_dem.SURF_WATER_LEVEL = dam_vetoed.area/the_dam_nominal.area
+        water_level_dem.GEOMETRY = dam_vetoed.wkt
      
     return water_level_dem
+
+def surface_water_area_with_dem_veto_batch(measurements, the_dam_nominal, the_dam_bbox, resx, resy, dem_threshold,
+                                           tile_cache=None, dam_context=None, dem=None):
+    """
+    Applies DEM veto to a list of measurements of the same dam. DEM is downloaded and the veto mask is computed only
+    once, after which each measurement costs one rasterization and one logical AND. Returns vetoed copies of the
+    measurements, copies of measurements which are not valid are returned unchanged. An already downloaded DEM of
+    the bbox can be given, e.g. a window of a shared footprint (see `spatial_grouping.get_group_dem`).
+    """
+    water_levels_dem = [copy_measurement(measurement) for measurement in measurements]
+    valid_levels = [water_level_dem for water_level_dem in water_levels_dem 
+                    if water_level_dem.MEAS_STATUS == WaterDetectionStatus.MEASUREMENT_VALID.value]
+    if len(valid_levels)==0:
+        return water_levels_dem
+    
+    if dem is None:
+        try:
+            with stage('dem_download'):
+                dem = get_request_data(lambda: get_DEM_request(the_dam_bbox, resx, resy), tile_cache,
+                                       layer='DEM', evalscript=S2_DEM_SCRIPT_V3, bbox=the_dam_bbox, resx=resx,
+                                       resy=resy, date=None, maxcc=None)[0]
+        except (RuntimeError, DownloadFailedException, ImageDecodingError):
+            for water_level_dem in valid_levels:
+                set_measurement_status(water_level_dem, WaterDetectionStatus.SH_REQUEST_ERROR)
+            return water_levels_dem
+        add_bytes('dem', dem.nbytes)
+
+    with stage('dem_veto'):
+        dem_valid = get_DEM_veto_mask(dem, the_dam_nominal, the_dam_bbox, dem_threshold, dam_context=dam_context)
+    del dem
+
+    for water_level_dem in valid_levels:
+        with stage('dem_veto'):
+            dam_vetoed = apply_DEM_veto_mask(dem_valid, the_dam_nominal, loads(water_level_dem.GEOMETRY),
+                                             the_dam_bbox, simplify=True, dam_context=dam_context)
+        if dam_vetoed is None:
+            set_measurement_status(water_level_dem, WaterDetectionStatus.INVALID_POLYGON)
+            continue
+        water_level_dem.SURF_WATER_LEVEL = dam_vetoed.area/the_dam_nominal.area
+        water_level_dem.GEOMETRY = dam_vetoed.wkt
+    
+    return water_levels_dem
@@ -0,0 +1,401 @@
+""" Module for concurrent processing of many waterbodies. """
+
+import os
+import threading
+import queue
+import time
+from functools import partial
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+
+from sentinelhub import DownloadFailedException
+from sentinelhub.download import ImageDecodingError
+
+from geom_utils import apply_DEM_veto
+from sh_requests import get_S2_dates, get_optical_data, get_DEM_request
+from definitions import WaterDetectionSensor, WaterDetectionStatus, get_new_measurement_entry, set_measurement_status
+from definitions import MeasurementTable, copy_measurement
+from s2_water_extraction import S2_WATER_DETECTOR_VERSION, S2_MAX_CC, get_frame_data, get_water_level_optical
+from s2_water_extraction import preload_cloud_detector
+from profiling import record
+from dam_context import DamContext
+from raster_transport import RasterRing, get_raster
+
+# number of dam contexts (with their rasterized masks) kept by each compute process
+WORKER_DAM_CONTEXTS = 16
+_worker_dam_contexts = OrderedDict()
+
+def fetch_S2_dates(time_interval, dam_bbox, resx, resy):
+    """
+    Default date discovery used by the scheduler.
+    """
+    return get_S2_dates(time_interval, dam_bbox, S2_MAX_CC)
+
+def fetch_DEM(dam_bbox, resx, resy):
+    """
+    Default DEM download used by the scheduler.
+    """
+    return get_optical_data(get_DEM_request(dam_bbox, resx, resy))
+
+def get_worker_dam_context(dam_context):
+    """
+    Returns the dam context already used by this process for the same dam, so its rasterized masks are reused.
+    """
+    key = (dam_context.dam_id, dam_context.dam_poly.wkb)
+    if key in _worker_dam_contexts:
+        _worker_dam_contexts.move_to_end(key)
+        return _worker_dam_contexts[key]
+
+    _worker_dam_contexts[key] = dam_context
+    if len(_worker_dam_contexts) > WORKER_DAM_CONTEXTS:
+        _worker_dam_contexts.popitem(last=False)
+    return dam_context
+
+def compute_water_level(date, ndwi, dam_context, dem=None, dem_threshold=15, simplify=True):
+    """
+    CPU-bound part of the extraction, run in the process pool. Rasters are arrays or handles of a `RasterRing`.
+    Geometries are returned as WKT. Returns None if no water is detected.
+    """
+    dam_context = get_worker_dam_context(dam_context)
+    ndwi, dem = get_raster(ndwi), get_raster(dem)
+    dam_poly, dam_bbox = dam_context.dam_poly, dam_context.dam_bbox
+    result = get_water_level_optical(date, ndwi, dam_poly, dam_bbox, simplify=simplify, dam_context=dam_context)
+    if result is None:
+        return None
+
+    result['geometry_dem'] = None
+    if dem is not None:
+        dam_vetoed = apply_DEM_veto(dem, dam_poly, result['geometry'], dam_bbox, None, None,
+                                    dem_threshold, simplify=simplify, dam_context=dam_context)
+        if dam_vetoed is not None:
+            result['water_level_dem'] = dam_vetoed.area/dam_poly.area
+            result['geometry_dem'] = dam_vetoed.wkt
+
+    result['geometry'] = result['geometry'].wkt
+    return result
+
+class _Frame:
+    """
+    Bookkeeping of a single (dam, date) task.
+    """
+    def __init__(self, dam_key, idx, dam_context, date, dem_future, table):
+        self.dam_key = dam_key
+        self.idx = idx
+        self.dam_context = dam_context
+        self.dam_id = dam_context.dam_id
+        self.date = date
+        self.dem_future = dem_future
+        # measurements of a dam share a table, released once they are consumed
+        self.table = table
+        self.dem_failed = False
+        self.ndwi = None
+        self.submitted = time.perf_counter()
+        self.compute_start = None
+        self.download_time = 0.0
+        self.compute_time = 0.0
+
+class SchedulerStats:
+    """
+    Throughput and latency summary of a scheduler run. Latencies are in seconds.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.end = None
+        self.n_dams = 0
+        self.n_failed_dams = 0
+        self.n_skipped = 0
+        self.n_frames = 0
+        self.n_valid = 0
+        self.download_times = []
+        self.compute_times = []
+        self.latencies = []
+
+    def add_frame(self, frame, measurement):
+        self.n_frames += 1
+        if measurement.MEAS_STATUS == WaterDetectionStatus.MEASUREMENT_VALID.value:
+            self.n_valid += 1
+        self.download_times.append(frame.download_time)
+        self.compute_times.append(frame.compute_time)
+        self.latencies.append(time.perf_counter() - frame.submitted)
+
+    @staticmethod
+    def _percentiles(values):
+        if len(values)==0:
+            return {'p50': 0.0, 'p90': 0.0, 'p99': 0.0, 'max': 0.0}
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        return {'p50': p50, 'p90': p90, 'p99': p99, 'max': max(values)}
+
+    def summary(self):
+        wall_time = (self.end or time.perf_counter()) - self.start
+        return {'dams': self.n_dams,
+                'failed_dams': self.n_failed_dams,
+                'skipped_frames': self.n_skipped,
+                'frames': self.n_frames,
+                'valid_frames': self.n_valid,
+                'wall_time': wall_time,
+                'frames_per_second': self.n_frames/wall_time if wall_time > 0 else 0.0,
+                'download': self._percentiles(self.download_times),
+                'compute': self._percentiles(self.compute_times),
+                'latency': self._percentiles(self.latencies)}
+
+    def __str__(self):
+        summary = self.summary()
+        lines = [f"{summary['dams']} dams ({summary['failed_dams']} failed), {summary['frames']} frames "
+                 f"({summary['valid_frames']} valid, {summary['skipped_frames']} skipped) in {summary['wall_time']:.1f}s, "
+                 f"{summary['frames_per_second']:.2f} frames/s"]
+        for stage in ['download', 'compute', 'latency']:
+            lines.append(f"{stage:>8}: " + ', '.join(f'{k}={v:.3f}s' for k, v in summary[stage].items()))
+        return '\n'.join(lines)
+
+class CatalogueScheduler:
+    """
+    Runs water detection for a list of waterbodies over a time interval.
+
+    Network-bound work (date discovery, NDWI, cloud bands and DEM downloads, cloud detection) runs in a thread pool
+    and CPU-bound work (water mask, water extent, DEM veto) in a process pool. At most `max_pending` frames are in
+    flight at any time. Measurements of each dam are yielded in chronological order, while different dams are
+    interleaved as they complete. If `dem_threshold` is set, each valid measurement is followed by a copy with
+    DEM veto applied. If `measurement_index` (see `incremental.MeasurementIndex`) is given, only dates which need
+    (re)processing are scheduled.
+
+    If `shared_rasters` is set, NDWI and DEM rasters are passed to the process pool through a ring of shared
+    buffers (see `raster_transport.RasterRing`) instead of being pickled. Each DEM is shared by all frames of its
+    dam. Buffers are released when the measurements of a frame are complete.
+
+    Download functions can be replaced (e.g. with a local fake Sentinel Hub responder):
+        * fetch_frame(measurement, dam_bbox, date, resx, resy) -> NDWI band or None, as `get_frame_data`
+        * fetch_dates(time_interval, dam_bbox, resx, resy) -> list of dates
+        * fetch_dem(dam_bbox, resx, resy) -> DEM band
+    """
+    def __init__(self, time_interval, n_download_workers=8, n_compute_workers=None, max_pending=32,
+                 dem_threshold=None, simplify=True, fetch_frame=get_frame_data, fetch_dates=fetch_S2_dates,
+                 fetch_dem=fetch_DEM, measurement_index=None, shared_rasters=False):
+        self.time_interval = time_interval
+        self.n_download_workers = n_download_workers
+        self.n_compute_workers = n_compute_workers
+        self.max_pending = max_pending
+        self.dem_threshold = dem_threshold
+        self.simplify = simplify
+        self.fetch_frame = fetch_frame
+        self.fetch_dates = fetch_dates
+        self.fetch_dem = fetch_dem
+        self.measurement_index = measurement_index
+        self.shared_rasters = shared_rasters
+        self.raster_ring = None
+        self.stats = None
+
+    def run(self, dams):
+        """
+        Processes a list of (dam_id, polygon) pairs and yields measurements as they complete. Summary of the run
+        is available in `stats` once the generator is exhausted. An error of scheduling (e.g. an invalid dam
+        polygon) stops the run and is raised by the generator.
+        """
+        self.stats = SchedulerStats()
+        if self.fetch_frame is get_frame_data:
+            # load the cloud classifier once, before download threads would race to load it on their first frames
+            preload_cloud_detector()
+        results = queue.Queue()
+        slots = threading.BoundedSemaphore(self.max_pending)
+        stop = threading.Event()
+        if self.shared_rasters:
+            # a slot for each frame in flight and for DEMs of dams being downloaded
+            self.raster_ring = RasterRing(n_slots=self.max_pending + self.n_download_workers)
+
+        n_compute_workers = self.n_compute_workers or os.cpu_count() or 1
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.n_download_workers) as download_pool, \
+                 ProcessPoolExecutor(max_workers=n_compute_workers) as compute_pool:
+                # workers are forked on first submits, start them before download threads could hold locks
+                # (e.g. of GDAL) which forked workers would inherit locked
+                for future in [compute_pool.submit(os.getpid) for _ in range(n_compute_workers)]:
+                    future.result()
+                producer = threading.Thread(target=self._produce,
+                                            args=(dams, download_pool, compute_pool, slots, results, stop),
+                                            daemon=True)
+                producer.start()
+                try:
+                    yield from self._consume(results, slots)
+                finally:
+                    stop.set()
+                    producer.join()
+                    self.stats.end = time.perf_counter()
+        finally:
+            if self.raster_ring is not None:
+                self.raster_ring.close()
+
+    def _produce(self, dams, download_pool, compute_pool, slots, results, stop):
+        try:
+            for dam_key, (dam_id, dam_poly) in enumerate(dams):
+                if stop.is_set():
+                    return
+
+                dam_context = DamContext(dam_id, dam_poly)
+                dam_bbox, resx, resy = dam_context.dam_bbox, dam_context.resx, dam_context.resy
+                try:
+                    dates = self.fetch_dates(self.time_interval, dam_bbox, resx, resy)
+                except (RuntimeError, DownloadFailedException):
+                    dates = []
+                    self.stats.n_failed_dams += 1
+                if self.measurement_index is not None:
+                    n_dates = len(dates)
+                    dates = self.measurement_index.get_dates_to_process(dam_id, dates)
+                    self.stats.n_skipped += n_dates - len(dates)
+                self.stats.n_dams += 1
+                results.put(('dam', dam_key, len(dates)))
+
+                dem_future = None
+                if self.dem_threshold is not None and len(dates) > 0:
+                    dem_future = download_pool.submit(self._download_dem, dam_bbox, resx, resy, len(dates))
+
+                table = MeasurementTable(capacity=len(dates)*(1 if self.dem_threshold is None else 2))
+                for idx, date in enumerate(dates):
+                    # backpressure: wait until a slot is released by the consumer
+                    while not slots.acquire(timeout=0.1):
+                        if stop.is_set():
+                            return
+                    frame = _Frame(dam_key, idx, dam_context, date, dem_future, table)
+                    future = download_pool.submit(self._download, frame)
+                    future.add_done_callback(partial(self._downloaded, frame, compute_pool, results))
+        except Exception as exception:
+            results.put(('error', exception))
+        finally:
+            results.put(('done',))
+
+    def _download_dem(self, dam_bbox, resx, resy, n_frames):
+        dem = self.fetch_dem(dam_bbox, resx, resy)
+        if self.raster_ring is None:
+            return dem
+        return self.raster_ring.put(dem, refs=n_frames)
+
+    def _release_dem(self, dem_future):
+        if not dem_future.cancelled() and dem_future.exception() is None:
+            self.raster_ring.release(dem_future.result())
+
+    def _release(self, frame):
+        """
+        Releases shared rasters of a completed frame.
+        """
+        if self.raster_ring is None:
+            return
+        self.raster_ring.release(frame.ndwi)
+        frame.ndwi = None
+        if frame.dem_future is not None:
+            frame.dem_future.add_done_callback(self._release_dem)
+
+    def _download(self, frame):
+        start = time.perf_counter()
+        measurement = get_new_measurement_entry(frame.dam_id, frame.date, WaterDetectionSensor.S2_NDWI,
+                                                S2_WATER_DETECTOR_VERSION, table=frame.table)
+        dam_context = frame.dam_context
+        # download stages of the frame are profiled as one measurement
+        with record(dam_id=frame.dam_id, date=frame.date):
+            ndwi = self.fetch_frame(measurement, dam_context.dam_bbox, frame.date, dam_context.resx,
+                                    dam_context.resy)
+
+        dem = None
+        if ndwi is not None and frame.dem_future is not None:
+            try:
+                dem = frame.dem_future.result()
+            except (DownloadFailedException, ImageDecodingError):
+                frame.dem_failed = True
+
+        frame.download_time = time.perf_counter() - start
+        return measurement, ndwi, dem
+
+    def _downloaded(self, frame, compute_pool, results, future):
+        try:
+            measurement, ndwi, dem = future.result()
+        except Exception:
+            # unexpected failure, measurement keeps UNKNOWN_ERROR status
+            self._release(frame)
+            results.put(('frame', frame, [get_new_measurement_entry(frame.dam_id, frame.date,
+                                                                    WaterDetectionSensor.S2_NDWI,
+                                                                    S2_WATER_DETECTOR_VERSION,
+                                                                    table=frame.table)]))
+            return
+
+        if ndwi is None:
+            self._release(frame)
+            results.put(('frame', frame, [measurement]))
+            return
+
+        try:
+            if self.raster_ring is not None:
+                ndwi = frame.ndwi = self.raster_ring.put(ndwi)
+
+            frame.compute_start = time.perf_counter()
+            compute_future = compute_pool.submit(compute_water_level, frame.date, ndwi, frame.dam_context,
+                                                 dem, self.dem_threshold, self.simplify)
+        except Exception:
+            # e.g. compute pool was shut down after the consumer stopped, measurement keeps UNKNOWN_ERROR status
+            self._release(frame)
+            results.put(('frame', frame, [measurement]))
+            return
+        compute_future.add_done_callback(partial(self._computed, frame, measurement, results))
+
+    def _computed(self, frame, measurement, results, future):
+        frame.compute_time = time.perf_counter() - frame.compute_start
+        self._release(frame)
+        try:
+            result = future.result()
+        except Exception:
+            results.put(('frame', frame, [measurement]))
+            return
+
+        if result is None:
+            set_measurement_status(measurement, WaterDetectionStatus.INVALID_POLYGON)
+            results.put(('frame', frame, [measurement]))
+            return
+
+        set_measurement_status(measurement, WaterDetectionStatus.MEASUREMENT_VALID)
+        measurement.SURF_WATER_LEVEL = result['water_level']
+        measurement.GEOMETRY = result['geometry']
+        measurement.ALG_STATUS = result['alg_status']
+        measurements = [measurement]
+
+        if self.dem_threshold is not None:
+            water_level_dem = copy_measurement(measurement)
+            water_level_dem.SENSOR_TYPE = WaterDetectionSensor.S2_NDWI_DEM.value
+            if frame.dem_failed:
+                set_measurement_status(water_level_dem, WaterDetectionStatus.SH_REQUEST_ERROR)
+            elif result['geometry_dem'] is None:
+                set_measurement_status(water_level_dem, WaterDetectionStatus.INVALID_POLYGON)
+            else:
+                water_level_dem.SURF_WATER_LEVEL = result['water_level_dem']
+                water_level_dem.GEOMETRY = result['geometry_dem']
+            measurements.append(water_level_dem)
+
+        results.put(('frame', frame, measurements))
+
+    def _consume(self, results, slots):
+        expected = {}
+        next_idx = {}
+        buffers = {}
+        producer_done = False
+
+        while not producer_done or any(next_idx[key] < expected[key] for key in expected):
+            message = results.get()
+            if message[0] == 'done':
+                producer_done = True
+            elif message[0] == 'error':
+                raise message[1]
+            elif message[0] == 'dam':
+                _, dam_key, n_frames = message
+                expected[dam_key] = n_frames
+                next_idx[dam_key] = 0
+                buffers[dam_key] = {}
+            else:
+                _, frame, measurements = message
+                buffers[frame.dam_key][frame.idx] = (frame, measurements)
+
+                # emit completed frames of this dam in chronological order
+                buffer = buffers[frame.dam_key]
+                while next_idx[frame.dam_key] in buffer:
+                    done_frame, done_measurements = buffer.pop(next_idx[frame.dam_key])
+                    next_idx[frame.dam_key] += 1
+                    self.stats.add_frame(done_frame, done_measurements[0])
+                    slots.release()
+                    yield from done_measurements
@@ -0,0 +1,273 @@
+""" Module for executing Sentinel Hub requests over a shared HTTP session with rate limiting and retries. """
+
+import time
+import random
+import logging
+import threading
+from datetime import datetime
+from urllib.parse import urlparse, urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+import sentinelhub
+from sentinelhub import DownloadFailedException, SHConfig, ServiceType, DataSource, MimeType, CRS
+from sentinelhub.download import decode_data
+from sentinelhub.time_utils import parse_time_interval
+
+LOGGER = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_default_client = None
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing `rate` requests per second on average and bursts of up to `capacity` requests.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token, waiting until one is available.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated)*self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens)/self.rate
+            time.sleep(wait)
+
+def get_endpoint(url):
+    """
+    Returns the endpoint name used in statistics, i.e. host and service path without instance ID,
+    e.g. 'services.sentinel-hub.com/ogc/wcs'.
+    """
+    parsed = urlparse(url)
+    return '/'.join([parsed.netloc] + [part for part in parsed.path.split('/') if part][:2])
+
+class RequestClient:
+    """
+    Executes HTTP requests over a pooled keep-alive session shared by all threads. The number of concurrent requests
+    is limited to `max_concurrency` and, if `requests_per_second` is given, the request rate is limited by a token
+    bucket. Connection errors, timeouts and responses with retryable statuses are retried up to `max_retries` times
+    with jittered exponential backoff, a `Retry-After` header of the response is respected.
+
+    Request, retry and error counts and latencies are collected per endpoint, see `summary`.
+    """
+    def __init__(self, max_concurrency=8, requests_per_second=None, burst=None, max_retries=5, backoff=1.0,
+                 max_backoff=60.0, timeout=120, retry_statuses=RETRY_STATUSES, session=None):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.retry_statuses = set(retry_statuses)
+
+        self.session = session or requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._rate_limiter = TokenBucket(requests_per_second, burst) if requests_per_second else None
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def _get_stats(self, endpoint):
+        with self._stats_lock:
+            if endpoint not in self._stats:
+                self._stats[endpoint] = {'requests': 0, 'retries': 0, 'errors': 0, 'latencies': []}
+            return self._stats[endpoint]
+
+    def _get_sleep_time(self, attempt, response=None):
+        if response is not None and 'Retry-After' in response.headers:
+            try:
+                return min(self.max_backoff, float(response.headers['Retry-After']))
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff, self.backoff*2**attempt))
+
+    def request(self, method, url, **kwargs):
+        """
+        Executes the request and returns the successful response. Raises `requests.RequestException` after all
+        attempts failed or if the error is not retryable.
+        """
+        stats = self._get_stats(get_endpoint(url))
+        kwargs.setdefault('timeout', self.timeout)
+
+        for attempt in range(self.max_retries + 1):
+            if self._rate_limiter is not None:
+                self._rate_limiter.acquire()
+
+            response, error = None, None
+            with self._semaphore:
+                start = time.perf_counter()
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                    response.raise_for_status()
+                except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as exception:
+                    error = exception
+                latency = time.perf_counter() - start
+
+            with self._stats_lock:
+                stats['requests'] += 1
+                stats['latencies'].append(latency)
+                if error is None:
+                    return response
+
+                retryable = response is None or response.status_code in self.retry_statuses
+                if not retryable or attempt == self.max_retries:
+                    stats['errors'] += 1
+                    raise error
+                stats['retries'] += 1
+
+            sleep_time = self._get_sleep_time(attempt, response)
+            LOGGER.debug('Request to %s failed: %s, retrying in %.1fs', url, error, sleep_time)
+            time.sleep(sleep_time)
+
+    def execute(self, download_request):
+        """
+        Executes a sentinelhub `DownloadRequest` and returns the decoded data. Failures are raised as
+        `DownloadFailedException`, as by sentinelhub.
+        """
+        try:
+            if download_request.post_values is not None:
+                response = self.request('POST', download_request.url, json=download_request.post_values,
+                                        headers=download_request.headers)
+            else:
+                response = self.request('GET', download_request.url, headers=download_request.headers)
+        except requests.RequestException as exception:
+            raise DownloadFailedException(f'Failed to download from {download_request.url}: {exception}')
+        return decode_data(response.content, download_request.data_type, entire_response=response)
+
+    def get_json(self, url):
+        """
+        Returns the JSON content of a GET request. Failures are raised as `DownloadFailedException`.
+        """
+        try:
+            return self.request('GET', url).json()
+        except (requests.RequestException, ValueError) as exception:
+            raise DownloadFailedException(f'Failed to download from {url}: {exception}')
+
+    def get_data(self, data_request):
+        """
+        Downloads all data of a sentinelhub `DataRequest` (e.g. `WcsRequest`), equivalent to
+        `data_request.get_data()`.
+        """
+        download_list = data_request.get_download_list()
+        if len(download_list) <= 1:
+            return [self.execute(download_request) for download_request in download_list]
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(download_list))) as executor:
+            return list(executor.map(self.execute, download_list))
+
+    @staticmethod
+    def _percentiles(values):
+        if len(values)==0:
+            return {'p50': 0.0, 'p90': 0.0, 'p99': 0.0, 'max': 0.0}
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        return {'p50': p50, 'p90': p90, 'p99': p99, 'max': max(values)}
+
+    def summary(self):
+        """
+        Returns request, retry and error counts and latency percentiles (in seconds) per endpoint.
+        """
+        with self._stats_lock:
+            return {endpoint: {'requests': stats['requests'],
+                               'retries': stats['retries'],
+                               'errors': stats['errors'],
+                               'latency': self._percentiles(stats['latencies'])}
+                    for endpoint, stats in self._stats.items()}
+
+    def close(self):
+        self.session.close()
+
+def set_default_client(client):
+    """
+    Sets the client used by `download` for all Sentinel Hub requests of this process, None restores downloading
+    by sentinelhub. Returns the previous client.
+    """
+    global _default_client
+    previous, _default_client = _default_client, client
+    return previous
+
+def get_default_client():
+    return _default_client
+
+class WebFeatureService:
+    """
+    Iterator over tiles of the Sentinel Hub WFS service, with the parameters of `sentinelhub.WebFeatureService`.
+    If the default client is set, pages of tiles are requested by it, else (and for Sentinel-1, whose tiles are
+    filtered by product type) the tiles are those of a `sentinelhub.WebFeatureService`. Tiles are collected on the
+    first iteration and reused by the following ones.
+    """
+    def __init__(self, bbox, time_interval, data_source=DataSource.SENTINEL2_L1C, maxcc=1.0, base_url=None,
+                 instance_id=None):
+        self.bbox = bbox
+        self.time_interval = parse_time_interval(time_interval)
+        self.data_source = data_source
+        self.maxcc = maxcc
+        self.base_url = base_url or SHConfig().ogc_base_url
+        self.instance_id = instance_id or SHConfig().instance_id
+        self._tiles = None
+
+    def __iter__(self):
+        if self._tiles is None:
+            if _default_client is None or self.data_source.is_sentinel1():
+                tiles = sentinelhub.WebFeatureService(self.bbox, self.time_interval, data_source=self.data_source,
+                                                      maxcc=self.maxcc, base_url=self.base_url,
+                                                      instance_id=self.instance_id)
+            else:
+                tiles = self._get_pages(_default_client)
+            self._tiles = list(tiles)
+        return iter(self._tiles)
+
+    def _get_pages(self, client):
+        page_size = SHConfig().max_wfs_records_per_query
+        params = {'SERVICE': ServiceType.WFS.value,
+                  'REQUEST': 'GetFeature',
+                  'TYPENAMES': DataSource.get_wfs_typename(self.data_source),
+                  'BBOX': str(self.bbox.reverse()) if self.bbox.crs is CRS.WGS84 else str(self.bbox),
+                  'OUTPUTFORMAT': MimeType.get_string(MimeType.JSON),
+                  'SRSNAME': CRS.ogc_string(self.bbox.crs),
+                  'TIME': f'{self.time_interval[0]}/{self.time_interval[1]}',
+                  'MAXCC': 100.0*self.maxcc,
+                  'MAXFEATURES': page_size}
+
+        offset = 0
+        while True:
+            url = f'{self.base_url}{ServiceType.WFS.value}/{self.instance_id}?' \
+                  f'{urlencode(dict(params, FEATURE_OFFSET=offset))}'
+            features = client.get_json(url)['features']
+            yield from features
+            if len(features) < page_size:
+                return
+            offset += page_size
+
+    def get_dates(self):
+        """
+        Returns acquisition times of the tiles as `sentinelhub.WebFeatureService.get_dates`, None for tiles without
+        a date.
+        """
+        return [datetime.strptime(f"{tile_info['properties']['date']}T{tile_info['properties']['time'].split('.')[0]}",
+                                  '%Y-%m-%dT%H:%M:%S') if tile_info['properties']['date'] else None
+                for tile_info in self]
+
+def download(data_request):
+    """
+    Returns the data of a sentinelhub `DataRequest`, downloaded by the default client if it is set.
+    """
+    if _default_client is None:
+        return data_request.get_data()
+    return _default_client.get_data(data_request)
@@ -2,9 +2,13 @@ from sentinelhub import BBox
 from sentinelhub import WcsRequest, WmsRequest
 from sentinelhub import MimeType, CustomUrlParam, DataSource
 from sentinelhub import SHConfig
+from sh_client import download, WebFeatureService
 import numpy as np
 from datetime import datetime, timedelta
 
+# acquisitions within this time of each other are a single date
+S2_TIME_DIFFERENCE = timedelta(hours=2)
+
 S2_DEM_SCRIPT_V3 = """
     //VERSION=3
     function setup() {
@@ -75,7 +79,7 @@ def get_S2_request(layer, dam_bbox, date, resx, resy, maxcc):
                       resx=f'{resx}m', resy=f'{resy}m',
                       image_format=MimeType.TIFF_d32f,
                       maxcc=maxcc,
-                      time_difference=timedelta(hours=2),
+                      time_difference=S2_TIME_DIFFERENCE,
                       custom_url_params={CustomUrlParam.EVALSCRIPT: S2_NDWI_SCRIPT_V3 if layer == 'NDWI' else S2_TRUECOLOR_SCRIPT_V3, CustomUrlParam.SHOWLOGO: False})
 
 def get_S2_wmsrequest(layer, dam_bbox, date, width, height, maxcc):
@@ -86,15 +90,31 @@ def get_S2_wmsrequest(layer, dam_bbox, date, width, height, maxcc):
                       width=width, height=height,
                       image_format=MimeType.TIFF_d32f,
                       maxcc=maxcc,
-                      time_difference=timedelta(hours=2),
+                      time_difference=S2_TIME_DIFFERENCE,
                       custom_url_params={CustomUrlParam.SHOWLOGO: False})
 
-def get_S2_dates(layer, time_interval, dam_bbox, resx, resy, maxcc):
-    date_request = get_S2_request(layer, dam_bbox, time_interval, resx=resx, resy=resy, maxcc=maxcc)
-    return date_request.get_dates()
+def filter_dates(dates, time_difference):
+    """
+    Keeps the first of sorted dates which are within `time_difference` of each other, as `WcsRequest.get_dates`.
+    """
+    if len(dates) == 0 or time_difference is None or time_difference < timedelta(0):
+        return dates
+    separate_dates = [dates[0]]
+    for date in dates[1:]:
+        if date - separate_dates[-1] > time_difference:
+            separate_dates.append(date)
+    return separate_dates
+
+def get_S2_dates(time_interval, dam_bbox, maxcc):
+    """
+    Returns dates of Sentinel-2 acquisitions over the bbox, as `get_dates` of a request of the bbox. The catalogue
+    (WFS) is queried through the default client if it is set, see `sh_client.set_default_client`.
+    """
+    tiles = WebFeatureService(dam_bbox, time_interval, data_source=DataSource.SENTINEL2_L1C, maxcc=maxcc)
+    return filter_dates(sorted(set(tiles.get_dates())), S2_TIME_DIFFERENCE)
 
 def get_optical_data(request):
-    return np.asarray(request.get_data())[0]
+    return np.asarray(download(request))[0]
 
 def get_DEM_request(dam_bbox, resx, resy):
     return WcsRequest(data_source=DataSource.DEM,
@@ -0,0 +1,321 @@
+""" Module for serving nearby waterbodies from shared request footprints.
+
+Clustered reservoirs (e.g. a cascade in the same valley) have overlapping bboxes, so requesting each of them on its
+own downloads the same pixels several times. Dams are grouped into footprints, each footprint is downloaded once
+per date and each dam gets a window (a view, not a copy) of the footprint raster.
+"""
+
+import math
+import logging
+
+import numpy as np
+from shapely.geometry import box
+from shapely.strtree import STRtree
+
+from sentinelhub import BBox, bbox_to_dimensions
+from sentinelhub import DownloadFailedException
+from sentinelhub.download import ImageDecodingError
+
+from geom_utils import get_bbox, get_optimal_resolution, get_optimal_cloud_resolution
+from sh_requests import get_DEM_request, S2_DEM_SCRIPT_V3
+from date_discovery import DateCatalogue
+from tile_cache import get_request_data
+from profiling import stage, add_bytes, add_count
+from definitions import WaterDetectionSensor, WaterDetectionStatus, get_new_measurement_entry, set_measurement_status
+from s2_water_extraction import S2_WATER_DETECTOR_VERSION, S2_MAX_CC, S2_MIN_VALID_FRACTION, S2_MAX_CLOUD_COVERAGE
+from s2_water_extraction import S2_CLOUD_BANDS_SCRIPT_V3, S2_CLOUD_BANDS_COMPACT_SCRIPT_V3, TransferStats
+from s2_water_extraction import get_ndwi_request, get_cloud_bands_request, get_ndwi_compact_script, decode_ndwi
+from s2_water_extraction import decode_cloud_bands, get_cloud_coverage, set_water_level_optical
+
+LOGGER = logging.getLogger(__name__)
+
+class DamGroup:
+    """
+    Waterbodies served by one request footprint. All dams of a group have the same optimal resolution, which is
+    also the optimal resolution of the footprint (i.e. it is within the 5000 x 5000 pixel limit).
+    """
+    def __init__(self, dam_ids, dam_polys, dam_bboxes, resx, resy):
+        self.dam_ids = dam_ids
+        self.dam_polys = dam_polys
+        self.dam_bboxes = dam_bboxes
+        self.resx = resx
+        self.resy = resy
+        self.bbox = get_union_bbox(dam_bboxes)
+
+    def __len__(self):
+        return len(self.dam_ids)
+
+    def get_subgroup(self, indices):
+        """
+        Returns the group of the dams at the indices, with the footprint reduced to their bboxes.
+        """
+        if len(indices) == len(self):
+            return self
+        return DamGroup([self.dam_ids[idx] for idx in indices], [self.dam_polys[idx] for idx in indices],
+                        [self.dam_bboxes[idx] for idx in indices], self.resx, self.resy)
+
+    def get_windows(self, height, width):
+        """
+        Returns (row slice, column slice, window bbox) of each dam in a height x width raster of the footprint.
+        """
+        return [get_window(dam_bbox, self.bbox, height, width) for dam_bbox in self.dam_bboxes]
+
+def get_union_bbox(bboxes):
+    return BBox(bbox=[min(bbox.min_x for bbox in bboxes), min(bbox.min_y for bbox in bboxes),
+                      max(bbox.max_x for bbox in bboxes), max(bbox.max_y for bbox in bboxes)], crs=bboxes[0].crs)
+
+def get_window(dam_bbox, footprint_bbox, height, width):
+    """
+    Returns row and column slices of a height x width raster of the footprint covering the dam bbox, and the bbox
+    of the window, i.e. the dam bbox extended to pixel edges.
+    """
+    min_x, min_y = footprint_bbox.get_lower_left()
+    max_x, max_y = footprint_bbox.get_upper_right()
+    pixel_x, pixel_y = (max_x - min_x)/width, (max_y - min_y)/height
+
+    # small tolerance, so that bboxes on pixel edges are not extended by rounding errors
+    col_start = max(0, math.floor((dam_bbox.min_x - min_x)/pixel_x + 1e-6))
+    col_end = min(width, math.ceil((dam_bbox.max_x - min_x)/pixel_x - 1e-6))
+    row_start = max(0, math.floor((max_y - dam_bbox.max_y)/pixel_y + 1e-6))
+    row_end = min(height, math.ceil((max_y - dam_bbox.min_y)/pixel_y - 1e-6))
+
+    window_bbox = BBox(bbox=[min_x + col_start*pixel_x, max_y - row_end*pixel_y,
+                             min_x + col_end*pixel_x, max_y - row_start*pixel_y], crs=footprint_bbox.crs)
+    return slice(row_start, row_end), slice(col_start, col_end), window_bbox
+
+def get_num_pixels(bbox, resx, resy):
+    width, height = bbox_to_dimensions(bbox, (resx, resy))
+    return width*height
+
+def _query(tree, geometry, geometry_ids):
+    """
+    Returns indices of tree geometries intersecting the geometry's extent. Shapely 2 returns indices, earlier
+    versions the geometries themselves.
+    """
+    return sorted(int(item) if isinstance(item, (int, np.integer)) else geometry_ids[id(item)]
+                  for item in tree.query(geometry))
+
+def get_dam_groups(dams, inflate_bbox=0.1, max_area_ratio=1.5, max_gap=0.0):
+    """
+    Groups a list of (dam_id, polygon) pairs into `DamGroup`s of dams whose bboxes (see `get_bbox`) can be served
+    by a common footprint.
+
+    Bboxes are indexed with an STRtree. Starting from the westernmost ungrouped dam, neighbouring bboxes (with
+    extents intersecting the footprint extended by `max_gap` in CRS units) are merged into the footprint as long as
+    it keeps the resolution of the dams and its number of pixels doesn't exceed `max_area_ratio` times the pixels
+    of separate requests for its dams. Dams without neighbours form groups of one.
+
+    A ratio of 1.0 never downloads more pixels, but it only merges bboxes overlapping by about half or more, e.g. not
+    reservoirs of a cascade along a diagonal valley. The default of 1.5 groups such cascades, trading up to half more
+    pixels for fewer requests.
+    """
+    dam_ids = [dam_id for dam_id, _ in dams]
+    dam_polys = [dam_poly for _, dam_poly in dams]
+    dam_bboxes = [get_bbox(dam_poly, inflate_bbox=inflate_bbox) for dam_poly in dam_polys]
+    resolutions = [get_optimal_resolution(dam_bbox) for dam_bbox in dam_bboxes]
+    pixels = [get_num_pixels(dam_bbox, *resolution) for dam_bbox, resolution in zip(dam_bboxes, resolutions)]
+
+    boxes = [box(*dam_bbox) for dam_bbox in dam_bboxes]
+    tree = STRtree(boxes)
+    box_ids = {id(dam_box): idx for idx, dam_box in enumerate(boxes)}
+
+    grouped = [False]*len(dams)
+    groups = []
+    for seed in sorted(range(len(dams)), key=lambda idx: tuple(dam_bboxes[idx])):
+        if grouped[seed]:
+            continue
+        grouped[seed] = True
+        members, footprint, separate_pixels = [seed], dam_bboxes[seed], pixels[seed]
+        resolution = resolutions[seed]
+
+        grown = True
+        while grown:
+            grown = False
+            for idx in _query(tree, box(*footprint).buffer(max_gap, join_style=2), box_ids):
+                if grouped[idx] or resolutions[idx] != resolution:
+                    continue
+                merged = get_union_bbox([footprint, dam_bboxes[idx]])
+                if get_optimal_resolution(merged) != resolution or \
+                        get_num_pixels(merged, *resolution) > max_area_ratio*(separate_pixels + pixels[idx]):
+                    continue
+                grouped[idx] = True
+                members.append(idx)
+                footprint, separate_pixels = merged, separate_pixels + pixels[idx]
+                grown = True
+
+        groups.append(DamGroup([dam_ids[idx] for idx in members], [dam_polys[idx] for idx in members],
+                               [dam_bboxes[idx] for idx in members], *resolution))
+    return groups
+
+def get_grouping_summary(groups):
+    """
+    Returns the number of requests per date and pixels per date (at NDWI resolution) of separate and grouped
+    requests.
+    """
+    separate_pixels = sum(get_num_pixels(dam_bbox, group.resx, group.resy)
+                          for group in groups for dam_bbox in group.dam_bboxes)
+    grouped_pixels = sum(get_num_pixels(group.bbox, group.resx, group.resy) for group in groups)
+    return {'dams': sum(len(group) for group in groups),
+            'footprints': len(groups),
+            'separate_pixels': separate_pixels,
+            'grouped_pixels': grouped_pixels,
+            'pixels_saved': separate_pixels - grouped_pixels}
+
+def _download(get_request, layer, evalscript, bbox, resx, resy, date_str, tile_cache, stats, stage_name, counter):
+    """
+    Downloads a footprint raster. Returns None if the download failed.
+    """
+    try:
+        with stage(stage_name):
+            data = get_request_data(get_request, tile_cache, layer=layer, evalscript=evalscript, bbox=bbox,
+                                    resx=resx, resy=resy, date=date_str, maxcc=S2_MAX_CC if date_str else None)
+    except (RuntimeError, DownloadFailedException, ImageDecodingError):
+        return None
+    stats.add_download(data)
+    add_bytes(counter, data.nbytes)
+    return data
+
+def _add_saved(stats, footprint, windows):
+    """
+    Counts requests and bytes of separate requests for windows which were served by the footprint. A footprint
+    larger than its windows together saves no bytes, its extra bytes are already counted as downloaded.
+    """
+    stats.requests_saved += len(windows) - 1
+    stats.bytes_saved += max(0, sum(footprint[rows, cols].nbytes for rows, cols, _ in windows) - footprint.nbytes)
+
+def extract_surface_water_area_group(group, date, tile_cache=None, stats=None, encoding=None, simplify=True):
+    """
+    Runs water detection for all dams of the group for a single timestamp. NDWI and cloud bands of the footprint
+    are downloaded once and each dam is processed on its window of the footprint rasters, with the same checks and
+    statuses as `extract_surface_water_area_per_frame`. Clouds of all dams are classified in one batch. Requests
+    and bytes saved compared to separate requests are accumulated in `stats` (`TransferStats`).
+
+    Returns a list of measurements in the order of dams in the group.
+    """
+    if stats is None:
+        stats = TransferStats()
+    date_str = date.strftime('%Y-%m-%d')
+    resx, resy = group.resx, group.resy
+    measurements = [get_new_measurement_entry(dam_id, date, WaterDetectionSensor.S2_NDWI, S2_WATER_DETECTOR_VERSION)
+                    for dam_id in group.dam_ids]
+
+    def set_status(status, idx=None):
+        for measurement in (measurements if idx is None else [measurements[i] for i in idx]):
+            set_measurement_status(measurement, status)
+        return measurements
+
+    ndwi = _download(lambda: get_ndwi_request(group.bbox, date_str, resx, resy, encoding), 'NDWI',
+                     encoding and get_ndwi_compact_script(encoding), group.bbox, resx, resy, date_str, tile_cache,
+                     stats, 'ndwi_download', 'ndwi')
+    if ndwi is None:
+        return set_status(WaterDetectionStatus.SH_REQUEST_ERROR)
+    if len(ndwi)==0:
+        return set_status(WaterDetectionStatus.SH_NO_DATA)
+    if encoding is not None:
+        with stage('decode'):
+            ndwi = decode_ndwi(ndwi, encoding)
+    ndwi = ndwi[0]
+
+    windows = group.get_windows(*ndwi.shape[:2])
+    _add_saved(stats, ndwi, windows)
+    # check that windows have no INVALID PIXELS
+    valid_idx = []
+    for idx, (rows, cols, _) in enumerate(windows):
+        if np.count_nonzero(ndwi[rows, cols, 1])/np.size(ndwi[rows, cols, 1]) < S2_MIN_VALID_FRACTION:
+            set_status(WaterDetectionStatus.INVALID_DATA, [idx])
+        else:
+            valid_idx.append(idx)
+    if len(valid_idx)==0:
+        return measurements
+
+    cloudresx, cloudresy = get_optimal_cloud_resolution(resx, resy)
+    compact = encoding is not None
+    cloud_bands = _download(lambda: get_cloud_bands_request(group.bbox, date_str, resx, resy, compact), 'NDWI',
+                            S2_CLOUD_BANDS_COMPACT_SCRIPT_V3 if compact else S2_CLOUD_BANDS_SCRIPT_V3, group.bbox,
+                            cloudresx, cloudresy, date_str, tile_cache, stats, 'cloud_download', 'cloud_bands')
+    if cloud_bands is None:
+        return set_status(WaterDetectionStatus.SH_REQUEST_ERROR, valid_idx)
+    if len(cloud_bands)==0:
+        return set_status(WaterDetectionStatus.SH_NO_CLOUD_DATA, valid_idx)
+    if compact:
+        with stage('decode'):
+            cloud_bands = decode_cloud_bands(cloud_bands)
+    cloud_bands = cloud_bands[0]
+
+    cloud_windows = group.get_windows(*cloud_bands.shape[:2])
+    _add_saved(stats, cloud_bands, cloud_windows)
+    # cloud coverage over each dam's bbox, all windows are classified in one batch
+    cloud_frames = [cloud_bands[cloud_windows[idx][0], cloud_windows[idx][1]] for idx in valid_idx]
+    cloud_cov = get_cloud_coverage(cloud_frames, range(len(cloud_frames)))
+
+    for idx, dam_cloud_cov in zip(valid_idx, cloud_cov):
+        measurement = measurements[idx]
+        if dam_cloud_cov > S2_MAX_CLOUD_COVERAGE:
+            set_measurement_status(measurement, WaterDetectionStatus.TOO_CLOUDY)
+            continue
+        rows, cols, window_bbox = windows[idx]
+        measurement.CLOUD_COVERAGE = dam_cloud_cov
+        set_water_level_optical(measurement, date, ndwi[rows, cols, 0], group.dam_polys[idx], window_bbox,
+                                simplify=simplify)
+    return measurements
+
+def get_group_dem(group, tile_cache=None, stats=None):
+    """
+    Downloads the DEM of the footprint once. Returns a list of (DEM window, window bbox) per dam, for
+    `surface_water_area_with_dem_veto_batch`, or None if the download failed.
+    """
+    if stats is None:
+        stats = TransferStats()
+    dem = _download(lambda: get_DEM_request(group.bbox, group.resx, group.resy), 'DEM', S2_DEM_SCRIPT_V3,
+                    group.bbox, group.resx, group.resy, None, tile_cache, stats, 'dem_download', 'dem')
+    if dem is None or len(dem)==0:
+        return None
+    dem = dem[0]
+    windows = group.get_windows(*dem.shape[:2])
+    _add_saved(stats, dem, windows)
+    return [(dem[rows, cols], window_bbox) for rows, cols, window_bbox in windows]
+
+def get_group_dates(group, time_interval, date_catalogue):
+    """
+    Returns sorted (date, dam indices) pairs of the group: dates of tiles covering any dam of the group, each with
+    the dams covered by a tile of that day. Dams of the same day get the earliest date of the day.
+    """
+    days = {}
+    for idx, dam_bbox in enumerate(group.dam_bboxes):
+        for date in date_catalogue.get_dates(dam_bbox, time_interval, maxcc=S2_MAX_CC):
+            days.setdefault(date.date(), []).append((date, idx))
+    return [(min(date for date, _ in dam_dates), [idx for _, idx in dam_dates])
+            for _, dam_dates in sorted(days.items())]
+
+def extract_surface_water_area_grouped(groups, time_interval, tile_cache=None, stats=None, encoding=None,
+                                       simplify=True, date_catalogue=None):
+    """
+    Runs water detection for all groups over the time interval. Yields lists of measurements per group and date,
+    one per dam of the group which has the date.
+
+    Dates of each dam are looked up in the date catalogue (see `date_discovery.DateCatalogue`), an in-memory one
+    is used if none is given. A date of the footprint which does not cover every dam is downloaded for the
+    footprint of the covered dams only, so dams get the same dates as when processed separately. If dates of a
+    group can't be looked up, a list of measurements with status SH_REQUEST_ERROR (dated at the start of the time
+    interval) is yielded for the group instead.
+    """
+    if stats is None:
+        stats = TransferStats()
+    if date_catalogue is None:
+        date_catalogue = DateCatalogue()
+    for group in groups:
+        try:
+            group_dates = get_group_dates(group, time_interval, date_catalogue)
+        except (RuntimeError, DownloadFailedException) as exception:
+            LOGGER.warning('Failed to look up dates of %d dams (%s): %s', len(group),
+                           ', '.join(map(str, group.dam_ids)), exception)
+            add_count('failed_date_lookups', len(group))
+            measurements = [get_new_measurement_entry(dam_id, time_interval[0], WaterDetectionSensor.S2_NDWI,
+                                                      S2_WATER_DETECTOR_VERSION) for dam_id in group.dam_ids]
+            for measurement in measurements:
+                set_measurement_status(measurement, WaterDetectionStatus.SH_REQUEST_ERROR)
+            yield measurements
+            continue
+        for date, indices in group_dates:
+            yield extract_surface_water_area_group(group.get_subgroup(indices), date, tile_cache=tile_cache,
+                                                   stats=stats, encoding=encoding, simplify=simplify)
@@ -0,0 +1,168 @@
+""" Module for local on-disk caching of downloaded rasters. """
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+import numpy as np
+
+from sh_client import download
+
+STATIC_LAYERS = ('DEM',)
+DEFAULT_MAX_SIZE = 10*2**30
+DEFAULT_TTL = 30*24*3600
+
+class TileCache:
+    """
+    Content-addressed cache of request results stored as `.npy` files.
+
+    Entries are keyed on (layer, evalscript, bbox, resolution, date, maxcc). Entries of static layers (DEM) expire
+    after `static_ttl` seconds (never if None), other entries after `ttl` seconds. When the total size exceeds
+    `max_size` bytes, least recently used entries are removed. Empty responses are not cached, data may still be
+    processed for the date.
+    """
+    def __init__(self, cache_folder, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL, static_ttl=None,
+                 static_layers=STATIC_LAYERS, mmap=True):
+        self.cache_folder = cache_folder
+        self.max_size = max_size
+        self.ttl = ttl
+        self.static_ttl = static_ttl
+        self.static_layers = static_layers
+        self.mmap = mmap
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._index = {}
+        self._size = 0
+        self._load_index()
+
+    def _load_index(self):
+        os.makedirs(self.cache_folder, exist_ok=True)
+        for layer in os.listdir(self.cache_folder):
+            layer_folder = os.path.join(self.cache_folder, layer)
+            if not os.path.isdir(layer_folder):
+                continue
+            for file_name in os.listdir(layer_folder):
+                if file_name.endswith('.npy'):
+                    path = os.path.join(layer_folder, file_name)
+                    stat = os.stat(path)
+                    self._index[path] = (stat.st_size, stat.st_mtime, stat.st_atime)
+                    self._size += stat.st_size
+
+    @staticmethod
+    def get_key(layer, evalscript, bbox, resx, resy, date, maxcc):
+        """
+        Returns the hash of request parameters which define the downloaded raster.
+        """
+        params = {'layer': layer,
+                  'evalscript': hashlib.sha1(evalscript.encode()).hexdigest() if evalscript else None,
+                  'bbox': [round(coord, 9) for coord in bbox] + [str(bbox.crs)],
+                  'resolution': [str(resx), str(resy)],
+                  'date': date if date is None or isinstance(date, str) else [str(d) for d in date],
+                  'maxcc': maxcc}
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def _get_path(self, layer, key):
+        return os.path.join(self.cache_folder, layer, f'{key}.npy')
+
+    def _get_ttl(self, layer):
+        return self.static_ttl if layer in self.static_layers else self.ttl
+
+    def get(self, layer, key):
+        """
+        Returns cached array or None if the entry does not exist or has expired.
+        """
+        path = self._get_path(layer, key)
+        with self._lock:
+            if path not in self._index:
+                return None
+            size, created, _ = self._index[path]
+
+            ttl = self._get_ttl(layer)
+            now = time.time()
+            if ttl is not None and now - created > ttl:
+                self._remove(path)
+                return None
+
+            # modification time keeps the creation time, access time is set explicitly for LRU eviction
+            try:
+                os.utime(path, (now, created))
+            except FileNotFoundError:
+                self._remove(path)
+                return None
+            self._index[path] = (size, created, now)
+
+        try:
+            return np.load(path, mmap_mode='r' if self.mmap else None)
+        except (OSError, ValueError):
+            # removed by eviction in another thread or process, or a broken file, either way a miss
+            with self._lock:
+                if path in self._index and self._index[path][1] == created:
+                    self._remove(path)
+            return None
+
+    def put(self, layer, key, array):
+        """
+        Stores the array and evicts least recently used entries if cache is over its size limit.
+        """
+        path = self._get_path(layer, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as tmp_file:
+            np.save(tmp_file, np.asarray(array))
+        os.replace(tmp_path, path)
+
+        size = os.path.getsize(path)
+        with self._lock:
+            if path in self._index:
+                self._size -= self._index[path][0]
+            now = time.time()
+            self._index[path] = (size, now, now)
+            self._size += size
+            self._evict()
+
+    def _remove(self, path):
+        size, _, _ = self._index.pop(path)
+        self._size -= size
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        if self._size <= self.max_size:
+            return
+        for path, _ in sorted(self._index.items(), key=lambda item: item[1][2]):
+            self._remove(path)
+            if self._size <= self.max_size:
+                return
+
+    def get_data(self, get_request, layer, evalscript, bbox, resx, resy, date, maxcc):
+        """
+        Returns data of the request from the cache. On a miss the request is built with `get_request`, downloaded
+        and stored. On a hit no request is built.
+        """
+        key = self.get_key(layer, evalscript, bbox, resx, resy, date, maxcc)
+        data = self.get(layer, key)
+        if data is not None:
+            self.hits += 1
+            return data
+
+        self.misses += 1
+        data = np.asarray(download(get_request()))
+        if len(data) > 0:
+            self.put(layer, key, data)
+        return data
+
+def get_request_data(get_request, tile_cache=None, **key_params):
+    """
+    Returns all data of the request built by `get_request`, through the tile cache if it is given. Key parameters
+    are the arguments of `TileCache.get_data`.
+    """
+    if tile_cache is None:
+        return np.asarray(download(get_request()))
+    return tile_cache.get_data(get_request, **key_params)
@@ -0,0 +1,275 @@
+""" Module for tiled water detection of large waterbodies at native resolution. """
+
+import os
+import math
+import tempfile
+
+import numpy as np
+from shapely.geometry import box, shape
+from shapely.ops import unary_union
+
+from sentinelhub import BBox, bbox_to_dimensions
+from sentinelhub import DownloadFailedException
+from sentinelhub.download import ImageDecodingError
+
+from geom_utils import get_bbox, get_optimal_resolution, get_raster_mask, get_budget_simplified_poly
+from geom_utils import get_wkt_size_estimate
+from definitions import WaterDetectionSensor, WaterDetectionStatus, get_new_measurement_entry, set_measurement_status
+from tile_cache import get_request_data
+from s2_water_extraction import S2_WATER_DETECTOR_VERSION, S2_MAX_CC, S2_MIN_VALID_FRACTION, S2_MAX_CLOUD_COVERAGE
+from s2_water_extraction import get_ndwi_request, download_cloud_bands, get_cloud_coverage, get_structuring_element
+from s2_water_extraction import binary_dilation_fast, get_otsu_threshold, OTSU_BINS
+
+# rasterio and skimage are imported on first use to keep the import of this module fast
+
+TILE_SIZE = 2000
+TILE_OVERLAP = 64
+
+def get_tile_bboxes(dam_bbox, resx=10, resy=10, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    """
+    Splits the bbox into a grid of tiles of at most `tile_size` x `tile_size` pixels at given resolution. Returns
+    a list of (core bbox, tile bbox) pairs, where core bboxes partition the dam bbox and tile bboxes extend them by
+    `overlap` pixels on each side (within the dam bbox).
+    """
+    width, height = bbox_to_dimensions(dam_bbox, (resx, resy))
+    n_cols, n_rows = max(1, math.ceil(width/tile_size)), max(1, math.ceil(height/tile_size))
+
+    min_x, min_y = dam_bbox.get_lower_left()
+    max_x, max_y = dam_bbox.get_upper_right()
+    step_x, step_y = (max_x - min_x)/n_cols, (max_y - min_y)/n_rows
+    overlap_x, overlap_y = overlap*(max_x - min_x)/max(width, 1), overlap*(max_y - min_y)/max(height, 1)
+
+    tiles = []
+    for row in range(n_rows):
+        for col in range(n_cols):
+            core = [min_x + col*step_x, max_y - (row + 1)*step_y, min_x + (col + 1)*step_x, max_y - row*step_y]
+            tile = [max(min_x, core[0] - overlap_x), max(min_y, core[1] - overlap_y),
+                    min(max_x, core[2] + overlap_x), min(max_y, core[3] + overlap_y)]
+            tiles.append((BBox(bbox=core, crs=dam_bbox.crs), BBox(bbox=tile, crs=dam_bbox.crs)))
+    return tiles
+
+def get_core_window(core_bbox, tile_bbox, width, height, margin=1):
+    """
+    Returns row and column slices of the tile raster covering the core bbox, extended by `margin` pixels so that
+    polygons can be clipped exactly at the core boundary.
+    """
+    tile_min_x, tile_min_y = tile_bbox.get_lower_left()
+    tile_max_x, tile_max_y = tile_bbox.get_upper_right()
+    core_min_x, core_min_y = core_bbox.get_lower_left()
+    core_max_x, core_max_y = core_bbox.get_upper_right()
+
+    col_start = math.floor((core_min_x - tile_min_x)/(tile_max_x - tile_min_x)*width) - margin
+    col_end = math.ceil((core_max_x - tile_min_x)/(tile_max_x - tile_min_x)*width) + margin
+    row_start = math.floor((tile_max_y - core_max_y)/(tile_max_y - tile_min_y)*height) - margin
+    row_end = math.ceil((tile_max_y - core_min_y)/(tile_max_y - tile_min_y)*height) + margin
+
+    return slice(max(0, row_start), min(height, row_end)), slice(max(0, col_start), min(width, col_end))
+
+def get_core_pixels(core_bbox, tile_bbox, width, height):
+    """
+    Returns slices of pixels whose centers are within the core bbox, used to count each pixel only once.
+    """
+    return get_core_window(core_bbox, tile_bbox, width, height, margin=0)
+
+class _Tile:
+    """
+    Tile bboxes and path of the NDWI band stored on disk between passes, and of its dilated edges once computed.
+    """
+    def __init__(self, core_bbox, tile_bbox, path):
+        self.core_bbox = core_bbox
+        self.tile_bbox = tile_bbox
+        self.path = path
+        self.edges_path = os.path.splitext(path)[0] + '_edges.npy'
+
+    def load(self):
+        return np.load(self.path, mmap_mode='r')
+
+    def load_edges(self):
+        return np.load(self.edges_path, mmap_mode='r')
+
+def _get_tile_water_polygons(water, dam_poly, tile):
+    """
+    Polygonizes water components of the tile which touch the dam or the core boundary (i.e. may continue in a
+    neighbouring tile) and clips them to the core bbox.
+    """
+    import rasterio.features
+    import rasterio.transform
+    from skimage.measure import label
+
+    height, width = water.shape
+    rows, cols = get_core_window(tile.core_bbox, tile.tile_bbox, width, height)
+    water = water[rows, cols]
+
+    tile_transform = rasterio.transform.from_bounds(*tile.tile_bbox, width=width, height=height)
+    window_transform = tile_transform*rasterio.transform.Affine.translation(cols.start, rows.start)
+    window_bounds = rasterio.transform.array_bounds(water.shape[0], water.shape[1], window_transform)
+    window_bbox = BBox(bbox=[window_bounds[0], window_bounds[1], window_bounds[2], window_bounds[3]],
+                       crs=tile.tile_bbox.crs)
+
+    labels = label(water, connectivity=1)
+    if labels.max()==0:
+        return []
+
+    dam_mask = get_raster_mask(dam_poly, window_bbox, water.shape[1], water.shape[0], all_touched=True)
+    border = np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]])
+    selected = np.union1d(np.unique(labels[dam_mask==1]), np.unique(border))
+    selected = selected[selected > 0]
+    if len(selected)==0:
+        return []
+
+    selected_mask = np.isin(labels, selected)
+    core_box = box(*tile.core_bbox)
+    geoms = []
+    for geom, _ in rasterio.features.shapes(selected_mask.astype(np.uint8), mask=selected_mask,
+                                            transform=window_transform):
+        clipped = shape(geom).intersection(core_box)
+        if not clipped.is_empty:
+            geoms.append(clipped)
+    return geoms
+
+def _get_global_threshold(tiles, ndwi_min, ndwi_max, canny_sigma, canny_threshold, selem):
+    """
+    Determines a single threshold for all tiles, following `get_water_mask_from_S2`: Otsu threshold of NDWI
+    values on dilated canny edges of all tiles, or of all values if there are no edges, lowered to 0.0 if the
+    majority of pixels above it has negative NDWI.
+
+    Histograms have the same bins as in `get_water_mask_from_S2`, i.e. `OTSU_BINS` over the range of edge values
+    (or of all values), so a scene gives the same threshold tiled and in one piece. The edge range is only known
+    after all tiles, so dilated edges of tile cores are kept on disk until their values are binned.
+    """
+    from skimage.feature import canny
+
+    all_hist = np.zeros(OTSU_BINS, dtype=np.int64)
+    edge_min, edge_max = np.inf, -np.inf
+
+    for tile in tiles:
+        ndwi = tile.load()
+        ndwi_std = (ndwi - ndwi_min)/(ndwi_max - ndwi_min)
+        edges = canny(ndwi_std, sigma=canny_sigma, high_threshold=canny_threshold)
+        dilated_edges = binary_dilation_fast(edges, selem, np.empty(edges.shape, dtype=bool))
+
+        rows, cols = get_core_pixels(tile.core_bbox, tile.tile_bbox, ndwi.shape[1], ndwi.shape[0])
+        core_edges = dilated_edges[rows, cols]
+        np.save(tile.edges_path, core_edges)
+        counts, all_bin_edges = np.histogram(ndwi[rows, cols], bins=OTSU_BINS, range=(ndwi_min, ndwi_max))
+        all_hist += counts
+        edge_values = ndwi[rows, cols][core_edges]
+        if edge_values.size > 0:
+            edge_min, edge_max = min(edge_min, edge_values.min()), max(edge_max, edge_values.max())
+
+    if edge_min < edge_max:
+        status, fallback_status = 1, 3
+        edge_hist = np.zeros(OTSU_BINS, dtype=np.int64)
+        for tile in tiles:
+            ndwi = tile.load()
+            rows, cols = get_core_pixels(tile.core_bbox, tile.tile_bbox, ndwi.shape[1], ndwi.shape[0])
+            counts, edge_bin_edges = np.histogram(ndwi[rows, cols][tile.load_edges()], bins=OTSU_BINS,
+                                                  range=(edge_min, edge_max))
+            edge_hist += counts
+        otsu_thr = get_otsu_threshold(edge_hist, edge_bin_edges)
+    else:
+        status, fallback_status = 2, 4
+        otsu_thr = get_otsu_threshold(all_hist, all_bin_edges)
+
+    n_positive, n_water = 0, 0
+    for tile in tiles:
+        ndwi = tile.load()
+        rows, cols = get_core_pixels(tile.core_bbox, tile.tile_bbox, ndwi.shape[1], ndwi.shape[0])
+        n_positive += np.count_nonzero(ndwi[rows, cols] > 0)
+        n_water += np.count_nonzero(ndwi[rows, cols] > otsu_thr)
+
+    if n_water > 0 and n_positive/n_water < 0.9:
+        return 0.0, fallback_status
+    return otsu_thr, status
+
+def extract_surface_water_area_tiled(dam_id, dam_poly, date, resx=10, resy=10, tile_size=TILE_SIZE,
+                                     overlap=TILE_OVERLAP, tile_cache=None, simplify=True, canny_sigma=4,
+                                     canny_threshold=0.3):
+    """
+    Run water detection algorithm for a single timestamp on overlapping tiles at native resolution.
+
+    Cloud coverage is determined for the whole dam bbox at cloud resolution. NDWI tiles are downloaded one by one and
+    kept on disk, a single Otsu threshold is computed from histograms accumulated over all tiles and water polygons
+    are clipped to tile cores and stitched across seams. Peak memory is bounded by the tile size.
+    """
+    measurement = get_new_measurement_entry(dam_id, date, WaterDetectionSensor.S2_NDWI, S2_WATER_DETECTOR_VERSION)
+    date_str = date.strftime('%Y-%m-%d')
+    dam_bbox = get_bbox(dam_poly)
+
+    # cloud detection for the entire bbox
+    cloud_bands = download_cloud_bands(measurement, dam_bbox, date_str, *get_optimal_resolution(dam_bbox),
+                                       tile_cache=tile_cache)
+    if cloud_bands is None:
+        return measurement
+    cloud_cov = get_cloud_coverage(cloud_bands, [0])[0]
+    del cloud_bands
+    if cloud_cov > S2_MAX_CLOUD_COVERAGE:
+        set_measurement_status(measurement, WaterDetectionStatus.TOO_CLOUDY)
+        return measurement
+
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        # download NDWI tiles, check data validity and NDWI range
+        tiles = []
+        n_valid, n_pixels = 0, 0
+        ndwi_min, ndwi_max = np.inf, -np.inf
+        for idx, (core_bbox, tile_bbox) in enumerate(get_tile_bboxes(dam_bbox, resx, resy, tile_size, overlap)):
+            try:
+                data = get_request_data(lambda: get_ndwi_request(tile_bbox, date_str, resx, resy), tile_cache,
+                                        layer='NDWI', evalscript=None, bbox=tile_bbox, resx=resx, resy=resy,
+                                        date=date_str, maxcc=S2_MAX_CC)
+            except (RuntimeError, DownloadFailedException, ImageDecodingError):
+                set_measurement_status(measurement, WaterDetectionStatus.SH_REQUEST_ERROR)
+                return measurement
+
+            if len(data)==0:
+                set_measurement_status(measurement, WaterDetectionStatus.SH_NO_DATA)
+                return measurement
+
+            ndwi, valid = data[0,...,0], data[0,...,1]
+            rows, cols = get_core_pixels(core_bbox, tile_bbox, ndwi.shape[1], ndwi.shape[0])
+            n_valid += np.count_nonzero(valid[rows, cols])
+            n_pixels += valid[rows, cols].size
+            ndwi_min, ndwi_max = min(ndwi_min, ndwi[rows, cols].min()), max(ndwi_max, ndwi[rows, cols].max())
+
+            tile = _Tile(core_bbox, tile_bbox, os.path.join(tmp_folder, f'{idx}.npy'))
+            np.save(tile.path, np.ascontiguousarray(ndwi))
+            tiles.append(tile)
+            del data, ndwi, valid
+
+        if n_valid/n_pixels < S2_MIN_VALID_FRACTION:
+            set_measurement_status(measurement, WaterDetectionStatus.INVALID_DATA)
+            return measurement
+
+        measurement.CLOUD_COVERAGE = cloud_cov
+
+        # global threshold
+        if ndwi_min == ndwi_max:
+            otsu_thr, alg_status = 1.0, 0
+        else:
+            otsu_thr, alg_status = _get_global_threshold(tiles, ndwi_min, ndwi_max, canny_sigma, canny_threshold,
+                                                         get_structuring_element(4))
+
+        # polygonize water per tile and stitch the tiles
+        geoms = []
+        for tile in tiles:
+            water = (tile.load() > otsu_thr).astype(np.uint8)
+            geoms.extend(_get_tile_water_polygons(water, dam_poly, tile))
+            del water
+
+    if len(geoms)==0:
+        set_measurement_status(measurement, WaterDetectionStatus.INVALID_POLYGON)
+        return measurement
+
+    water = unary_union(geoms)
+    parts = water.geoms if hasattr(water, 'geoms') else [water]
+    measured_water_extent = unary_union([part for part in parts if part.intersects(dam_poly)]).buffer(0)
+    if simplify:
+        measured_water_extent, _ = get_budget_simplified_poly(measured_water_extent,
+                                                              max_bytes=min(100000, get_wkt_size_estimate(dam_poly)*100))
+
+    set_measurement_status(measurement, WaterDetectionStatus.MEASUREMENT_VALID)
+    measurement.SURF_WATER_LEVEL = measured_water_extent.area/dam_poly.area
+    measurement.GEOMETRY = measured_water_extent.wkt
+    measurement.ALG_STATUS = alg_status
+
+    return measurement
@@ -0,0 +1,305 @@
+""" Module for exporting time-lapse animations of a waterbody from true colour frames and measured water extents. """
+
+import os
+import tempfile
+from itertools import chain
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageDraw, GifImagePlugin, TiffImagePlugin
+from shapely.wkt import loads
+
+from geom_utils import get_raster_outline
+from sh_requests import get_S2_request, S2_TRUECOLOR_SCRIPT_V3
+from tile_cache import get_request_data
+from definitions import WaterDetectionStatus
+
+TIMELAPSE_FORMATS = ('.gif', '.webp', '.mp4')
+# maximal number of consecutive frames with the same background rendered by one task
+MAX_RUN = 16
+# number of outline overlays kept by each worker process
+WORKER_OVERLAYS = 4
+_worker_overlays = OrderedDict()
+
+def get_true_color(dam_bbox, date, resx, resy, maxcc=1.0, tile_cache=None):
+    """
+    Returns the true colour RGBA image (data mask as alpha) of the date, through the tile cache if it is given.
+    Returns None if there is no data.
+    """
+    date_str = date.strftime('%Y-%m-%d') if hasattr(date, 'strftime') else date
+    data = get_request_data(lambda: get_S2_request('TRUE-COLOR', dam_bbox, date_str, resx, resy, maxcc), tile_cache,
+                            layer='TRUE-COLOR', evalscript=S2_TRUECOLOR_SCRIPT_V3, bbox=dam_bbox, resx=resx,
+                            resy=resy, date=date_str, maxcc=maxcc)
+    if len(data) == 0:
+        return None
+    return data[0]
+
+def get_timelapse_frames(dam_bbox, measurements, resx, resy, maxcc=1.0, tile_cache=None, valid_only=True):
+    """
+    Yields frames of `export_timelapse` for measurements of a waterbody. True colour images are downloaded (or read
+    from the tile cache) one at a time, when the frame is consumed. Consecutive measurements of the same date (e.g.
+    with and without the DEM veto) reuse the image and are rendered on the same background. Measurements without a
+    valid water extent are skipped, unless `valid_only` is False, in which case they are shown without the current
+    outline.
+    """
+    img_date = None
+    for measurement in measurements:
+        valid = measurement.MEAS_STATUS == WaterDetectionStatus.MEASUREMENT_VALID.value
+        if valid_only and not valid:
+            continue
+        date = measurement.SAT_IMAGE_DATE or measurement.BLUEDOT_MEAS_DATE
+        date_str = date.strftime('%Y-%m-%d') if hasattr(date, 'strftime') else date
+        if date_str != img_date:
+            img = get_true_color(dam_bbox, date_str, resx, resy, maxcc=maxcc, tile_cache=tile_cache)
+            img_date = date_str
+        if img is None:
+            continue
+        yield {'img': img,
+               'background': date_str,
+               'water_extent': measurement.GEOMETRY if valid and measurement.GEOMETRY else None,
+               'date': date_str,
+               'water_level': measurement.SURF_WATER_LEVEL if valid else None}
+
+def get_frame_size(img_shape, max_size):
+    """
+    Returns (width, height) of frames showing an image of the given shape with the longer side `max_size` pixels.
+    Sizes are even, as required by most video codecs.
+    """
+    scale = max_size/max(img_shape[:2])
+    return 2*max(1, round(img_shape[1]*scale/2)), 2*max(1, round(img_shape[0]*scale/2))
+
+def get_background(img, width, height, clip=0):
+    """
+    Returns the RGB(A) image with values in [0, 1] as a width x height uint8 RGB array. Pixels without data (alpha
+    0) are black. If clip is given, the image is stretched so that its `clip` percentile becomes white.
+    """
+    rgb = np.asarray(img[..., :3], dtype=np.float32)
+    vmax = np.percentile(rgb, clip) if clip > 0 else 1.0
+    rgb = np.clip(rgb*(255/max(vmax, 1e-6)), 0, 255)
+    if img.shape[-1] > 3:
+        rgb *= np.asarray(img[..., 3:4], dtype=np.float32) > 0
+    background = Image.fromarray(rgb.astype(np.uint8), mode='RGB').resize((width, height), Image.BILINEAR)
+    return np.array(background)
+
+def get_outline_overlay(geometry, dam_bbox, width, height, color, lw=2):
+    """
+    Rasterizes the outline of a geometry as (black halo mask, line mask, RGB colour), see `apply_overlay`.
+    """
+    from matplotlib.colors import to_rgb
+
+    rgb = np.array([round(255*value) for value in to_rgb(color)], dtype=np.uint8)
+    return (get_raster_outline(geometry, dam_bbox, width, height, line_width=lw + 2),
+            get_raster_outline(geometry, dam_bbox, width, height, line_width=lw),
+            rgb)
+
+def apply_overlay(frame, overlay):
+    """
+    Draws the outline overlay onto the RGB frame in place.
+    """
+    halo, line, rgb = overlay
+    frame[halo] = 0
+    frame[line] = rgb
+
+def _get_nominal_overlay(dam_poly, dam_bbox, width, height, color, lw):
+    """
+    Returns the nominal outline overlay already rasterized by this process for the same dam and frame size.
+    """
+    key = (dam_poly.wkb, tuple(dam_bbox), width, height, color, lw)
+    if key in _worker_overlays:
+        _worker_overlays.move_to_end(key)
+        return _worker_overlays[key]
+
+    _worker_overlays[key] = get_outline_overlay(dam_poly, dam_bbox, width, height, color, lw=lw)
+    if len(_worker_overlays) > WORKER_OVERLAYS:
+        _worker_overlays.popitem(last=False)
+    return _worker_overlays[key]
+
+def render_run(img, frames, dam_poly, dam_bbox, width, height, clip=0, color_nominal='white',
+               color_current='xkcd:lime', lw=2):
+    """
+    Renders frames sharing the same background image. The background with the nominal outline is rendered once,
+    each frame adds its current outline (WKT or geometry) and its date and water level label. Returns a list of
+    uint8 RGB arrays.
+    """
+    background = get_background(img, width, height, clip=clip)
+    apply_overlay(background, _get_nominal_overlay(dam_poly, dam_bbox, width, height, color_nominal, lw))
+
+    rendered = []
+    for frame in frames:
+        image = background.copy()
+        water_extent = frame.get('water_extent')
+        if isinstance(water_extent, str):
+            water_extent = loads(water_extent)
+        if water_extent is not None:
+            apply_overlay(image, get_outline_overlay(water_extent, dam_bbox, width, height, color_current, lw=lw))
+
+        date, water_level = frame.get('date'), frame.get('water_level')
+        if date is not None:
+            label = f'{date} | {water_level*100: 3.0f}%' if water_level is not None else f'{date}'
+            canvas = Image.fromarray(image)
+            ImageDraw.Draw(canvas).text((2, 2), label, fill=(255, 255, 255), stroke_width=1, stroke_fill=(0, 0, 0))
+            image = np.asarray(canvas)
+        rendered.append(image)
+    return rendered
+
+def _render_run_args(args):
+    return render_run(*args[0], **args[1])
+
+def get_runs(frames, max_run=MAX_RUN):
+    """
+    Groups consecutive frames with an unchanged background into runs of at most `max_run` frames. Runs are keyed on
+    the `background` of frames (e.g. the date of the image, as set by `get_timelapse_frames`), the image of the
+    first frame of a run is used for all of its frames. Frames without `background` are keyed on their image object,
+    so they share a run only if they have the same image. A frame without an image (`img` is None) keeps the
+    previous background. Yields (img, frames) pairs, frames without the image.
+    """
+    img, background, run = None, None, []
+    for frame in frames:
+        frame_img = frame.get('img')
+        if frame_img is not None:
+            frame_background = frame['background'] if frame.get('background') is not None else id(frame_img)
+            if img is None or frame_background != background:
+                if run:
+                    yield img, run
+                img, background, run = frame_img, frame_background, []
+        if img is None:
+            continue
+        if len(run) == max_run:
+            yield img, run
+            run = []
+        run.append({key: value for key, value in frame.items() if key != 'img'})
+    if run:
+        yield img, run
+
+class _GifWriter:
+    """
+    Writes an animated GIF frame by frame, each frame with its own palette, so only the current frame is kept in
+    memory.
+    """
+    def __init__(self, file_name, fps, loop=0):
+        self.fp = open(file_name, 'wb')
+        self.duration = int(1000/fps)
+        self.loop = loop
+        self.n_frames = 0
+
+    def append(self, image):
+        frame = Image.fromarray(image).quantize(colors=256, method=Image.FASTOCTREE)
+        if self.n_frames == 0:
+            header, _ = GifImagePlugin.getheader(frame, info={'loop': self.loop, 'duration': self.duration})
+            self.fp.write(b''.join(header))
+        self.fp.write(b''.join(GifImagePlugin.getdata(frame, duration=self.duration, include_color_table=True)))
+        self.n_frames += 1
+
+    def close(self):
+        self.fp.write(b';')
+        self.fp.close()
+
+class _WebpWriter:
+    """
+    Writes an animated WebP. PIL encodes the animation at once, so frames are streamed to a temporary multi-page
+    TIFF next to the output file and encoded from it when the writer is closed, reading one frame at a time.
+    """
+    def __init__(self, file_name, fps, loop=0, quality=80):
+        self.file_name = file_name
+        self.duration = int(1000/fps)
+        self.loop = loop
+        self.quality = quality
+        self.n_frames = 0
+
+        fd, self.tmp_name = tempfile.mkstemp(suffix='.tif', dir=os.path.dirname(os.path.abspath(file_name)))
+        os.close(fd)
+        self.tiff = TiffImagePlugin.AppendingTiffWriter(self.tmp_name, new=True)
+
+    def append(self, image):
+        Image.fromarray(image).save(self.tiff, format='TIFF')
+        self.tiff.newFrame()
+        self.n_frames += 1
+
+    def close(self):
+        try:
+            self.tiff.close()
+            if self.n_frames:
+                with Image.open(self.tmp_name) as frames:
+                    frames.save(self.file_name, format='WEBP', save_all=True, duration=self.duration,
+                                loop=self.loop, quality=self.quality)
+        finally:
+            os.remove(self.tmp_name)
+
+class _Mp4Writer:
+    """
+    Streams frames to an MP4 video encoded by ffmpeg, requires imageio with the imageio-ffmpeg plugin.
+    """
+    def __init__(self, file_name, fps, quality=7):
+        import imageio
+        self.writer = imageio.get_writer(file_name, format='FFMPEG', mode='I', fps=fps, quality=quality,
+                                         macro_block_size=2)
+
+    def append(self, image):
+        self.writer.append_data(image)
+
+    def close(self):
+        self.writer.close()
+
+def get_writer(file_name, fps, **kwargs):
+    """
+    Returns a frame writer for the animation format given by the file extension (.gif, .webp or .mp4).
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == '.gif':
+        return _GifWriter(file_name, fps, **kwargs)
+    if extension == '.webp':
+        return _WebpWriter(file_name, fps, **kwargs)
+    if extension == '.mp4':
+        return _Mp4Writer(file_name, fps, **kwargs)
+    raise ValueError(f'Unsupported time-lapse format {extension}, use one of {TIMELAPSE_FORMATS}')
+
+def export_timelapse(file_name, dam_poly, dam_bbox, frames, max_size=512, fps=2, n_workers=None, max_run=MAX_RUN,
+                     clip=0, color_nominal='white', color_current='xkcd:lime', lw=2, writer_kwargs=None):
+    """
+    Renders frames (dicts with `img`, `water_extent` and optionally `background`, `date` and `water_level`, e.g.
+    from `get_timelapse_frames`) into an animated GIF, WebP or MP4 and returns the number of frames written.
+
+    Frames are consumed lazily and rendered in a process pool with at most 2 runs (see `get_runs`) per worker in
+    flight, so the memory does not grow with the length of the time series (WebP frames are buffered on disk, see
+    `_WebpWriter`).
+    Outlines are rasterized with the transform of `get_raster_mask`, the background with the nominal outline is
+    rendered once for consecutive frames with the same image.
+    """
+    n_workers = n_workers or os.cpu_count()
+    runs = get_runs(frames, max_run=max_run)
+    first = next(runs, None)
+    if first is None:
+        return 0
+
+    width, height = get_frame_size(first[0].shape, max_size)
+    kwargs = {'clip': clip, 'color_nominal': color_nominal, 'color_current': color_current, 'lw': lw}
+    tasks = (((img, run, dam_poly, dam_bbox, width, height), kwargs)
+             for img, run in chain([first], runs))
+
+    writer = get_writer(file_name, fps, **(writer_kwargs or {}))
+    n_frames = 0
+    try:
+        if n_workers == 1:
+            for task in tasks:
+                for image in _render_run_args(task):
+                    writer.append(image)
+                    n_frames += 1
+            return n_frames
+
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            pending = deque()
+            for task in tasks:
+                pending.append(executor.submit(_render_run_args, task))
+                if len(pending) < 2*n_workers:
+                    continue
+                for image in pending.popleft().result():
+                    writer.append(image)
+                    n_frames += 1
+            while pending:
+                for image in pending.popleft().result():
+                    writer.append(image)
+                    n_frames += 1
+        return n_frames
+    finally:
+        writer.close()
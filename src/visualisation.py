@@ -4,22 +4,21 @@ from sentinelhub import BBox
 from shapely.geometry import MultiPolygon, Polygon
 import numpy as np
 
-import matplotlib as mpl
-# mpl.use('Agg')
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-import matplotlib.pyplot as plt
-
-from matplotlib import patches, patheffects
+# matplotlib is imported on first use, pyplot only by `plot_water_body`, so that headless workers rendering
+# thumbnails with PIL don't load it
 
 import os, sys, gc
-from PIL import Image
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw
 
 def draw_outline(o, lw):
+    from matplotlib import patheffects
     o.set_path_effects([patheffects.Stroke(
         linewidth=lw, foreground='black'), patheffects.Normal()])
 
 def draw_circ(ax, pos, radius, color='white'):
+    from matplotlib import patches
     patch = ax.add_patch(patches.Circle(pos, radius, fill=True, edgecolor=color, color=color, lw=2))
     draw_outline(patch, 4)
     
@@ -28,7 +27,8 @@ def draw_poly(ax, poly, color='xkcd:lime', lw=2):
         return
     if poly.exterior is None:
         return
-    
+    from matplotlib import patches
+
     x, y = poly.exterior.coords.xy
     xy = np.moveaxis(np.array([x, y]),0,-1)
     patch = ax.add_patch(patches.Polygon(xy, closed=True, edgecolor=color, fill=False, lw=lw))
@@ -46,6 +46,7 @@ def draw_text(ax, xy, txt, sz=14, color='white'):
 def plot_water_body(img, date, dam_poly, dam_bbox, water_extent, water_level, clip=0, 
                     color_nominal='white', color_current='xkcd:lime',
                     hide_axis=True, file_name=None, add_text=False):
+    import matplotlib.pyplot as plt
 
     shape = img.shape[0:2]
     dpi = 300
@@ -84,6 +85,9 @@ def plot_water_body(img, date, dam_poly, dam_bbox, water_extent, water_level, cl
 def plot_water_body_oo(img, date, dam_poly, dam_bbox, water_extent, water_level, clip=0, 
                         color_nominal='white', color_current='xkcd:lime',
                         hide_axis=True, file_name=None, add_text=False):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+    from matplotlib.ticker import NullLocator
 
     shape = img.shape[0:2]
     dpi = 300
@@ -94,8 +98,8 @@ def plot_water_body_oo(img, date, dam_poly, dam_bbox, water_extent, water_level,
     ax = fig.add_subplot(1, 1, 1)
 
     if hide_axis:
-        ax.xaxis.set_major_locator(plt.NullLocator())
-        ax.yaxis.set_major_locator(plt.NullLocator())
+        ax.xaxis.set_major_locator(NullLocator())
+        ax.yaxis.set_major_locator(NullLocator())
 
     if clip>0:
         ax.imshow(img,extent=[dam_bbox.min_x,dam_bbox.max_x,dam_bbox.min_y,dam_bbox.max_y],
@@ -128,4 +132,95 @@ def resize_image(orig, resized, width, height):
     im_res.close()
     im_orig.close()
     del im_res, im_orig
-    gc.collect()
\ No newline at end of file
+    gc.collect()
+
+def get_pixel_coords(coords, dam_bbox, width, height):
+    """
+    Converts coordinates in the bbox CRS to pixel coordinates of a width x height image of the bbox.
+    """
+    coords = np.asarray(coords)
+    min_x, min_y = dam_bbox.get_lower_left()
+    max_x, max_y = dam_bbox.get_upper_right()
+    cols = (coords[:, 0] - min_x)/(max_x - min_x)*width
+    rows = (max_y - coords[:, 1])/(max_y - min_y)*height
+    return list(zip(cols, rows))
+
+def draw_poly_outline(draw, geometry, dam_bbox, width, height, color, lw=2, outline_lw=4):
+    """
+    Draws exteriors of a polygon or multipolygon with a black outline, as `draw_poly` does with matplotlib.
+    """
+    from matplotlib.colors import to_rgb
+
+    if geometry is None or geometry.is_empty:
+        return
+    polys = list(geometry.geoms) if isinstance(geometry, MultiPolygon) else [geometry]
+    rgb = tuple(int(round(255*value)) for value in to_rgb(color))
+    for poly in polys:
+        if not isinstance(poly, Polygon) or poly.exterior is None:
+            continue
+        xy = get_pixel_coords(poly.exterior.coords, dam_bbox, width, height)
+        draw.line(xy, fill=(0, 0, 0, 255), width=outline_lw, joint='curve')
+        draw.line(xy, fill=rgb + (255,), width=lw, joint='curve')
+
+def render_water_body(img, dam_poly, dam_bbox, water_extent, width, height, date=None, water_level=None, clip=0,
+                      color_nominal='white', color_current='xkcd:lime', supersample=2):
+    """
+    Renders the image with nominal and current water extent outlines as a width x height RGBA array. Unlike
+    `plot_water_body` no matplotlib figure is created, the image is resized to the final size and outlines are drawn
+    directly with PIL (at `supersample` times the size for smoother lines).
+
+    Image is RGB or RGBA (e.g. with data mask as alpha) with values in [0, 1]. If clip is given, the image is
+    stretched so that its `clip` percentile becomes white.
+    """
+    rgb = np.asarray(img[..., :3], dtype=np.float32)
+    vmax = np.percentile(rgb, clip) if clip > 0 else 1.0
+    rgba = np.empty(img.shape[:2] + (4,), dtype=np.uint8)
+    rgba[..., :3] = np.clip(rgb*(255/max(vmax, 1e-6)), 0, 255)
+    rgba[..., 3] = 255 if img.shape[-1] < 4 else np.clip(img[..., 3]*255, 0, 255)
+
+    canvas_width, canvas_height = width*supersample, height*supersample
+    canvas = Image.fromarray(rgba, mode='RGBA').resize((canvas_width, canvas_height), Image.BILINEAR)
+    draw = ImageDraw.Draw(canvas)
+    draw_poly_outline(draw, dam_poly, dam_bbox, canvas_width, canvas_height, color_nominal,
+                      lw=2*supersample, outline_lw=4*supersample)
+    draw_poly_outline(draw, water_extent, dam_bbox, canvas_width, canvas_height, color_current,
+                      lw=2*supersample, outline_lw=4*supersample)
+    if supersample > 1:
+        canvas = canvas.resize((width, height), Image.LANCZOS)
+
+    if date is not None and water_level is not None:
+        ImageDraw.Draw(canvas).text((2, 2), f'{date} | {water_level*100: 3.0f}%', fill=(255, 255, 255, 255),
+                                    stroke_width=1, stroke_fill=(0, 0, 0, 255))
+
+    return np.asarray(canvas)
+
+def encode_png(image):
+    """
+    Encodes an RGB(A) array as PNG in memory and returns the bytes.
+    """
+    buffer = BytesIO()
+    Image.fromarray(image).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def render_thumbnail(frame, width, height, **kwargs):
+    """
+    Renders a frame (dict with `img`, `dam_poly`, `dam_bbox`, `water_extent` and optionally `date` and
+    `water_level`) as PNG bytes.
+    """
+    return encode_png(render_water_body(frame['img'], frame['dam_poly'], frame['dam_bbox'], frame['water_extent'],
+                                        width, height, date=frame.get('date'), water_level=frame.get('water_level'),
+                                        **kwargs))
+
+def _render_thumbnail_args(args):
+    return render_thumbnail(*args[0], **args[1])
+
+def render_thumbnails(frames, width, height, n_workers=None, chunksize=4, **kwargs):
+    """
+    Renders frames (see `render_thumbnail`) as PNG thumbnails in a process pool. Returns a list of PNG bytes in the
+    order of frames, no files are written.
+    """
+    tasks = [((frame, width, height), kwargs) for frame in frames]
+    if n_workers == 1:
+        return [_render_thumbnail_args(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(_render_thumbnail_args, tasks, chunksize=chunksize))
@@ -0,0 +1,40 @@
+""" Tests of `CloudDetectionService` against `s2cloudless.CloudMaskRequest`. """
+
+import numpy as np
+import pytest
+
+from cloud_detection import N_CLOUD_BANDS, CloudDetectionService
+
+s2cloudless = pytest.importorskip('s2cloudless')
+
+def get_frame(height=48, width=64):
+    """
+    Cloud bands and data mask of a frame with a cloud across the invalid columns on its right.
+    """
+    rng = np.random.RandomState(0)
+    bands = rng.uniform(0.02, 0.12, size=(height, width, N_CLOUD_BANDS)).astype(np.float32)
+    bands[10:30, 40:] = rng.uniform(0.5, 0.7, size=(20, width - 40, N_CLOUD_BANDS))
+    data_mask = np.ones((height, width, 1), dtype=np.float32)
+    data_mask[:, 50:] = 0.0
+    return np.concatenate([bands, data_mask], axis=-1)
+
+def get_baseline_cloud_mask(frame):
+    """
+    Cloud mask of `CloudMaskRequest`, with bands and valid data set instead of downloaded.
+    """
+    request = s2cloudless.CloudMaskRequest.__new__(s2cloudless.CloudMaskRequest)
+    request.cloud_detector = s2cloudless.S2PixelCloudDetector(threshold=0.4, average_over=4, dilation_size=2)
+    request.bands = frame[np.newaxis, ..., :-1]
+    request.valid_data = frame[np.newaxis, ..., -1] == 1.0
+    request.probability_masks = None
+    return request.get_cloud_masks()[0].astype(bool)
+
+def test_cloud_mask_of_partially_invalid_frame():
+    frame = get_frame()
+    valid_mask = frame[..., -1] == 1.0
+
+    cloud_mask = CloudDetectionService().get_cloud_masks([frame], valid_masks=[valid_mask])[0]
+
+    baseline = get_baseline_cloud_mask(frame)
+    assert baseline.any() and not baseline.all()
+    np.testing.assert_array_equal(cloud_mask, baseline)
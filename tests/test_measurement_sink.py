@@ -0,0 +1,24 @@
+""" Tests of writing and reading the measurement dataset. """
+
+import os
+from datetime import date
+
+import pytest
+
+from definitions import WaterDetectionSensor, get_new_measurement_entry
+from measurement_sink import MeasurementSink, read_measurements
+
+DAM_IDS = ['plain', 'basin/dam', 'a=b', '100%', 'a%2Fb']
+
+@pytest.mark.parametrize('file_format', ['parquet', 'arrow'])
+def test_dam_ids_with_separators(tmp_path, file_format):
+    with MeasurementSink(str(tmp_path), file_format=file_format) as sink:
+        for dam_id in DAM_IDS:
+            sink.write(get_new_measurement_entry(dam_id, date(2020, 1, 1), WaterDetectionSensor.S2_NDWI, 'v1'))
+
+    assert len(os.listdir(tmp_path)) == len(DAM_IDS)
+    table = read_measurements(str(tmp_path), file_format=file_format)
+    assert sorted(table['BLUEDOT_WB_ID'].to_pylist()) == sorted(DAM_IDS)
+    for dam_id in DAM_IDS:
+        table = read_measurements(str(tmp_path), file_format=file_format, dam_ids=[dam_id])
+        assert table['BLUEDOT_WB_ID'].to_pylist() == [dam_id]
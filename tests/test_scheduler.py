@@ -0,0 +1,111 @@
+""" Tests of `CatalogueScheduler` with a fake Sentinel Hub responder instead of downloads. """
+
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from shapely.geometry import Point
+from sentinelhub import bbox_to_dimensions
+
+from geom_utils import get_raster_mask
+from definitions import WaterDetectionSensor, WaterDetectionStatus
+from scheduler import CatalogueScheduler
+
+DATES = [datetime(2020, 1, 1) + timedelta(days=5*idx) for idx in range(6)]
+
+def get_dams(n_dams=3):
+    return [(f'dam-{idx}', Point(14.0 + idx, 46.0).buffer(0.005)) for idx in range(n_dams)]
+
+def fetch_dates(time_interval, dam_bbox, resx, resy):
+    return DATES
+
+def fetch_frame(measurement, dam_bbox, date, resx, resy):
+    """
+    NDWI with water inside a circle shrinking with the date, later dates of a dam arrive first.
+    """
+    time_to_wait = 0.01*(len(DATES) - DATES.index(date))
+    threading.Event().wait(time_to_wait)
+    width, height = bbox_to_dimensions(dam_bbox, (resx, resy))
+    center = Point(*dam_bbox.middle)
+    water = get_raster_mask(center.buffer(0.004 - 0.0003*DATES.index(date)), dam_bbox, width, height)
+    return np.where(water, 0.5, -0.5).astype(np.float32)
+
+def fetch_dem(dam_bbox, resx, resy):
+    width, height = bbox_to_dimensions(dam_bbox, (resx, resy))
+    return np.zeros((height, width), dtype=np.float32)
+
+def run_with_timeout(scheduler, dams, timeout=120):
+    """
+    Consumes the run in a thread, so a hanging scheduler fails the test instead of blocking it.
+    """
+    outcome = {}
+
+    def consume():
+        try:
+            outcome['measurements'] = list(scheduler.run(dams))
+        except Exception as exception:
+            outcome['error'] = exception
+
+    thread = threading.Thread(target=consume, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'scheduler run did not finish'
+    return outcome
+
+def get_scheduler(**kwargs):
+    return CatalogueScheduler(('2020-01-01', '2020-02-01'), n_download_workers=4, n_compute_workers=2,
+                              max_pending=4, fetch_dates=fetch_dates, fetch_frame=fetch_frame,
+                              fetch_dem=fetch_dem, **kwargs)
+
+@pytest.mark.parametrize('shared_rasters', [False, True])
+def test_measurements_in_order(shared_rasters):
+    scheduler = get_scheduler(dem_threshold=15, shared_rasters=shared_rasters)
+    outcome = run_with_timeout(scheduler, get_dams())
+    assert 'error' not in outcome
+    measurements = outcome['measurements']
+
+    # a valid measurement and its DEM vetoed copy per date
+    assert len(measurements) == 3*len(DATES)*2
+    for dam_id, _ in get_dams():
+        dam_measurements = [measurement for measurement in measurements if measurement.BLUEDOT_WB_ID == dam_id]
+        optical = [measurement for measurement in dam_measurements
+                   if measurement.SENSOR_TYPE == WaterDetectionSensor.S2_NDWI.value]
+        assert [measurement.SAT_IMAGE_DATE for measurement in optical] == \
+            [date.strftime('%Y-%m-%d') for date in DATES]
+        assert all(measurement.MEAS_STATUS == WaterDetectionStatus.MEASUREMENT_VALID.value
+                   for measurement in dam_measurements)
+        water_levels = [measurement.SURF_WATER_LEVEL for measurement in optical]
+        assert water_levels == sorted(water_levels, reverse=True)
+
+    assert scheduler.stats.n_frames == 3*len(DATES)
+    if shared_rasters:
+        # frames are below the size of shared buffers, they are pickled and no buffer is left in use
+        assert scheduler.raster_ring.stats['pickled'] > 0
+        assert not any(scheduler.raster_ring._refs)
+
+def test_default_workers():
+    scheduler = CatalogueScheduler(('2020-01-01', '2020-02-01'), fetch_dates=fetch_dates, fetch_frame=fetch_frame,
+                                   fetch_dem=fetch_dem)
+    outcome = run_with_timeout(scheduler, get_dams(1))
+    assert 'error' not in outcome
+    assert len(outcome['measurements']) == len(DATES)*(1 if scheduler.dem_threshold is None else 2)
+
+def test_producer_failure_is_raised():
+    # the second dam has no polygon, DamContext fails after the first dam was scheduled
+    dams = get_dams(1) + [('broken', None)] + get_dams(2)[1:]
+    outcome = run_with_timeout(get_scheduler(), dams)
+    assert isinstance(outcome.get('error'), AttributeError)
+
+def test_frame_failure_keeps_unknown_error():
+    def failing_fetch_frame(measurement, dam_bbox, date, resx, resy):
+        if date == DATES[2]:
+            raise ValueError('corrupt response')
+        return fetch_frame(measurement, dam_bbox, date, resx, resy)
+
+    scheduler = get_scheduler()
+    scheduler.fetch_frame = failing_fetch_frame
+    outcome = run_with_timeout(scheduler, get_dams(1))
+    statuses = [measurement.MEAS_STATUS for measurement in outcome['measurements']]
+    assert statuses[2] == WaterDetectionStatus.UNKNOWN_ERROR.value
+    assert statuses.count(WaterDetectionStatus.MEASUREMENT_VALID.value) == len(DATES) - 1
@@ -0,0 +1,125 @@
+""" Tests of `RequestClient` retries against a local mock server. """
+
+import json
+import time
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+import requests
+from sentinelhub import BBox, CRS
+
+import sh_client
+from sh_client import RequestClient, WebFeatureService, set_default_client
+
+class MockHandler(BaseHTTPRequestHandler):
+    """
+    Responds with the next scripted (status, headers, body) of the server and records requested paths.
+    """
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        status, headers, body = self.server.responses.pop(0) if self.server.responses else (200, {}, b'{}')
+        if callable(body):
+            body = body(self.path)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = HTTPServer(('127.0.0.1', 0), MockHandler)
+    server.responses, server.paths = [], []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f'http://127.0.0.1:{server.server_port}'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def get_client(**kwargs):
+    kwargs.setdefault('backoff', 0.01)
+    return RequestClient(max_concurrency=2, **kwargs)
+
+def test_retry_after_is_respected(server):
+    server.responses = [(429, {'Retry-After': '0.2'}, b''), (200, {}, b'ok')]
+    client = get_client(backoff=30)
+    start = time.perf_counter()
+    response = client.request('GET', f'{server.url}/ogc/wcs/instance')
+    elapsed = time.perf_counter() - start
+
+    assert response.content == b'ok'
+    # the backoff of 30 s would be used without the header
+    assert 0.2 <= elapsed < 5
+    stats = client.summary()[f'127.0.0.1:{server.server_port}/ogc/wcs']
+    assert (stats['requests'], stats['retries'], stats['errors']) == (2, 1, 0)
+
+def test_server_errors_are_retried(server):
+    server.responses = [(503, {}, b''), (502, {}, b''), (500, {}, b''), (200, {}, b'ok')]
+    client = get_client()
+    assert client.request('GET', f'{server.url}/ogc/wcs/instance').content == b'ok'
+    assert len(server.paths) == 4
+
+def test_retries_are_limited(server):
+    server.responses = [(500, {}, b'')]*5
+    client = get_client(max_retries=2)
+    with pytest.raises(requests.HTTPError):
+        client.request('GET', f'{server.url}/ogc/wcs/instance')
+    assert len(server.paths) == 3
+    stats = client.summary()[f'127.0.0.1:{server.server_port}/ogc/wcs']
+    assert (stats['requests'], stats['retries'], stats['errors']) == (3, 2, 1)
+
+def test_client_errors_are_not_retried(server):
+    server.responses = [(400, {}, b''), (200, {}, b'ok')]
+    client = get_client()
+    with pytest.raises(requests.HTTPError):
+        client.request('GET', f'{server.url}/ogc/wcs/instance')
+    assert len(server.paths) == 1
+
+def get_features(path):
+    """
+    Two tiles per page of features, two pages.
+    """
+    offset = int(parse_qs(urlparse(path).query)['FEATURE_OFFSET'][0])
+    dates = ['2020-01-01', '2020-01-06'] if offset == 0 else ['2020-01-11']
+    features = [{'type': 'Feature', 'geometry': None,
+                 'properties': {'id': f'tile-{date}', 'date': date, 'time': '10:05:01.100',
+                                'cloudCoverPercentage': 10.0}} for date in dates]
+    return json.dumps({'type': 'FeatureCollection', 'features': features}).encode()
+
+def test_wfs_pages_through_client(server, monkeypatch):
+    monkeypatch.setattr(sh_client.SHConfig()._instance, 'max_wfs_records_per_query', 2)
+    server.responses = [(429, {'Retry-After': '0'}, b''), (200, {}, get_features), (200, {}, get_features)]
+    client = get_client()
+    previous = set_default_client(client)
+    try:
+        tiles = WebFeatureService(BBox([14.0, 46.0, 14.1, 46.1], crs=CRS.WGS84), ('2020-01-01', '2020-01-31'),
+                                  base_url=f'{server.url}/ogc/', instance_id='instance')
+        dates = tiles.get_dates()
+    finally:
+        set_default_client(previous)
+
+    assert [date.day for date in dates] == [1, 6, 11]
+    assert [parse_qs(urlparse(path).query)['FEATURE_OFFSET'][0] for path in server.paths] == ['0', '0', '2']
+    stats = client.summary()[f'127.0.0.1:{server.server_port}/ogc/wfs']
+    assert (stats['requests'], stats['retries']) == (3, 1)
+
+def test_wfs_without_client(server, monkeypatch):
+    monkeypatch.setattr(sh_client.SHConfig()._instance, 'max_wfs_records_per_query', 2)
+    server.responses = [(200, {}, get_features), (200, {}, get_features)]
+    previous = set_default_client(None)
+    try:
+        tiles = WebFeatureService(BBox([14.0, 46.0, 14.1, 46.1], crs=CRS.WGS84), ('2020-01-01', '2020-01-31'),
+                                  base_url=f'{server.url}/ogc/', instance_id='instance')
+        dates = tiles.get_dates()
+    finally:
+        set_default_client(previous)
+
+    assert [date.day for date in dates] == [1, 6, 11]
+    assert [parse_qs(urlparse(path).query)['FEATURE_OFFSET'][0] for path in server.paths] == ['0', '2']
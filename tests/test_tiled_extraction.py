@@ -0,0 +1,46 @@
+""" Tests of the global threshold of tiled extraction against `get_water_mask_from_S2` on the whole scene. """
+
+import numpy as np
+import pytest
+from sentinelhub import BBox, CRS
+
+from s2_water_extraction import get_water_mask_from_S2, get_structuring_element
+from tiled_extraction import _Tile, _get_global_threshold, get_tile_bboxes
+
+RESOLUTION = 10
+
+def get_scene(height=160, width=192):
+    """
+    NDWI of a lake with a noisy shore, in a UTM bbox of whole pixels.
+    """
+    rng = np.random.RandomState(0)
+    rows, cols = np.mgrid[:height, :width]
+    distance = np.hypot(rows - 0.45*height, cols - 0.55*width)
+    ndwi = np.where(distance < 0.3*min(height, width), 0.4, -0.3) + rng.normal(0, 0.08, size=(height, width))
+    bbox = BBox(bbox=[500000, 5000000, 500000 + RESOLUTION*width, 5000000 + RESOLUTION*height], crs=CRS.UTM_33N)
+    return ndwi.astype(np.float32), bbox
+
+def get_tiles(ndwi, bbox, folder, tile_size, overlap):
+    """
+    Cuts the scene into tiles of `get_tile_bboxes` and stores them as `extract_surface_water_area_tiled` does.
+    """
+    min_x, max_y = bbox.min_x, bbox.max_y
+    tiles = []
+    for idx, (core_bbox, tile_bbox) in enumerate(get_tile_bboxes(bbox, RESOLUTION, RESOLUTION, tile_size, overlap)):
+        cols = slice(int(round((tile_bbox.min_x - min_x)/RESOLUTION)), int(round((tile_bbox.max_x - min_x)/RESOLUTION)))
+        rows = slice(int(round((max_y - tile_bbox.max_y)/RESOLUTION)), int(round((max_y - tile_bbox.min_y)/RESOLUTION)))
+        tile = _Tile(core_bbox, tile_bbox, str(folder/f'{idx}.npy'))
+        np.save(tile.path, ndwi[rows, cols])
+        tiles.append(tile)
+    return tiles
+
+@pytest.mark.parametrize('tile_size', [256, 96])
+def test_global_threshold_as_whole_scene(tmp_path, tile_size):
+    ndwi, bbox = get_scene()
+    tiles = get_tiles(ndwi, bbox, tmp_path, tile_size, overlap=64)
+
+    otsu_thr, status = _get_global_threshold(tiles, ndwi.min(), ndwi.max(), 4, 0.3, get_structuring_element(4))
+
+    expected_status, expected_water = get_water_mask_from_S2(ndwi)
+    assert status == expected_status == 1
+    np.testing.assert_array_equal(ndwi > otsu_thr, expected_water.astype(bool))